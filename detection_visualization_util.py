@@ -464,100 +464,70 @@ def get_bounding_boxes_for_image_array(
         groundtruth_box_visualization_color='black',
         skip_scores=True,
         skip_labels=True):
-    """Overlay labeled boxes on an image with formatted scores and label names.
-    This function groups boxes that correspond to the same location
-    and creates a display string for each detection and overlays these
-    on the image. Note that this function modifies the image in place, and returns
-    that same image.
+    """Get the pixel bounding boxes of the detections in an image.
+    This is a vectorized version of looping over get_bounding_box_for_image_array.
+    Scores are thresholded, boxes at the same location are grouped together and
+    every remaining box is scaled to pixels in a single array operation using the
+    image's shape. The image itself is never converted or copied.
     Args:
       image: uint8 numpy array with shape (img_height, img_width, 3)
       boxes: a numpy array of shape [N, 4]
       classes: a numpy array of shape [N]. Note that class indices are 1-based,
         and match the keys in the label map.
       scores: a numpy array of shape [N] or None.  If scores=None, then
-        this function assumes that the boxes to be plotted are groundtruth
-        boxes and plot all boxes as black with no classes or scores.
-      category_index: a dict containing category dictionaries (each holding
-        category index `id` and category name `name`) keyed by category indices.
-      instance_masks: a numpy array of shape [N, image_height, image_width] with
-        values ranging between 0 and 1, can be None.
-      instance_boundaries: a numpy array of shape [N, image_height, image_width]
-        with values ranging between 0 and 1, can be None.
-      keypoints: a numpy array of shape [N, num_keypoints, 2], can
-        be None
+        this function assumes that the boxes are groundtruth boxes and keeps them all.
+      instance_masks: unused, kept for compatibility with the visualization_utils API.
+      instance_boundaries: unused, kept for compatibility.
+      keypoints: unused, kept for compatibility.
       use_normalized_coordinates: whether boxes is to be interpreted as
         normalized coordinates or not.
-      max_boxes_to_draw: maximum number of boxes to visualize.  If None, draw
+      max_boxes_to_draw: maximum number of boxes to return.  If None, return
         all boxes.
-      min_score_thresh: minimum score threshold for a box to be visualized
-      agnostic_mode: boolean (default: False) controlling whether to evaluate in
-        class-agnostic mode or not.  This mode will display scores but ignore
-        classes.
-      line_thickness: integer (default: 4) controlling line width of the boxes.
-      groundtruth_box_visualization_color: box color for visualizing groundtruth
-        boxes
-      skip_scores: whether to skip score when drawing a single detection
-      skip_labels: whether to skip label when drawing a single detection
+      min_score_thresh: minimum score threshold for a box to be returned
+      agnostic_mode: unused, kept for compatibility.
+      line_thickness: unused, kept for compatibility.
+      groundtruth_box_visualization_color: unused, kept for compatibility.
+      skip_scores: unused, kept for compatibility.
+      skip_labels: unused, kept for compatibility.
     Returns:
-      uint8 numpy array with shape (img_height, img_width, 3) with overlaid boxes.
+      a list of (left, top, right, bottom, detection_class_id) tuples in pixels.
+      When several boxes share the same location, the box keeps its first position
+      in the list and the class of its last occurrence.
     """
-    # Create a display string (and color) for every box location, group any boxes
-    # that correspond to the same location.
-    box_to_display_str_map = collections.defaultdict(list)
-    box_to_color_map = collections.defaultdict(str)
-    box_to_instance_masks_map = {}
-    box_to_instance_boundaries_map = {}
-    box_to_keypoints_map = collections.defaultdict(list)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    classes = np.asarray(classes).reshape(-1)
+
     if not max_boxes_to_draw:
         max_boxes_to_draw = boxes.shape[0]
-    for i in range(min(max_boxes_to_draw, boxes.shape[0])):
-        if scores is None or scores[i] > min_score_thresh:
-            box = tuple(boxes[i].tolist())
-            if instance_masks is not None:
-                box_to_instance_masks_map[box] = instance_masks[i]
-            if instance_boundaries is not None:
-                box_to_instance_boundaries_map[box] = instance_boundaries[i]
-            if keypoints is not None:
-                box_to_keypoints_map[box].extend(keypoints[i])
-            if scores is None:
-                box_to_color_map[box] = groundtruth_box_visualization_color
-            else:
-                display_str = ''
-                if not skip_labels:
-                    if not agnostic_mode:
-                        if classes[i] in category_index.keys():
-                            class_name = category_index[classes[i]]['name']
-                        else:
-                            class_name = 'N/A'
-                        display_str = str(class_name)
-                if not skip_scores:
-                    if not display_str:
-                        display_str = '{}%'.format(int(100*scores[i]))
-                    else:
-                        display_str = '{}: {}%'.format(display_str, int(100*scores[i]))
-                box_to_display_str_map[box].append(display_str)
-                if agnostic_mode:
-                    box_to_color_map[box] = ('DarkOrange', classes[i])
-                else:
-                    box_to_color_map[box] = (STANDARD_COLORS[classes[i] % len(STANDARD_COLORS)], classes[i])
-
-    bounding_boxes = []
-    # Draw all boxes onto image.
-    for box, (color, detection_class_id) in box_to_color_map.items():
-        ymin, xmin, ymax, xmax = box
-        left, top, right, bottom = get_bounding_box_for_image_array(
-            image,
-            ymin,
-            xmin,
-            ymax,
-            xmax,
-            color=color,
-            thickness=line_thickness,
-            display_str_list=box_to_display_str_map[box],
-            use_normalized_coordinates=use_normalized_coordinates
-        )
-
-        bounding_boxes.append((left, top, right, bottom, detection_class_id))
+    num_boxes = min(max_boxes_to_draw, boxes.shape[0])
+    boxes = boxes[:num_boxes]
+    classes = classes[:num_boxes]
+
+    if scores is not None:
+        keep = np.asarray(scores).reshape(-1)[:num_boxes] > min_score_thresh
+        boxes = boxes[keep]
+        classes = classes[keep]
+
+    if boxes.shape[0] == 0:
+        return []
+
+    # Group boxes that correspond to the same location. The group is ordered by its first
+    # occurrence and takes the class of its last occurrence
+    _, first_index, inverse = np.unique(boxes, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    last_index = np.zeros(first_index.shape[0], dtype=np.int64)
+    np.maximum.at(last_index, inverse, np.arange(boxes.shape[0]))
+    order = np.argsort(first_index)
+    boxes = boxes[first_index[order]]
+    classes = classes[last_index[order]]
+
+    # boxes are (ymin, xmin, ymax, xmax). Reorder them to (left, top, right, bottom)
+    pixel_boxes = boxes[:, [1, 0, 3, 2]]
+    if use_normalized_coordinates:
+        im_height, im_width = image.shape[0:2]
+        pixel_boxes = pixel_boxes * np.array([im_width, im_height, im_width, im_height], dtype=np.float64)
 
-    return bounding_boxes
+    # Truncate towards zero, the same as int()
+    pixel_boxes = pixel_boxes.astype(np.int64).tolist()
 
+    return [(left, top, right, bottom, detection_class_id) for (left, top, right, bottom), detection_class_id in zip(pixel_boxes, classes.tolist())]
@@ -0,0 +1,226 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+import io
+import os
+from abc import ABC, abstractmethod
+import json
+import threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import requests
+from PIL import Image
+
+
+'''
+Object detection backends
+
+Every backend takes a frame (numpy array) and returns the 'prediction_result' dictionary from the Node Lite Object Detection
+function with 'detection_boxes', 'detection_scores' and 'detection_classes' converted back to numpy arrays.
+Frames are encoded to JPEG in memory. Nothing is written to disk.
+'''
+
+
+def encode_frame(frame):
+    # Remember Opencv images are in 'BGR'. They're sent as is, the same as when they were saved to /tmp
+    jpeg_buffer = io.BytesIO()
+    Image.fromarray(frame).save(jpeg_buffer, format='JPEG')
+    return jpeg_buffer.getvalue()
+
+
+def parse_prediction_result(response_text):
+    response_dict = json.loads(response_text)
+
+    output_dict = response_dict['prediction_result']
+
+    # Convert from Python lists back to Numpy arrays
+    output_dict['detection_boxes'] = np.array(output_dict['detection_boxes'])
+    output_dict['detection_scores'] = np.array(output_dict['detection_scores'])
+    output_dict['detection_classes'] = np.array(output_dict['detection_classes'])
+
+    return output_dict
+
+
+
+class DetectorBackend(ABC):
+    def __init__(self):
+        # HTTP sessions (and boto3 sessions) aren't safe to share between threads or across a fork ...
+        # ... so each thread of each process gets its own
+        self._local = threading.local()
+
+    def _thread_state(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.__dict__.clear()
+            self._local.pid = os.getpid()
+        return self._local
+
+    def session(self):
+        state = self._thread_state()
+        if not hasattr(state, 'session'):
+            state.session = requests.Session() # Keeps the connection to the endpoint alive between detections
+        return state.session
+
+    def wakeup(self):
+        pass
+
+    @abstractmethod
+    def detect(self, frame_number, frame):
+        # The prediction_result for the frame
+        pass
+
+
+
+class S3LambdaDetectorBackend(DetectorBackend):
+    # Upload frame to S3, ask the Lambda function to run detection on the S3 object, then delete the object
+    def __init__(self, lambda_url, s3_bucket_name):
+        super().__init__()
+        self.lambda_url = lambda_url
+        self.s3_bucket_name = s3_bucket_name
+
+    def s3_bucket(self):
+        state = self._thread_state()
+        if not hasattr(state, 's3_bucket'):
+            import boto3
+            state.s3_bucket = boto3.session.Session().resource('s3').Bucket(self.s3_bucket_name)
+        return state.s3_bucket
+
+    def wakeup(self):
+        self.session().get(self.lambda_url)
+
+    def detect(self, frame_number, frame):
+        file_name_ext = 'frame_'+str(frame_number)+'.jpg'
+        s3_bucket = self.s3_bucket()
+
+        s3_bucket.upload_fileobj(io.BytesIO(encode_frame(frame)), file_name_ext)
+        try:
+            response = self.session().get(self.lambda_url, params={"bucket": self.s3_bucket_name, "key": file_name_ext})
+        finally:
+            try:
+                s3_bucket.delete_objects(Delete={'Objects': [{'Key': file_name_ext}]})
+            except:
+                import traceback
+                traceback.print_exc()
+
+        return parse_prediction_result(response.text)
+
+
+
+class HttpDetectorBackend(DetectorBackend):
+    # POST the JPEG bytes straight to the detection endpoint. One round trip per detection
+    def __init__(self, detection_url, timeout=30):
+        super().__init__()
+        self.detection_url = detection_url
+        self.timeout = timeout
+
+    def wakeup(self):
+        self.session().get(self.detection_url, timeout=self.timeout)
+
+    def detect(self, frame_number, frame):
+        response = self.session().post(
+            self.detection_url,
+            params={"frame_number": frame_number},
+            data=encode_frame(frame),
+            headers={"Content-Type": "image/jpeg"},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+
+        return parse_prediction_result(response.text)
+
+
+
+def empty_prediction_result(jpeg_bytes):
+    return {
+        "num_detections": 0,
+        "detection_boxes": [],
+        "detection_scores": [],
+        "detection_classes": []
+    }
+
+
+class LocalDetectionServer:
+    '''
+    Local stand-in for the detection endpoint, for running the node and its tests without AWS.
+    'detect_function' takes the posted JPEG bytes and returns a 'prediction_result' dictionary. By default there are no detections
+    '''
+    def __init__(self, host='127.0.0.1', port=0, detect_function=empty_prediction_result):
+        detect_function_ = detect_function
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self): # Wakeup ping
+                self._send({"status": "awake"})
+
+            def do_POST(self):
+                jpeg_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._send({"prediction_result": detect_function_(jpeg_bytes)})
+
+            def _send(self, response_dict):
+                body = bytes(json.dumps(response_dict), 'utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[0:2]
+        return 'http://'+host+':'+str(port)+'/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+
+DETECTOR_BACKENDS = ['s3', 'http', 'local']
+
+def create_detector_backend(name, detection_url=None, s3_bucket_name=None):
+    if name == 's3':
+        return S3LambdaDetectorBackend(detection_url, s3_bucket_name)
+    elif name == 'http':
+        return HttpDetectorBackend(detection_url)
+    elif name == 'local':
+        local_server = LocalDetectionServer().start()
+        print("Started local stand-in detection server at "+local_server.url)
+        return HttpDetectorBackend(local_server.url)
+    else:
+        raise ValueError("Unknown detector backend '"+str(name)+"'. Choose from "+str(DETECTOR_BACKENDS))
+
+
+
+if __name__ == '__main__':
+    # Run the stand-in detection server on its own, e.g. for '--detector http --detection_url http://127.0.0.1:8767/'
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8767,
+                    help="Port for the local stand-in detection server [default: 8767]")
+    server_args = vars(ap.parse_args())
+
+    local_server = LocalDetectionServer(port=server_args['port'])
+    print("Local stand-in detection server listening at "+local_server.url)
+    try:
+        local_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        local_server.httpd.server_close()
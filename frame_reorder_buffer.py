@@ -0,0 +1,96 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+import heapq
+import time
+
+
+class FrameReorderBuffer:
+    '''
+    Puts frames that arrive out of order (detected frames come back from the detector later than the frames around them)
+    back in frame number order.
+
+    pop() only releases the next expected frame number. If that frame is missing, pop() waits for it until the lateness
+    watermark 'max_wait' (seconds) has passed since the gap was first seen, or until the buffer holds 'max_size' frames,
+    and then skips ahead to the lowest frame number it has. A frame that arrives after its number has been skipped is late
+    and is handed back by push() so the caller can free whatever it holds.
+    '''
+    def __init__(self, max_wait=5.0, max_size=300, first_frame_number=0):
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.next_frame_number = first_frame_number
+
+        self.heap = []
+        self.push_count = 0
+        self.gap_since = None # When we started waiting for next_frame_number while later frames were already buffered
+
+        self.late_count = 0 # frames that arrived after their number was skipped
+        self.skipped_count = 0 # frame numbers given up on
+
+
+    def __len__(self):
+        return len(self.heap)
+
+
+    def push(self, frame_number, item):
+        # Returns a list of the (frame_number, item) tuples that were rejected as late
+        if frame_number < self.next_frame_number:
+            self.late_count += 1
+            return [(frame_number, item)]
+
+        # push_count breaks ties so items are never compared
+        heapq.heappush(self.heap, (frame_number, self.push_count, item))
+        self.push_count += 1
+        return []
+
+
+    def pop(self, now=None):
+        # Returns the next (frame_number, item) in order or None if it isn't ready yet
+        if not self.heap:
+            self.gap_since = None
+            return None
+
+        now = time.time() if now is None else now
+        lowest_frame_number = self.heap[0][0]
+
+        if lowest_frame_number > self.next_frame_number:
+            if self.gap_since is None:
+                self.gap_since = now
+
+            if now - self.gap_since < self.max_wait and len(self.heap) < self.max_size:
+                return None # keep waiting for the missing frame
+
+            # Past the watermark (or out of room). Give up on the missing frame numbers
+            self.skipped_count += lowest_frame_number - self.next_frame_number
+            self.next_frame_number = lowest_frame_number
+
+        self.gap_since = None
+        self.next_frame_number = lowest_frame_number + 1
+        frame_number, _, item = heapq.heappop(self.heap)
+        return (frame_number, item)
+
+
+    def seconds_until_skip(self, now=None):
+        # How long pop() can keep returning None before it'll skip a missing frame. None if nothing is buffered
+        if not self.heap or self.gap_since is None:
+            return None
+
+        now = time.time() if now is None else now
+        return max(0.0, self.max_wait - (now - self.gap_since))
+
+
+    def stats(self):
+        return {
+            "buffered": len(self.heap),
+            "late": self.late_count,
+            "skipped": self.skipped_count
+        }
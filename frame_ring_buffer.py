@@ -0,0 +1,95 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+from multiprocessing import Queue
+from multiprocessing import shared_memory
+from queue import Empty
+import numpy as np
+
+
+class FrameRingBuffer:
+    '''
+    Fixed number of frame slots in one block of shared memory (https://docs.python.org/3/library/multiprocessing.shared_memory.html)
+
+    A producer acquires a free slot, writes its frame into it and sends only the slot index (plus whatever metadata it needs)
+    through a multiprocessing queue. The consumer reads the frame in place as a numpy view of the shared memory and releases
+    the slot when it's done with it. Frames are never pickled or copied between processes and memory use is bounded by
+    num_slots no matter how far behind the consumer gets.
+
+    Create it before starting the processes that use it.
+    '''
+    def __init__(self, num_slots, frame_shape, dtype=np.uint8):
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+
+        slot_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_nbytes*num_slots)
+        self.owner = True
+        self.frames = np.ndarray((num_slots,)+self.frame_shape, dtype=self.dtype, buffer=self.shm.buf)
+
+        # Indices of the slots that aren't holding a frame
+        self.free_slots = Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+
+    def __getstate__(self):
+        # Only needed if the ring is passed to a process that isn't forked. The child attaches to the same shared memory by name
+        return {
+            "name": self.shm.name,
+            "num_slots": self.num_slots,
+            "frame_shape": self.frame_shape,
+            "dtype": self.dtype.str,
+            "free_slots": self.free_slots
+        }
+
+    def __setstate__(self, state):
+        self.num_slots = state['num_slots']
+        self.frame_shape = state['frame_shape']
+        self.dtype = np.dtype(state['dtype'])
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.frames = np.ndarray((self.num_slots,)+self.frame_shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.free_slots = state['free_slots']
+
+
+    def acquire(self, block=False, timeout=None):
+        # Returns the index of a free slot or None if every slot is in use
+        try:
+            return self.free_slots.get(block=block, timeout=timeout)
+        except Empty:
+            return None
+
+    def put(self, frame, block=False, timeout=None):
+        # Copy 'frame' into a free slot. Returns the slot index or None if every slot is in use
+        slot = self.acquire(block=block, timeout=timeout)
+        if slot is not None:
+            np.copyto(self.frames[slot], frame)
+        return slot
+
+    def get(self, slot):
+        # A view of the frame in the slot, not a copy. Only valid until the slot is released
+        return self.frames[slot]
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def free_count(self):
+        return self.free_slots.qsize()
+
+
+    def close(self):
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -112,6 +112,8 @@ export default class App extends Component {
 		this.last_query_timestamp = 0;
 		this.new_query_timestamp;
 		this.query_timestamp_range = 60000;
+		this.query_lod = {"tolerance_m": 0.25, "max_points": 300}; // node thins out each object's tracklets to what's needed to animate it
+		this.liveResumeToken = null; // token of the last message from the live tail subscription, to resume from after a reconnect
 		this.mapLoaded = false;
 		this.lastRAFTimestamp = 0;
 		this.lastMapLatitudeFocus = 0;
@@ -129,9 +131,13 @@ export default class App extends Component {
 		this._interpolateTrackableObjects = this._interpolateTrackableObjects.bind(this);
 		this._openCalFrameWebsocketConnection = this._openCalFrameWebsocketConnection.bind(this);
 		this._openTrackletsWebsocketConnection = this._openTrackletsWebsocketConnection.bind(this);
+		this._openLiveTrackletsWebsocketConnection = this._openLiveTrackletsWebsocketConnection.bind(this);
+		this._subscribeLiveTracklets = this._subscribeLiveTracklets.bind(this);
+		this._receiveLiveTracklets = this._receiveLiveTracklets.bind(this);
 
 		this._openCalFrameWebsocketConnection();
 		this._openTrackletsWebsocketConnection();
+		this._openLiveTrackletsWebsocketConnection();
 
 		this._onCalibrationToggleClick = this._onCalibrationToggleClick.bind(this);
 		this._setDefaultObjectFootprints = this._setDefaultObjectFootprints.bind(this);
@@ -164,6 +170,9 @@ export default class App extends Component {
 		this.ws_send_cal_recv_frame.removeEventListener('close', this._openCalFrameWebsocketConnection);
 		this.ws_get_tracklets.removeEventListener('close', this._openTrackletsWebsocketConnection);
 
+		this.ws_live_tracklets.removeEventListener('close', this._openLiveTrackletsWebsocketConnection);
+		this.ws_live_tracklets.close();
+
 	}
 
 
@@ -185,6 +194,64 @@ export default class App extends Component {
 	}
 
 
+	_openLiveTrackletsWebsocketConnection() {
+		try {
+			this.ws_live_tracklets = new WebSocket('ws://'+window.location.hostname+':8080/subscribe_tracklets');
+			this.ws_live_tracklets.addEventListener('open', this._subscribeLiveTracklets);
+			this.ws_live_tracklets.addEventListener('message', this._receiveLiveTracklets);
+			this.ws_live_tracklets.addEventListener('close', () => setTimeout(this._openLiveTrackletsWebsocketConnection, 1000));
+		} catch(e) {
+			console.log("error", e);
+		}
+	}
+
+	_subscribeLiveTracklets() {
+		// Pick up where the last subscription left off, if there was one
+		if (this.ws_live_tracklets.readyState == 1) {
+			this.ws_live_tracklets.send(JSON.stringify(this.liveResumeToken === null ? {} : {"resume_token": this.liveResumeToken}));
+		}
+	}
+
+	_isLive() {
+		// The clock is showing the last query_timestamp_range and the live tail is pushing every new object, so the ...
+		// ... time window doesn't have to be queried again as the clock moves
+		return this.liveResumeToken !== null && this.ws_live_tracklets.readyState == 1 && this.last_query_timestamp !== 0 &&
+			Math.abs(Date.now() - this.clockTimestamp) < this.query_timestamp_range;
+	}
+
+	_receiveLiveTracklets(message) {
+
+		const pushed = JSON.parse(message.data);
+
+		if (pushed.error !== undefined) { // the subscription ended. Subscribe again from the last token
+			setTimeout(this._subscribeLiveTracklets, 1000);
+			return;
+		}
+
+		this.liveResumeToken = pushed.token;
+
+		if (pushed.resync) { // objects were missed. Query the time window again
+			this.last_query_timestamp = 0;
+		}
+
+		if (pushed.objects.length > 0) {
+			// Add the new objects, replacing any older version of them, and drop the ones that have left the clock's range
+			const oldestTimestamp = this.clockTimestamp - this.query_timestamp_range;
+			const trackableObjects = new Map();
+			for (const trackableObject of this.state.trackableObjectsArray.concat(pushed.objects)) {
+				const tracklets = trackableObject.tracklets;
+				if (tracklets.length > 0 && Math.max(tracklets[0][2], tracklets[tracklets.length-1][2]) >= oldestTimestamp) {
+					trackableObjects.set(trackableObject.object_id, trackableObject);
+				}
+			}
+
+			this.setState({
+				trackableObjectsArray: formatTracklets(Array.from(trackableObjects.values()), this.loopTime, this.loopLength)
+			});
+		}
+	}
+
+
 	_onCalibrationToggleClick() {
 
 		if (this.state.calibrationMode) { // if we are CURRENTLY in calibration mode
@@ -515,7 +582,7 @@ export default class App extends Component {
 				this.waitingToReceiveTrackableObjects = false;
 			}
 			
-			if (!DEMO_MODE && !this.waitingToReceiveTrackableObjects) { // if we're NOT in DEMO_MODE and NOT currently waiting on a request for more trackableObjects
+			if (!DEMO_MODE && !this.waitingToReceiveTrackableObjects && !this._isLive()) { // if we're NOT in DEMO_MODE, NOT currently waiting on a request for more trackableObjects and NOT getting them pushed by the live tail
 
 
 				if (this.clockTimestamp < this.last_query_timestamp+15000 || this.clockTimestamp > this.last_query_timestamp+this.query_timestamp_range-15000)  { // we'll still get back the range of tracklets. This just makes sure we don't experience a gap while we're waiting
@@ -528,7 +595,7 @@ export default class App extends Component {
 					}
 
 					if (this.ws_get_tracklets.readyState == 1) {
-						this.ws_get_tracklets.send(JSON.stringify({"timestamp": this.new_query_timestamp, "range": this.query_timestamp_range})); // ask server for more trackableObjects
+						this.ws_get_tracklets.send(JSON.stringify({"timestamp": this.new_query_timestamp, "range": this.query_timestamp_range, "lod": this.query_lod})); // ask server for more trackableObjects
 
 						this.last_ws_get_tracklets = rAFTimestamp; // set the time we last called ws_get_tracklets
 						
@@ -2,6 +2,7 @@
 'use strict';
 
 const net = require('net');
+const wireProtocol = require('./wire_protocol');
 const express = require('express')
 
 // const app = express()
@@ -35,32 +36,29 @@ app.ws('/send_calibration', (ws, req) => {
 		// Create new socket and connect to node
 		var client = new net.Socket();
 		client.setTimeout(4000);
-		client = client.setEncoding('utf8');
 		client.connect(8765, '127.0.0.1', function() {
 			// console.log('Connected to node calibration socket server');
 
-			// Send calibration to node's websocket/socket server
-			var if_sent = client.write(calibration);
+			// Send calibration to node's websocket/socket server as one length-prefixed JSON message
+			var if_sent = client.write(wireProtocol.encodeJSON(calibration));
 			if (if_sent) {
 				// console.log("Calibration sent");
 			}
 		});
 
 		
-		let chunks = []; // https://stackoverflow.com/a/45030133/8941739			
-		client.on('data', function(data) {
-			chunks.push(data); // https://stackoverflow.com/a/45030133/8941739
-		}).on('end', function() {
-			if (chunks.length > 0) {
+		// The answer is one JSON message with the frame dimensions (frame_dim)
+		let frameReader = new wireProtocol.FrameReader(function(messageType, payload) {
+			if (messageType == wireProtocol.MESSAGE_JSON) {
 				// console.log("Received frame dimensions (frame_dim) ...");
-				let this_data = chunks.join("");
-				var parsed_data = JSON.parse(this_data.replace(/\'/g, '"'));
-				// console.log(parsed_data);
 				// Send frame_dim to browser
-				ws.send(JSON.stringify(parsed_data));
+				ws.send(payload.toString('utf8'));
 			}
 			client.destroy(); // kill client after server's response
 		});
+		client.on('data', function(data) {
+			frameReader.push(data);
+		});
 
 		client.on('error', function(ex) {
 			// console.log("Something happened trying to send calibration to node ");
@@ -81,73 +79,115 @@ app.ws('/send_calibration', (ws, req) => {
 
 
 
+// One long-lived connection to the node's tracklets socket that every browser shares. Each query gets a request ID and ...
+// ... the answers are matched back by it, so scrubbing the timeline doesn't open a new TCP connection per query
+const trackletsClient = new wireProtocol.MultiplexedClient(8766, '127.0.0.1', 4000);
+
 // When browser requests tracklets, get them from node and return them
 // Browser requests tracklets from server. Server gets them from Node. Server sends tracklets to browser
 app.ws('/get_tracklets', (ws, req) => {
 
 	// console.log("called get_tracklets");
 
+	let pendingRequestId = null; // The browser's query still waiting for its tracklets
+
 	ws.on('message', function incoming(message) {
 		
 		// console.log('Server received get_tracklets from map');
 
-		var client = new net.Socket();
-		client.setTimeout(4000);
-		client = client.setEncoding('utf8');
-		client.connect(8766, '127.0.0.1', function() {
-			// console.log('Connected to tracklets');
-			// console.log("message");
-			//console.log(message);
-			client.write(message);
-		});
+		// A newer query supersedes the one still in progress. Tell node to stop working on it
+		if (pendingRequestId !== null) {
+			trackletsClient.cancel(pendingRequestId);
+		}
 
-		let chunks = []; // https://stackoverflow.com/a/45030133/8941739			
-		client.on('data', function(data) {
-			chunks.push(data); // https://stackoverflow.com/a/45030133/8941739
-		}).on('end', function() {
-
-			//console.log(chunks);
-			if (chunks.length > 0) {
-				let this_data = chunks.join("");
-				var trackableObjectsArray = JSON.parse(this_data.replace(/'/g, '"'));
-
-				if (typeof trackableObjectsArray !== 'undefined') {
-					try {
-
-						// console.log("-------------------------------------------------------");
-						// console.log(JSON.stringify(trackableObjectsArray));
-						// Send tracklets to browser
-						ws.send(JSON.stringify(trackableObjectsArray));
-
-					} catch(e) {
-						console.log("error", e);
-					}
-				} else {
-					// Send empty array to browser 
-					ws.send(JSON.stringify([]));
-				}
-			} else {
+		// The tracklets are streamed back in chunks (JSON or packed binary) and put back together by trackletsClient
+		let requestId = trackletsClient.request(message, function(trackableObjectsArray) {
+			if (pendingRequestId === requestId) {
+				pendingRequestId = null;
+			}
+			try {
+
+				// console.log("-------------------------------------------------------");
+				// console.log(JSON.stringify(trackableObjectsArray));
+				// Send tracklets to browser
+				ws.send(JSON.stringify(trackableObjectsArray));
+
+			} catch(e) {
+				console.log("error", e);
+			}
+		}, function(error) {
+			if (pendingRequestId === requestId) {
+				pendingRequestId = null;
+			}
+			console.log("Something happened trying to get trackelets from node ", error);
+			try {
 				// Send empty array to browser
 				ws.send(JSON.stringify([]));
+			} catch(e) {
+				console.log("error", e);
 			}
-			
-			client.destroy(); // kill client after server's response
 		});
+		pendingRequestId = requestId;
+		
+	});
 
-		client.on('error', function(ex) {
-			console.log("Something happened trying to get trackelets from node ");
-			client.destroy(); // kill client after error
-			console.log(ex);
-		});
+	ws.on('close', function() {
+		if (pendingRequestId !== null) {
+			trackletsClient.cancel(pendingRequestId);
+		}
+	});
+});
 
-		client.on('timeout', function() {
-			console.log('tracklet socket timeout');
-			client.destroy(); // have to .destroy() on timeout. If just .end(), it won't reconnect if user doesn't refresh browser
+
+
+// Live tail. The browser subscribes (optionally with the resume token of the last message it got) and every trackable object ...
+// ... node commits from then on is pushed to it as {"token", "objects"}. If the subscription ends, the browser is sent ...
+// ... {"error"} and can subscribe again with its last token
+app.ws('/subscribe_tracklets', (ws, req) => {
+
+	let subscriptionId = null;
+
+	ws.on('message', function incoming(message) {
+
+		// A new subscribe message replaces the subscription
+		if (subscriptionId !== null) {
+			trackletsClient.cancel(subscriptionId);
+		}
+
+		let subscription = {};
+		try {
+			subscription = JSON.parse(message);
+		} catch(e) {
+			console.log("error", e);
+		}
+		subscription.command = 'subscribe';
+
+		let thisSubscriptionId = trackletsClient.subscribe(subscription, function(pushed) {
+			try {
+				ws.send(JSON.stringify(pushed));
+			} catch(e) {
+				console.log("error", e);
+			}
+		}, function(error) {
+			if (subscriptionId === thisSubscriptionId) {
+				subscriptionId = null;
+			}
+			console.log("tracklets subscription ended", error);
+			try {
+				ws.send(JSON.stringify({"error": String(error)}));
+			} catch(e) {
+				console.log("error", e);
+			}
 		});
-		
+		subscriptionId = thisSubscriptionId;
 	});
-});
 
+	ws.on('close', function() {
+		if (subscriptionId !== null) {
+			trackletsClient.cancel(subscriptionId);
+		}
+	});
+});
 
 	
 app.listen(port, () => console.log(`Example app listening on port ${port}!`))
@@ -0,0 +1,222 @@
+'use strict';
+
+const net = require('net');
+
+// Framing for the node's tracklets (8766) and calibration (8765) sockets. Same as wire_protocol.py:
+// payload length (4 bytes, big-endian) + message type (1 byte) + request ID (4 bytes, big-endian) + payload
+
+const MESSAGE_JSON = 1; // A whole JSON message
+const MESSAGE_JSON_CHUNK = 2; // A JSON array, part of a streamed list
+const MESSAGE_BINARY_CHUNK = 3; // Packed trackable objects, part of a streamed list
+const MESSAGE_END = 4; // End of a streamed list. No payload
+const MESSAGE_ERROR = 5; // JSON {"error": "..."} instead of the response
+const MESSAGE_CANCEL = 6; // Stop answering the request with this ID. No payload
+const MESSAGE_PUSH = 7; // A JSON message of a subscription
+
+const HEADER_BYTES = 9;
+const MAX_REQUEST_ID = 0xffffffff;
+
+
+function encodeFrame(messageType, payload, requestId) {
+	payload = payload || Buffer.alloc(0);
+	const header = Buffer.alloc(HEADER_BYTES);
+	header.writeUInt32BE(payload.length, 0);
+	header.writeUInt8(messageType, 4);
+	header.writeUInt32BE(requestId || 0, 5);
+	return Buffer.concat([header, payload]);
+}
+
+function encodeJSON(message, requestId) {
+	// 'message' can already be a JSON string (as received from the browser)
+	return encodeFrame(MESSAGE_JSON, Buffer.from(typeof message === 'string' ? message : JSON.stringify(message), 'utf8'), requestId);
+}
+
+
+// Collects the socket's data and calls onFrame(messageType, payload, requestId) for each complete frame, however TCP split them up
+class FrameReader {
+	constructor(onFrame) {
+		this.onFrame = onFrame;
+		this.buffer = Buffer.alloc(0);
+	}
+
+	push(data) {
+		this.buffer = this.buffer.length > 0 ? Buffer.concat([this.buffer, data]) : data;
+		while (this.buffer.length >= HEADER_BYTES) {
+			const length = this.buffer.readUInt32BE(0);
+			if (this.buffer.length < HEADER_BYTES + length) {
+				break; // wait for the rest of the frame
+			}
+			const messageType = this.buffer.readUInt8(4);
+			const requestId = this.buffer.readUInt32BE(5);
+			const payload = this.buffer.slice(HEADER_BYTES, HEADER_BYTES + length);
+			this.buffer = this.buffer.slice(HEADER_BYTES + length);
+			this.onFrame(messageType, payload, requestId);
+		}
+	}
+}
+
+
+// One long-lived connection that many requests share, each with its own request ID. Streamed list responses are put back
+// together per request. It connects when the first request is made and again after it's been closed
+class MultiplexedClient {
+	constructor(port, host, timeout) {
+		this.port = port;
+		this.host = host;
+		this.timeout = timeout || 4000; // milliseconds a request can take before it's cancelled
+		this.socket = null;
+		this.nextRequestId = 1;
+		this.requests = new Map(); // request ID -> {items, onList, onPush, onError, timer}
+	}
+
+	connect() {
+		this.socket = new net.Socket();
+		this.socket.setNoDelay(true);
+
+		let frameReader = new FrameReader((messageType, payload, requestId) => this.receive(messageType, payload, requestId));
+		this.socket.on('data', (data) => {
+			try {
+				frameReader.push(data);
+			} catch(e) {
+				console.log("error", e);
+				this.socket.destroy();
+			}
+		});
+
+		let socket = this.socket;
+		let closed = (error) => {
+			if (this.socket === socket) {
+				this.socket = null;
+				// Every request still waiting for its answer fails. The next request reconnects
+				for (let requestId of Array.from(this.requests.keys())) {
+					this.finish(requestId).onError(error || "connection closed");
+				}
+			}
+		};
+		this.socket.on('error', (ex) => {
+			console.log("Something happened on the connection to node port " + this.port, ex.message);
+			closed(ex.message);
+		});
+		this.socket.on('close', () => closed());
+
+		this.socket.connect(this.port, this.host);
+	}
+
+	// Send a request. onList(items) gets the whole list, onError(error) is called instead if it fails or times out
+	// Returns the request ID, for cancel()
+	request(message, onList, onError) {
+		const requestId = this.send(message, {items: [], onList: onList, onPush: null, onError: onError, timer: null});
+		this.requests.get(requestId).timer = setTimeout(() => {
+			console.log('request ' + requestId + ' to node port ' + this.port + ' timed out');
+			this.cancel(requestId, "timeout");
+		}, this.timeout);
+		return requestId;
+	}
+
+	// Send a subscription request. onPush(message) gets each message pushed until it's cancelled. onError(error) is called ...
+	// ... if it ends any other way (the connection closed or the subscriber fell behind). Returns the request ID, for cancel()
+	subscribe(message, onPush, onError) {
+		return this.send(message, {items: [], onList: null, onPush: onPush, onError: onError, timer: null});
+	}
+
+	send(message, request) {
+		if (this.socket === null) {
+			this.connect();
+		}
+
+		const requestId = this.nextRequestId;
+		this.nextRequestId = this.nextRequestId == MAX_REQUEST_ID ? 1 : this.nextRequestId + 1;
+
+		this.requests.set(requestId, request);
+		this.socket.write(encodeJSON(message, requestId));
+		return requestId;
+	}
+
+	// Tell the node to stop answering a request that isn't wanted any more (superseded by a newer one). Its callbacks won't be called ...
+	// ... unless 'error' is given, in which case onError(error) is
+	cancel(requestId, error) {
+		if (!this.requests.has(requestId)) {
+			return;
+		}
+		const request = this.finish(requestId);
+		if (this.socket !== null) {
+			this.socket.write(encodeFrame(MESSAGE_CANCEL, null, requestId));
+		}
+		if (error) {
+			request.onError(error);
+		}
+	}
+
+	finish(requestId) {
+		const request = this.requests.get(requestId);
+		clearTimeout(request.timer);
+		this.requests.delete(requestId);
+		return request;
+	}
+
+	receive(messageType, payload, requestId) {
+		const request = this.requests.get(requestId);
+		if (typeof request === 'undefined') {
+			return; // The rest of a cancelled request's answer
+		}
+
+		if (messageType == MESSAGE_PUSH) {
+			request.onPush(JSON.parse(payload.toString('utf8')));
+		} else if (messageType == MESSAGE_JSON_CHUNK) {
+			request.items.push(...JSON.parse(payload.toString('utf8')));
+		} else if (messageType == MESSAGE_BINARY_CHUNK) {
+			request.items.push(...unpackTrackableObjects(payload));
+		} else if (messageType == MESSAGE_END) {
+			this.finish(requestId).onList(request.items);
+		} else if (messageType == MESSAGE_ERROR) {
+			this.finish(requestId).onError(JSON.parse(payload.toString('utf8')).error);
+		}
+	}
+}
+
+
+// Packed trackable objects (little-endian): number of objects (uint32), then for each object objectID (16 bytes) + ...
+// ... detection_class_id (int16) + number of tracklets n (uint32) + n lngs (float32) + n lats (float32) + n frame_timestamps (int64)
+function unpackTrackableObjects(payload) {
+	const trackableObjects = [];
+	const count = payload.readUInt32LE(0);
+	let position = 4;
+	for (let o = 0; o < count; o++) {
+		const objectId = payload.toString('hex', position, position + 16);
+		const detectionClassId = payload.readInt16LE(position + 16);
+		const n = payload.readUInt32LE(position + 18);
+		position += 22;
+
+		const tracklets = [];
+		for (let t = 0; t < n; t++) {
+			tracklets.push([
+				payload.readFloatLE(position + 4*t),
+				payload.readFloatLE(position + 4*n + 4*t),
+				Number(payload.readBigInt64LE(position + 8*n + 8*t))
+			]);
+		}
+		position += 16*n;
+
+		trackableObjects.push({
+			"object_id": objectId,
+			"detection_class_id": detectionClassId,
+			"tracklets": tracklets
+		});
+	}
+	return trackableObjects;
+}
+
+
+module.exports = {
+	MESSAGE_JSON,
+	MESSAGE_JSON_CHUNK,
+	MESSAGE_BINARY_CHUNK,
+	MESSAGE_END,
+	MESSAGE_ERROR,
+	MESSAGE_CANCEL,
+	MESSAGE_PUSH,
+	encodeFrame,
+	encodeJSON,
+	FrameReader,
+	MultiplexedClient,
+	unpackTrackableObjects
+};
@@ -21,13 +21,26 @@ from multiprocessing import Queue, Pool
 import gevent
 from gevent.server import StreamServer
 import time
+import hashlib
+import s2cells
+import wire_protocol
 from pathlib import Path
 
 class MyException(Exception):
     pass
 
+
+RW_TRANSFORMS = ['homography', 'affine']
+
+METRES_PER_DEGREE = 111319.49 # Along a meridian (and along the equator). Good enough for reporting errors
+
+def cell_ids_from_lnglat(lnglat):
+    # S2 cell ID (highest level) of each [lng, lat] row, the same cell tracklets_loop stores each tracklet under
+    return s2cells.cell_ids_from_lat_lng(lnglat[:, 1], lnglat[:, 0])
+
+
 class RealWorldCoordinates:
-    def __init__(self, tracking_frame):
+    def __init__(self, tracking_frame, lookup_table_dir=None, transform='homography'):
         
         # Create node's personal leveldb database if missing
         self.node_db = plyvel.DB(str(Path.home())+'/.grassland/node_db/', create_if_missing=True)
@@ -35,12 +48,18 @@ class RealWorldCoordinates:
         self.tracking_frame = tracking_frame
         self.calibration = {}
 
-        # pts_src and pts_dst are numpy arrays of points
-        # in source and destination images. We need at least 
-        # 4 corresponding points. 
-        pts_src = np.array([[421, 695], [1587, 198], [368, 309], [1091, 98]])
-        pts_dst =  np.array([[581, 473], [618, 215], [296, 449], [281, 245]])
-        h, status = cv2.findHomography(pts_src, pts_dst)
+        # Per-pixel lng/lat and S2 cell ID lookup tables for the tracking frame. Memory-mapped from 'lookup_table_dir' if it's set
+        self.lookup_table_dir = lookup_table_dir
+        self.lookup_table_key = None
+        self.lnglat_table = None
+        self.cell_id_table = None
+
+        # 'homography' fits a 3x3 perspective transform (https://docs.opencv.org/master/d9/d0c/group__calib3d.html#ga4abc2ece9fab9398f2e560d53c8c9780)
+        # 'affine' is the original least squares affine map, which can't represent the camera's perspective
+        if transform not in RW_TRANSFORMS:
+            raise MyException("Unknown real world transform '"+str(transform)+"'. Choose from "+str(RW_TRANSFORMS))
+        self.transform = transform
+        self.reprojection_errors = None
 
 
 
@@ -107,6 +126,13 @@ class RealWorldCoordinates:
             }
         }
 
+        'markers' are optional extra correspondences, e.g. landmarks, in the format
+            'markers': {
+                'lamp_post': {'x': 212, 'y': 97, 'lng': -75.75101, 'lat': 45.39342},
+                ...
+            }
+        where 'x' and 'y' are tracking frame pixel coordinates. With markers the homography is a least squares fit over all the points
+
 
         '''
         # MySQL
@@ -132,22 +158,44 @@ class RealWorldCoordinates:
             secondary_array.append([ul_lng, ul_lat])
 
 
-        secondary = np.array(secondary_array)
-            
+        primary_array = primary.tolist()
+        markers = self.calibration['homography_points'].get('markers') or {}
+        for marker in markers.values():
+            primary_array.append([float(marker['x']), float(marker['y'])])
+            secondary_array.append([marker['lng'], marker['lat']])
+
+        primary = np.array(primary_array, dtype=float)
+        secondary = np.array(secondary_array, dtype=float)
+
+        # Fit relative to the mean lng/lat. The points are only thousandths of a degree apart so this keeps the fit well conditioned
+        self.rw_origin = secondary.mean(axis=0)
+
+        if self.transform == 'homography':
+            # Least squares over all the points (exact with just the 4 corners)
+            H, status = cv2.findHomography(primary, secondary - self.rw_origin, 0)
+            if H is None:
+                raise MyException("!!! cv2.findHomography couldn't fit the calibration points !!!")
+            self.rw_homography = H
+            A = H
+        else:
+            # Pad the data with ones, so that our transformation can do translations too
+            pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
+            X = pad(primary)
+            Y = pad(secondary - self.rw_origin)
 
-        # Pad the data with ones, so that our transformation can do translations too
-        n = primary.shape[0]
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        unpad = lambda x: x[:,:-1]
-        X = pad(primary)
-        Y = pad(secondary)
+            # Solve the least squares problem X * A = Y
+            # to find our transformation matrix A
+            A, res, rank, s = np.linalg.lstsq(X, Y, rcond=None)
 
-        # Solve the least squares problem X * A = Y
-        # to find our transformation matrix A
-        A, res, rank, s = np.linalg.lstsq(X, Y)
+            # Split A into its linear part and its translation so coords() can transform many points with one matrix multiply and no padding
+            self.rw_matrix = A[:2, :2].copy()
+            self.rw_offset = A[2, :2].copy()
 
         # Real World Transform
-        self.rw_transform = lambda x: unpad(np.dot(pad(x), A))
+        self.rw_transform = self.coords
+
+        # How far (in metres) the fitted transform puts each calibration point from where it should be
+        self.reprojection_errors = self.distances_in_metres(self.coords(primary), secondary)
 
         np.set_printoptions(suppress=True)
 
@@ -156,13 +204,16 @@ class RealWorldCoordinates:
         print(secondary)
         print("Result:")
         print(self.rw_transform(primary))
-        print("Max error:", np.abs(secondary - self.rw_transform(primary)).max())
-        A[np.abs(A) < 1e-10] = 0  # set really small values to zero
+        print("Reprojection error ("+self.transform+", "+str(primary.shape[0])+" points): max "+str(round(float(self.reprojection_errors.max()), 3))+" m, RMS "+str(round(float(np.sqrt(np.mean(self.reprojection_errors**2))), 3))+" m")
         print(A)
         print("Now Try it")
         print(self.rw_transform(np.array([[300, 200]])))
         print(self.rw_transform(np.array([[300.0, 200.0]])))
 
+        # While calibrating, the transform is rebuilt every few seconds so it isn't worth building the lookup tables. coords() is used instead
+        if not self.CALIBRATING:
+            self.set_lookup_tables()
+
 
         
     def node_update(self):
@@ -238,7 +289,7 @@ class RealWorldCoordinates:
         
     def coord(self, x, y):
 
-        coord = self.rw_transform(np.array([[x, y]]))
+        coord = self.coords(np.array([[x, y]], dtype=float))
 
         return {
             "lng": coord[0][0],
@@ -246,28 +297,139 @@ class RealWorldCoordinates:
         }
 
 
+    def coords(self, points):
+        # Transform an (N, 2) array of pixel coordinates to an (N, 2) array of [lng, lat] in one go
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if points.shape[0] == 0:
+            return np.zeros((0, 2), dtype=float)
+
+        if self.transform == 'homography':
+            return cv2.perspectiveTransform(points.reshape(-1, 1, 2), self.rw_homography).reshape(-1, 2) + self.rw_origin
+        else:
+            return points @ self.rw_matrix + (self.rw_offset + self.rw_origin)
+
+
+
+    @staticmethod
+    def distances_in_metres(lnglat_a, lnglat_b):
+        # Approximate (equirectangular) ground distance between each pair of rows of two (N, 2) [lng, lat] arrays
+        lat_scale = np.cos(np.radians((lnglat_a[:, 1] + lnglat_b[:, 1]) / 2))
+        dx = (lnglat_a[:, 0] - lnglat_b[:, 0]) * lat_scale
+        dy = lnglat_a[:, 1] - lnglat_b[:, 1]
+        return np.hypot(dx, dy) * METRES_PER_DEGREE
+
+
+
+    def set_lookup_tables(self):
+        # Every pixel of the tracking frame (including the right and bottom edges, which bounding boxes can end on) gets its
+        # [lng, lat] and S2 cell ID computed once. The tables only depend on the calibration and the frame dimensions ...
+        # ... so they're only rebuilt when one of those changes
+        width = int(np.ceil(float(self.tracking_frame['width']))) + 1
+        height = int(np.ceil(float(self.tracking_frame['height']))) + 1
+
+        calibration_string = json.dumps(self.calibration, sort_keys=True)
+        lookup_table_key = hashlib.sha1(bytes(calibration_string+'|'+self.transform+'|'+str(width)+'x'+str(height), 'utf-8')).hexdigest()
+
+        if lookup_table_key == self.lookup_table_key:
+            return
+
+        lnglat_table = None
+        cell_id_table = None
+
+        if self.lookup_table_dir is not None:
+            os.makedirs(self.lookup_table_dir, exist_ok=True)
+            lnglat_path = os.path.join(self.lookup_table_dir, lookup_table_key+'_lnglat.npy')
+            cell_id_path = os.path.join(self.lookup_table_dir, lookup_table_key+'_cell_id.npy')
+
+            try:
+                lnglat_table = np.load(lnglat_path, mmap_mode='r')
+                cell_id_table = np.load(cell_id_path, mmap_mode='r')
+                if lnglat_table.shape != (height, width, 2) or cell_id_table.shape != (height, width):
+                    lnglat_table = cell_id_table = None
+            except (OSError, ValueError): # Not built yet for this calibration (or a partly written file)
+                lnglat_table = cell_id_table = None
+
+        if lnglat_table is None:
+            print("Building real world lookup tables for "+str(width)+"x"+str(height)+" pixels ...")
+            ys, xs = np.mgrid[0:height, 0:width]
+            lnglat = self.coords(np.stack([xs.ravel(), ys.ravel()], axis=1))
+            cell_ids = cell_ids_from_lnglat(lnglat)
+
+            if self.lookup_table_dir is None:
+                lnglat_table = lnglat.reshape(height, width, 2)
+                cell_id_table = cell_ids.reshape(height, width)
+            else:
+                # Remove the tables of previous calibrations
+                for file_name in os.listdir(self.lookup_table_dir):
+                    if file_name.endswith('.npy') and not file_name.startswith(lookup_table_key):
+                        os.remove(os.path.join(self.lookup_table_dir, file_name))
+
+                # Write the cell IDs last. If building is interrupted, the next load fails on the missing file and rebuilds
+                np.save(lnglat_path, lnglat.reshape(height, width, 2))
+                np.save(cell_id_path, cell_ids.reshape(height, width))
+                lnglat_table = np.load(lnglat_path, mmap_mode='r')
+                cell_id_table = np.load(cell_id_path, mmap_mode='r')
+
+        self.lnglat_table = lnglat_table
+        self.cell_id_table = cell_id_table
+        self.lookup_table_key = lookup_table_key
+
+
+
+    def lookup(self, points):
+        # [lng, lat] and S2 cell ID of each (N, 2) pixel coordinate. Points on the frame are a lookup table index. Any others ...
+        # ... (or every point, if the tables haven't been built) are transformed
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        pixels = np.rint(points).astype(np.int64)
+
+        if self.lookup_table_key is None:
+            on_frame = np.zeros(points.shape[0], dtype=bool)
+        else:
+            height, width = self.cell_id_table.shape
+            on_frame = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+
+        lnglat = np.empty((points.shape[0], 2), dtype=float)
+        cell_ids = np.empty(points.shape[0], dtype=np.uint64)
+
+        if on_frame.any():
+            xs, ys = pixels[on_frame, 0], pixels[on_frame, 1]
+            lnglat[on_frame] = self.lnglat_table[ys, xs]
+            cell_ids[on_frame] = self.cell_id_table[ys, xs]
+
+        if not on_frame.all():
+            off_frame = ~on_frame
+            lnglat[off_frame] = self.coords(points[off_frame])
+            cell_ids[off_frame] = cell_ids_from_lnglat(lnglat[off_frame])
+
+        return lnglat, cell_ids
+
+
         
     def calibration_socket_server_handler(self, socket, address):
 
-        calibration_bytes_object = socket.recv(4096)
-        # print("calibration_bytes_object")
-        # print(calibration_bytes_object)
+        # A length-prefixed frame (see wire_protocol) or, from older clients, one unframed JSON write
+        try:
+            calibration, framed = wire_protocol.read_request(socket)
+        except (wire_protocol.ProtocolError, ValueError) as e:
+            print("Bad calibration from %s:%s" % address, e)
+            return
+        
+        if calibration is None:
+            return
 
 
         # Store calibration in leveldb
-        #self.node_db.put(b'calibration', bytes(calibration_string, 'utf-8'))
-        self.node_db.put(b'calibration', calibration_bytes_object)
+        self.node_db.put(b'calibration', bytes(json.dumps(calibration), 'utf-8'))
 
-        # Get it back
-        calibration = self.node_db.get(b'calibration')
-
-        self.calibration = json.loads(calibration.decode("utf-8"))
+        self.calibration = calibration
 
 
         # Get camera frame dimensions (frame_dim). Could pull from database but this is easier
-        tracking_frame_string = json.dumps(self.tracking_frame)
         # Send camera frame dimensions (frame_dim)
-        socket.sendall(bytes(tracking_frame_string, 'utf-8'))
+        if framed:
+            wire_protocol.send_json(socket, self.tracking_frame)
+        else:
+            socket.sendall(bytes(json.dumps(self.tracking_frame), 'utf-8'))
         
 
     def call_gevent_wait(self):
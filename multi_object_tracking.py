@@ -24,27 +24,31 @@ import os
 import numpy as np
 import multiprocessing
 from multiprocessing import Queue, Pool
-from queue import PriorityQueue
 from queue import Empty
-import requests
-import boto3
-from PIL import Image
-import json
 import sys
 from threading import Thread
 import detection_visualization_util
 from random import randint
 import concurrent.futures
-from pyimagesearch.centroidtracker import CentroidTracker
+from pyimagesearch.arraycentroidtracker import ArrayCentroidTracker
 from pyimagesearch.trackableobject import TrackableObject
+import tracklets_store
+import tracklets_feed
+import trajectory_lod
+import window_cache
+import wire_protocol
+import s2cells
+import detector_backends
+from frame_ring_buffer import FrameRingBuffer
+from frame_reorder_buffer import FrameReorderBuffer
 
 import plyvel
-import s2sphere
 
 
 import gevent
 from gevent.server import StreamServer
 from gevent.queue import Queue as GeventQueue
+from gevent.threadpool import ThreadPool
 
 from multiprocessing import Value
 
@@ -57,8 +61,6 @@ except FileExistsError:
     # directory already exists
     pass
 
-frame_s3_bucket_name = os.environ['GRASSLAND_FRAME_S3_BUCKET']
-
 # construct the argument parser and parse the arguments
 ap = argparse.ArgumentParser()
 ap.add_argument("--mode", type=str, default='ONLINE',
@@ -72,10 +74,50 @@ ap.add_argument("--rotation", type=int, default=0,
 ap.add_argument("--video", type=str,
                 help="For debugging purposes, a video file can be used as input. This specifies path to video file.")
 ap.add_argument("--num_workers", type=int, default=5,
-                help="For computers with multi-core CPU's, spreads tasks into separate processes to parralelize processes and speed up software [default: 5]")
+                help="Number of object detection requests kept in flight at the same time. Detection throughput grows with it until the detector or the network is saturated [default: 5]")
 ap.add_argument("--tracker", type=str, default="mosse",
                 help="OpenCV object tracker type, [default: mosse]")
+ap.add_argument("--reorder_max_wait", type=float, default=5.0,
+                help="Seconds the tracker waits for a missing (usually still being detected) frame before skipping it and moving on to the frames after it [default: 5.0]")
+ap.add_argument("--tracking_ring_slots", type=int, default=64,
+                help="Frames waiting for the tracker that are kept in shared memory. Each slot holds one tracking size (500 pixels wide) frame, about 0.4 MB for a 16:9 camera, so the default uses about 27 MB. New frames are dropped while every slot is in use [default: 64]")
+ap.add_argument("--association", type=str, default="optimal", choices=["greedy", "optimal"],
+                help="How the tracker matches tracked objects to new detections/motion contours. 'greedy' takes each object's nearest centroid. 'optimal' only compares pairs within the maximum distance (spatial grid) and finds the assignment with the smallest total distance, which gives fewer ID switches when objects cross [default: optimal]")
+ap.add_argument("--match_iou", type=int, default=0,
+                help="With '--association optimal', match on bounding box overlap (IoU) instead of centroid distance [default: 0]")
+ap.add_argument("--motion_model", type=int, default=0,
+                help="Predict where each tracked object has moved to (constant velocity Kalman filter) and match detections/motion contours against the predictions, so objects keep their ID through missed frames and across longer '--detection_interval's [default: 0]")
+ap.add_argument("--detection_interval", type=float, default=3.0,
+                help="Seconds between frames sent for object detection. Every frame in between is only used for motion tracking [default: 3.0]")
+ap.add_argument("--lookup_table_cache", type=int, default=1,
+                help="Memory-map the per-pixel real world (lng/lat and S2 cell) lookup tables of the tracking frame from ~/.grassland/lookup_tables/ so they're only rebuilt when the calibration changes. With 0 they're rebuilt in memory every start [default: 1]")
+ap.add_argument("--rw_transform", type=str, default="homography", choices=["homography", "affine"],
+                help="How pixel coordinates are mapped to real world (lng/lat) coordinates from the calibration. 'homography' is a perspective transform fitted to the calibration corners and markers, 'affine' is the original affine fit, which can't represent the camera's perspective [default: homography]")
+ap.add_argument("--commit_max_objects", type=int, default=100,
+                help="Most completed objects the tracklets writer puts in one database write batch (group commit) [default: 100]")
+ap.add_argument("--commit_interval_ms", type=int, default=250,
+                help="Longest a completed object waits for its group commit before the writer commits whatever it has, in milliseconds [default: 250]")
+ap.add_argument("--storage_layout", type=str, default="objects", choices=tracklets_store.STORAGE_LAYOUTS,
+                help="How completed objects are stored. 'tracklets' writes one database entry per tracklet point, 'objects' one compressed record per object (much smaller, and queries get whole trajectories without regrouping), 'both' writes both. Queries with 'objects' still find objects stored per tracklet [default: objects]")
+ap.add_argument("--eon_minutes", type=int, default=60,
+                help="Length of the time partitions (eons) of the tracklets database in minutes. Fixed once the database has partitions [default: 60]")
+ap.add_argument("--retention_days", type=float, default=0,
+                help="Delete tracklets older than this many days, a whole eon at a time. 0 keeps everything [default: 0]")
+ap.add_argument("--feed_ring_size", type=int, default=10000,
+                help="Most recently committed objects kept in memory for live subscribers that reconnect with a resume token. Subscribers further behind are told to re-query the time window they missed [default: 10000]")
+ap.add_argument("--query_threads", type=int, default=2,
+                help="Most tracklets database queries run at once, each in its own thread on a snapshot of the database so queries and the tracklets writer don't hold each other up. Queries past the limit wait their turn [default: 2]")
+ap.add_argument("--query_cache_buckets", type=int, default=60,
+                help="Most one minute buckets of decoded query results the tracklets socket server keeps in memory (least recently used are dropped first), so the map's moving query windows are answered without reading the database again. 0 turns the cache off [default: 60]")
+ap.add_argument("--detector", type=str, default="s3", choices=detector_backends.DETECTOR_BACKENDS,
+                help="Object detection backend. 's3' uploads frames to the GRASSLAND_FRAME_S3_BUCKET S3 bucket for the Lambda function, 'http' POSTs frames straight to --detection_url, 'local' starts a local stand-in detection server that returns no detections [default: s3]")
+ap.add_argument("--detection_url", type=str, default=os.environ.get('LAMBDA_DETECTION_URL'),
+                help="URL of the object detection endpoint used by the 's3' and 'http' detectors [default: LAMBDA_DETECTION_URL environment variable]")
 args = vars(ap.parse_args())
+if args['detector'] in ('s3', 'http') and not args['detection_url']:
+    ap.error("--detector "+args['detector']+" needs the URL of the detection endpoint. Set --detection_url or the LAMBDA_DETECTION_URL environment variable")
+if args['tracking_ring_slots'] < 1:
+    ap.error("--tracking_ring_slots must be at least 1")
 
 # initialize a dictionary that maps strings to their corresponding
 # OpenCV object tracker implementations
@@ -106,39 +148,26 @@ min_area = int(tracking_frame_width/25)
 run_tracklets_socket_server = Value('i', 1)
 
 
-s3_res = boto3.resource('s3')
-s3_bucket = s3_res.Bucket(frame_s3_bucket_name)
+if args['detector'] == 's3':
+    frame_s3_bucket_name = os.environ['GRASSLAND_FRAME_S3_BUCKET']
+else:
+    frame_s3_bucket_name = None
 
-lambda_url = os.environ['LAMBDA_DETECTION_URL']
+detector = detector_backends.create_detector_backend(args['detector'], detection_url=args['detection_url'], s3_bucket_name=frame_s3_bucket_name)
 
 tracklets_queue_max = 100
 o_queue_max = 80
-p_queue_max = 300
+p_queue_max = 300 # Most frames the tracking loop's reorder buffer holds while it waits for a late detection
 
 tracklets_queue = Queue() # tracklets queue
-mapserver_tracklets_queue = GeventQueue() # calibration tracklets queue    
-i_queue = Queue() # input queue    
-o_queue = Queue(maxsize=o_queue_max) # output queue
-p_queue = PriorityQueue(maxsize=p_queue_max) # priority queue
-
-
-#### !!! WARNING !!! --> Store s2sphere in bigendian format to order bytes lexicographically in LevelDB
-s2sphere_byteorder = 'big'
 
-def delete_from_s3(s3_bucket, file_name_ext):
-    try:
-        s3_bucket.delete_objects(
-            Delete={
-                'Objects': [
-                    {
-                        'Key': file_name_ext
-                    }
-                ]
-            }
-        )
-    except:
-        import traceback
-        traceback.print_exc()
+# Tracklet writer stats, shared so any process can read them
+tracklets_backlog = Value('i', 0) # Completed objects waiting to be written (in tracklets_queue or waiting for the next group commit)
+tracklets_commit_latency_ms = Value('d', 0.0) # How long the last group commit took
+tracklets_committed_objects = Value('i', 0) # Objects written since start
+mapserver_tracklets_queue = GeventQueue() # calibration tracklets queue    
+i_queue = Queue() # input queue. Carries (frame_number, detection_slot, tracking_slot, frame_timestamp). The frames themselves are in detection_ring and tracking_ring
+o_queue = Queue(maxsize=o_queue_max) # output queue. Carries (frame_number, {"detected", "slot", "frame_timestamp", ...}) where "slot" is the frame's index in tracking_ring
 
 
                 
@@ -146,47 +175,24 @@ def get_detections_error_callback(the_exception):
     print("get_detections_error_callback called")
     print(the_exception)
 
-def get_detections(frame_number, frame, frame_timestamp, no_callback=False):    
+def get_detections(frame_number, detection_slot, tracking_slot, frame_timestamp, no_callback=False):    
     try:
-        image = Image.fromarray(frame) # Remember Opencv images are in 'BGR'
-        file_name_ext = 'frame_'+str(frame_number)+'.jpg'
-        file_path = '/tmp/'+file_name_ext
-
-        image.save(file_path)
-
-        # print("Uploading image file to s3")
         image_start_time = time.time()
-        s3_bucket.upload_file(file_path, file_name_ext)
-        # print("S3 Upload Time:", time.time()-image_start_time)
 
-        # print("Making request on lambda")
-        response = requests.get(lambda_url+"?bucket="+frame_s3_bucket_name+"&key="+file_name_ext)
+        # Read the detection sized frame in place from shared memory
+        frame = detection_ring.get(detection_slot)
+        try:
+            # The detector backend encodes the frame in memory and returns the prediction_result with numpy arrays
+            output_dict = detector.detect(frame_number, frame)
+        finally:
+            # The frame has been encoded so its slot can be reused
+            detection_ring.release(detection_slot)
 
         end_time = time.time()
 
         # print("ROUND TRIP TIME:", end_time-image_start_time)
 
-        response_dict = json.loads(response.text)
-
-        output_dict = response_dict['prediction_result']
-
-        # Convert from Python lists back to Numpy arrays
-        detection_boxes = np.array(output_dict['detection_boxes'])
-        detection_scores = np.array(output_dict['detection_scores'])
-        detection_classes = np.array(output_dict['detection_classes'])
-        output_dict['detection_boxes'] = detection_boxes
-        output_dict['detection_scores'] = detection_scores
-        output_dict['detection_classes'] = detection_classes
-
-
-        detected_frame_tuple = ( frame_number, {"detected": 1, "frame": frame, "frame_timestamp": frame_timestamp, "output_dict": output_dict} )
-        if no_callback:
-            add_to_o_queue(detected_frame_tuple)
-            delete_from_s3(s3_bucket, file_name_ext)
-        else:
-            delete_from_s3(s3_bucket, file_name_ext)
-            return detected_frame_tuple
-
+        detected_frame_tuple = ( frame_number, {"detected": 1, "slot": tracking_slot, "frame_timestamp": frame_timestamp, "output_dict": output_dict} )
 
     except KeyboardInterrupt:
         import traceback
@@ -195,28 +201,30 @@ def get_detections(frame_number, frame, frame_timestamp, no_callback=False):
     except:
         import traceback
         traceback.print_exc()
+
+        # Still give the frame to the tracker, without detections, so its tracking_ring slot gets released
+        detected_frame_tuple = ( frame_number, {"detected": 0, "slot": tracking_slot, "frame_timestamp": frame_timestamp} )
         
         #raise # Without this raise, the regular callback of apply_async will be called
 
+    if no_callback:
+        add_to_o_queue(detected_frame_tuple)
+    else:
+        return detected_frame_tuple
+
         
 def add_to_o_queue(detected_frame_tuple):
     try:
         if o_queue.full():
             print("o_queue FULL")
-            print("-------PROGRAM STOPPED UNTIL o_queue DRAINED INTO p_queue-----")
+            print("-------PROGRAM STOPPED UNTIL o_queue DRAINED INTO THE TRACKING LOOP-----")
             
         #if not o_queue.full():
         #    print("Adding detection to o_queue")
         #    print("o_queue size")
         #    print(o_queue.qsize())
 
-        # Change detected frame back to size for tracking
-        frame_number, frame_dict = detected_frame_tuple
-        frame = frame_dict['frame']
-        frame = imutils.resize(frame, width=tracking_frame_width)
-        frame_dict['frame'] = frame
-        detected_frame_tuple = (frame_number, frame_dict)
-
+        # The tracking sized copy of the frame is already in tracking_ring so only the slot index and metadata are queued
         o_queue.put(detected_frame_tuple)
         #else:
         #    print("o_queue full")
@@ -255,7 +263,8 @@ else: # otherwise, grab a reference to the video file
 '''
 Here we calculate and set the linear map (transformation matrix) that we use to turn the pixel coordinates of the objects on the frame into their corresponding lat/lng coordinates in the real world. It's a computationally expensive calculation and requires inputs from the camera's calibration (frame of reference in the real world) so we do it once here instead of everytime we need to do a transformation from pixels to lat/lng
 '''
-rw = RealWorldCoordinates({"height": tracking_frame_width*frame_ratio, "width": tracking_frame_width})
+lookup_table_dir = str(Path.home())+'/.grassland/lookup_tables/' if args['lookup_table_cache'] == 1 else None
+rw = RealWorldCoordinates({"height": tracking_frame_width*frame_ratio, "width": tracking_frame_width}, lookup_table_dir=lookup_table_dir, transform=args['rw_transform'])
 if args['mode'] == 'CALIBRATING':
     rw.set_transform(calibrating=True)
     print("set calibration")
@@ -270,12 +279,40 @@ if args['mode'] == 'CALIBRATING':
 else:
     tracklets_db = plyvel.DB(str(Path.home())+'/.grassland/gl_tracklets_db/', create_if_missing=True)
 
-# Use current eon number for LevelDB prefix to partition database
+# Use the eon number for LevelDB prefix to partition database by time
 # https://plyvel.readthedocs.io/en/latest/user.html#prefixed-databases
-eon_tracklets_db = tracklets_db.prefixed_db(b'\x00') 
+retention = int(args['retention_days'] * 24 * 60 * 60 * 1000) if args['retention_days'] > 0 else None
+eon_partitions = tracklets_store.EonPartitions(tracklets_db, eon_length=args['eon_minutes'] * 60 * 1000, retention=retention)
+eon_tracklets_db = eon_partitions.legacy_db # Tracklets stored before the database was partitioned
+
+# Pushes each committed object to the live subscribers of the tracklets socket. Only used in the tracklets loop's process
+live_tracklets_feed = tracklets_feed.TrackletsFeed(ring_size=args['feed_ring_size'])
+
+# Threads the tracklets socket server runs queries in. Made when the tracklets loop starts, since it belongs to that process's gevent hub
+query_threadpool = None
+
+# Decoded query results by one minute bucket, invalidated by each commit. Only used in the tracklets loop's process
+query_window_cache = window_cache.WindowCache(
+    lambda bucket_timestamp, bucket_length: run_query(eon_partitions.query_time_window, bucket_timestamp, bucket_length, storage_layout=args['storage_layout']),
+    bucket_length=60000, max_buckets=args['query_cache_buckets'])
 
 
         
+'''
+Frames are passed to the detection and tracking processes through fixed size ring buffers in shared memory.
+The queues only carry slot indices and metadata. Size the slots from the first frame of the stream
+'''
+probe_frame = vs.read()
+if probe_frame is None:
+    print("COULDN'T READ A FRAME FROM THE CAMERA/VIDEO STREAM")
+    vs.stop()
+    sys.exit()
+
+detection_ring = FrameRingBuffer(max(2, args['num_workers']*2), imutils.resize(probe_frame, width=detection_frame_width).shape) # Frames waiting for or being sent to the detector
+tracking_ring = FrameRingBuffer(args['tracking_ring_slots'], imutils.resize(probe_frame, width=tracking_frame_width).shape) # Every frame in o_queue and the tracking loop's reorder buffer holds one slot
+del probe_frame
+
+
 first_frame_detected = False
 if args["display"] == 1:
     display = True
@@ -301,87 +338,194 @@ update_frames = True
 
 lambda_wakeup_duration = 0
 
-print("Sending Wakeup Ping to Lambda function")
-requests.get(lambda_url)
+print("Sending Wakeup Ping to detector")
+detector.wakeup()
 print("Waiting "+str(lambda_wakeup_duration)+" seconds for function to wake up...")
 time.sleep(lambda_wakeup_duration)
 
 
 
-# this handler will be run for each incoming connection in a dedicated greenlet
-def tracklets_socket_server_handler(socket, address):
-    print('New connection for tracklets_socket_server from %s:%s' % address)
+def run_query(query, query_timestamp, query_range, **kwargs):
+    # Run query(query_timestamp, query_range, ...), an eon_partitions query, in a query thread on a snapshot of the partitions ...
+    # ... that overlap the window. The greenlet waits for it (and for a free thread first) while the writer and other requests carry on
+    partition_snapshots = eon_partitions.snapshot(query_timestamp, query_range)
 
-    # Read socket query
-    query_dict =  json.loads(socket.recv(4096).decode('utf-8'))
-    query_timestamp = query_dict['timestamp']
-    query_range = query_dict['range']
-    query_timestamp = int(query_timestamp)
-    query_range = int(query_range)
+    def query_snapshots():
+        try:
+            return query(query_timestamp, query_range, partition_dbs=partition_snapshots, **kwargs)
+        finally:
+            for partition_snapshot in partition_snapshots:
+                partition_snapshot.release()
 
-    print("query_timestamp", query_timestamp)
+    return query_threadpool.spawn(query_snapshots).get()
 
-    trackableObjects = {}
-    for key, val in eon_tracklets_db:
-        if query_timestamp <= int.from_bytes(key[8:], byteorder=s2sphere_byteorder) < query_timestamp+query_range:
-            # print("query_timestamp", query_timestamp)
-            # print('int.from_bytes(key[8:], byteorder=s2sphere_byteorder)')
-            # print(int.from_bytes(key[8:], byteorder=s2sphere_byteorder))
-            # print("------------------------------------------")
-            
-            cell_id = int.from_bytes(key[0:8], byteorder=s2sphere_byteorder)
-            s2_cellid = s2sphere.CellId(id_=cell_id)
-            s2_latlng = s2_cellid.to_lat_lng()
-            lat = s2_latlng.lat().degrees
-            lng = s2_latlng.lng().degrees
-            frame_timestamp = int.from_bytes(key[8:], byteorder=s2sphere_byteorder)
-
-            if val[0:16].hex() in trackableObjects:
-                
-                trackableObjects[val[0:16].hex()]['tracklets'].append(
-                    [
-                        lng,
-                        lat,
-                        frame_timestamp 
-                    ]
-                )
-            else:
-                trackableObjects[val[0:16].hex()] = {
-                    "detection_class_id": int.from_bytes(val[16:], byteorder=s2sphere_byteorder),
-                    "tracklets": [
-                        [
-                            lng,
-                            lat,
-                            frame_timestamp
-                        ]
-                    ]
-                }
 
-    
-    trackable_object_list = []
-    for object_id, trackableObject in trackableObjects.items():
 
-        trackable_object_list.append(
+def tracklets_query(query_dict):
+    # Run one query of the tracklets database and return the list to send back. Raises KeyError, ValueError or TypeError if ...
+    # ... the query is missing something or has invalid values
+    query_timestamp = int(query_dict['timestamp'])
+    query_range = int(query_dict['range'])
 
-            {
-                "object_id": object_id,
-                "detection_class_id": trackableObject['detection_class_id'],
-                "tracklets": trackableObject['tracklets']
-            }
-        )
-    
+    # Optional level of detail to thin out each object's tracklets to, like {"max_points": 200, "min_spacing_ms": 500}
+    query_lod = trajectory_lod.lod_from_query(query_dict['lod']) if query_dict.get('lod') else None
+
+    print("query_timestamp", query_timestamp)
 
-    if len(trackable_object_list) > 0:
-        socket.sendall(bytes(str(trackable_object_list), 'utf-8'))
-        print("sent "+str(len(trackable_object_list))+ " trackable objects for query_timestamp "+str(query_timestamp))
-        #print(str(trackable_object_list))
+    # Optional area of the map to restrict the query to, {"bbox": [west, south, east, north]} or {"polygon": [[lng, lat], ...]}
+    query_region = None
+    if query_dict.get('region'):
+        query_region = tracklets_store.Region.from_query(query_dict['region'])
+
+    # Optional objects to restrict the query to, {"detection_class_ids": [6]} and/or {"object_ids": ["<objectID>", ...]}
+    query_filter = tracklets_store.ObjectFilter.from_query(query_dict)
+
+    if query_dict.get('command') == 'rollups':
+        # Counts per coarse cell and detection class instead of the tracklets. 'bucket' (milliseconds) splits the window ...
+        # ... into buckets of that length (whole minutes) instead of one total and 'level' merges cells into a coarser S2 level
+        query_bucket = int(query_dict['bucket']) if query_dict.get('bucket') else None
+        if query_bucket is not None:
+            query_bucket = max(tracklets_store.ROLLUP_BUCKET, query_bucket // tracklets_store.ROLLUP_BUCKET * tracklets_store.ROLLUP_BUCKET)
+        query_level = max(0, min(int(query_dict.get('level', tracklets_store.ROLLUP_LEVEL)), tracklets_store.ROLLUP_LEVEL))
+
+        rollup_list = run_query(eon_partitions.query_rollups, query_timestamp, query_range, bucket=query_bucket, level=query_level, region=query_region)
+        print("sending "+str(len(rollup_list))+ " rollups for query_timestamp "+str(query_timestamp))
+        return rollup_list
+
+    # Bounded iteration over the time-primary index of only the partitions that overlap the window instead of a full scan of the cell-primary keys
+    # With a region, bounded iteration over the cells of its S2 covering instead
+    # With objectIDs, bounded iteration over just their time spans. Filtered queries skip the points of other objects before decoding them
+    # Without a region or filter, from the cached buckets the window overlaps (the next bucket the map will ask for is read ahead)
+    if query_region is None and query_filter is None and query_window_cache.max_buckets > 0:
+        trackable_object_list = query_window_cache.query_time_window(query_timestamp, query_range)
     else:
-        socket.sendall(bytes(str([]), 'utf-8')) # send an empty list
+        trackable_object_list = run_query(eon_partitions.query_time_window, query_timestamp, query_range, storage_layout=args['storage_layout'], region=query_region, object_filter=query_filter)
+
+    if query_lod is not None:
+        # Shape preserving decimation so long windows don't send (and the map doesn't process) points it has no use for
+        trackable_object_list = query_threadpool.spawn(trajectory_lod.simplify_trackable_objects, trackable_object_list, **query_lod).get()
+    print("sending "+str(len(trackable_object_list))+ " trackable objects for query_timestamp "+str(query_timestamp))
+    return trackable_object_list
+
+
+
+def answer_tracklets_query(query_dict):
+    # The answer to one request on the tracklets socket as (list, encoding), or a subscription to the live feed
+    if query_dict.get('command') == 'subscribe':
+        # Objects are pushed as they're committed. With a 'resume_token' from an earlier subscription the ones missed since are sent first
+        query_region = tracklets_store.Region.from_query(query_dict['region']) if query_dict.get('region') else None
+        return live_tracklets_feed.subscribe(query_dict.get('resume_token'), query_region, tracklets_store.ObjectFilter.from_query(query_dict))
+
+    # Tracklets can be sent packed ('binary') instead of as JSON. Rollups are always JSON
+    encoding = query_dict.get('encoding', 'json') if query_dict.get('command', 'tracklets') == 'tracklets' else 'json'
+    if encoding not in wire_protocol.ENCODINGS:
+        raise ValueError("Unknown encoding "+str(encoding))
+
+    return tracklets_query(query_dict), encoding
+
+
+
+# this handler will be run for each incoming connection in a dedicated greenlet
+def tracklets_socket_server_handler(socket, address):
+    print('New connection for tracklets_socket_server from %s:%s' % address)
+
+    # The connection stays open for as many queries as the client sends, each with its own request ID, until the client closes it
+    # Requests are length-prefixed frames (see wire_protocol) or, from older clients, one unframed JSON write
+    try:
+        wire_protocol.serve_requests(socket, answer_tracklets_query)
+    except (wire_protocol.ProtocolError, ValueError, OSError) as e:
+        print("Closing tracklets_socket_server connection from %s:%s" % address, e)
 
 
     return True # Must return something otherwise gevent base server socket won't get closed and we'll end up with zombie sockets
         
 
+def write_trackable_object(write_batch, trackable_object):
+    # Add every tracklet of a completed trackable object to 'write_batch' (an eon_partitions.write_batch()) in the '--storage_layout' format(s)
+    # Each tracklet goes into the eon partition of its frame_timestamp. Returns the frame_timestamp of the last one
+
+    # The tracking loop already looked up each oid's cell from the lookup tables unless it was calibrating ...
+    # ... the rest are encoded here in one call
+    s2_cell_ids = [oid['bbox_rw_coords']['btm_center'].get('cell_id') for oid in trackable_object.oids]
+    missing = [n for n, s2_cell_id in enumerate(s2_cell_ids) if s2_cell_id is None]
+    if missing:
+        btm_centers = [trackable_object.oids[n]['bbox_rw_coords']['btm_center'] for n in missing]
+        encoded_cell_ids = s2cells.cell_ids_from_lat_lng([btm_center['lat'] for btm_center in btm_centers], [btm_center['lng'] for btm_center in btm_centers])
+        for n, s2_cell_id in zip(missing, encoded_cell_ids.tolist()):
+            s2_cell_ids[n] = s2_cell_id
+
+    # Get the timestamp for when each tracklet occurred (But which end?). In milliseconds
+    # Convert frame_timestamp back to int since when it comes back from CentroidTracker it has a ".0" at the end
+    frame_timestamps = [int(oid['frame_timestamp']) for oid in trackable_object.oids]
+
+    # Per minute, per coarse cell and per detection class counts for dashboards and heatmaps
+    write_batch.add_object_rollups(trackable_object.detection_class_id, s2_cell_ids, frame_timestamps)
+
+    # The object's time span and detection class, so queries for particular objects only read their part of the time index
+    for eon_write_batch in write_batch.for_timestamps(frame_timestamps):
+        tracklets_store.put_object_span(eon_write_batch, trackable_object.objectID, trackable_object.detection_class_id, frame_timestamps)
+
+    if args['storage_layout'] in ('objects', 'both'):
+        # The whole object as one compressed record plus its time and space index entries
+        # An object that crosses an eon boundary is put in each partition it's in so every query that overlaps it finds it
+        for eon_write_batch in write_batch.for_timestamps(frame_timestamps):
+            tracklets_store.put_object(eon_write_batch, trackable_object.objectID, trackable_object.detection_class_id, s2_cell_ids, frame_timestamps)
+
+    if args['storage_layout'] == 'objects':
+        return frame_timestamps[-1]
+
+    # The LevelDB 'value' is the concatenation of the objectID and its the detection_class_id 
+    value = tracklets_store.tracklet_value(trackable_object.objectID, trackable_object.detection_class_id)
+
+    for s2_cell_id, frame_timestamp in zip(s2_cell_ids, frame_timestamps):
+
+        '''
+        #### DISCREPANCY: S2sphere Cells VS. Lat, Lng
+        Since we're storing values in the database as s2sphere cells and not lat, lng coordinates the best precision we can get amounts to dividing up the earth into square centimeters, it's highest cell level. And if you ask for the lat, lng coordinate of that cell, it'll return the lat, lng coordinate at the centre of that cell. But the precision of the lat, lng coordinates from the map server is higher so the function "s2sphere.LatLng.from_degrees" will take any lat, lng coordinate you give it and return the cell in which it resides whose centre will always be half a centimetre or less away from it. So there will always be a discrepancy between the lat, lng coordinates coming from the map server/homography function and the lat, lng coordinate associated with the centre of the cell that is actually entered into the database. The lat, lng discrepancy can range from 1.0e-8 to 1.0e-10 degrees. 
+        '''
+
+        # Set the cell-primary key and its time-primary index entry to be written to the database
+        tracklets_store.put_tracklet(write_batch.for_timestamp(frame_timestamp), s2_cell_id, frame_timestamp, value)
+
+        # # print('Original Lat Lng')
+        # # print('OR lat ', lat)
+        # # print('OR lng ', lng)
+
+        # # print('S2 Lat Lng')
+        # s2_latlng_dup = s2_cellid.to_lat_lng()
+        # s2_lat = s2_latlng_dup.lat().degrees
+        # s2_lng = s2_latlng_dup.lng().degrees
+        # # print('s2 lat ', s2_lat)
+        # # print('s2 lng ', s2_lng)
+
+        # # print('DIFFERENCE lat ', lat - s2_latlng_dup.lat().degrees)
+        # # print('DIFFERENCE lng ', lng - s2_latlng_dup.lng().degrees)
+
+    return frame_timestamps[-1]
+
+
+
+def feed_object(trackable_object):
+    # A committed trackable object in the query result format for the live feed
+    return {
+        "object_id": trackable_object.objectID,
+        "detection_class_id": int(trackable_object.detection_class_id),
+        "tracklets": [
+            [oid['bbox_rw_coords']['btm_center']['lng'], oid['bbox_rw_coords']['btm_center']['lat'], int(oid['frame_timestamp'])]
+            for oid in trackable_object.oids
+        ]
+    }
+
+
+
+def queue_size(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError: # macOS
+        return 0
+
+
+
 #### !!! WARNING !!! --> If writing to LevelDB in this loop, only run this in one process and avoid threads unless you use locking
 # ... https://github.com/google/leveldb/blob/master/doc/index.md#concurrency
 #### !!! WARNING !!! --> Store s2sphere in bigendian format to order bytes lexicographically in LevelDB
@@ -394,6 +538,8 @@ def tracklets_loop():
 
     try:
 
+        global query_threadpool
+        query_threadpool = ThreadPool(max(1, args['query_threads']))
 
         # print("Start gevent server socket for mapserver to get tracklets")
         tracklets_socket_server = StreamServer(('127.0.0.1', 8766), tracklets_socket_server_handler)
@@ -402,73 +548,69 @@ def tracklets_loop():
 
         print("STARTING TRACKLETS_LOOP")
 
+        # Index any tracklets that were stored before the time-primary index existed
+        indexed_count = tracklets_store.build_time_index(eon_tracklets_db)
+        if indexed_count > 0:
+            print("Added "+str(indexed_count)+" existing tracklets to the time index")
+
+        pending_objects = [] # Trackable objects taken off tracklets_queue but not committed yet
+        pending_since = None # When the oldest of them was taken off the queue
+        next_wait_seconds = 0
+        last_expire_time = 0
+
+        def commit_pending_objects():
+            nonlocal pending_objects, pending_since
+            commit_start_time = time.time()
+
+            with eon_partitions.write_batch() as eon_tracklets_wb:
+                for trackable_object in pending_objects:
+                    frame_timestamp = write_trackable_object(eon_tracklets_wb, trackable_object)
+
+            # Cached query results of the minutes these objects were written into are stale now
+            for trackable_object in pending_objects:
+                frame_timestamps = [int(oid['frame_timestamp']) for oid in trackable_object.oids]
+                query_window_cache.invalidate(min(frame_timestamps), max(frame_timestamps))
+
+            tracklets_commit_latency_ms.value = (time.time() - commit_start_time) * 1000
+            tracklets_committed_objects.value += len(pending_objects)
+
+            # Push them to live subscribers now that they're in the database
+            live_tracklets_feed.publish([feed_object(trackable_object) for trackable_object in pending_objects])
+
+            pending_objects = []
+            pending_since = None
+            return frame_timestamp
+
         while run_tracklets_loop.value:
 
             try:
                 
                 if run_tracklets_socket_server.value == 0:
+                    if pending_objects:
+                        commit_pending_objects()
+
                     tracklets_socket_server.stop(timeout=3)
 
                     break
 
 
-                gevent.wait(timeout=1) # https://stackoverflow.com/a/10292950/8941739
-                
-                if not tracklets_queue.empty():
+                # Wait for queries to the socket server (and the rest of gevent) until it's time to look at the queue again
+                gevent.wait(timeout=next_wait_seconds) # https://stackoverflow.com/a/10292950/8941739
 
-                    trackable_object = tracklets_queue.get(block=False)
+                # Drain the queue in bulk instead of one object per loop turn
+                while len(pending_objects) < args['commit_max_objects']:
+                    try:
+                        pending_objects.append(tracklets_queue.get(block=False))
+                    except Empty:
+                        break
 
-                    with eon_tracklets_db.write_batch() as eon_tracklets_wb:
-                        
-                        for oid in trackable_object.oids:
-                            bbox_rw_coords = oid['bbox_rw_coords']
-
-                            lat = oid['bbox_rw_coords']['btm_center']['lat']
-                            lng = oid['bbox_rw_coords']['btm_center']['lng']
-
-                            '''
-                            #### DISCREPANCY: S2sphere Cells VS. Lat, Lng
-                            Since we're storing values in the database as s2sphere cells and not lat, lng coordinates the best precision we can get amounts to dividing up the earth into square centimeters, it's highest cell level. And if you ask for the lat, lng coordinate of that cell, it'll return the lat, lng coordinate at the centre of that cell. But the precision of the lat, lng coordinates from the map server is higher so the function "s2sphere.LatLng.from_degrees" will take any lat, lng coordinate you give it and return the cell in which it resides whose centre will always be half a centimetre or less away from it. So there will always be a discrepancy between the lat, lng coordinates coming from the map server/homography function and the lat, lng coordinate associated with the centre of the cell that is actually entered into the database. The lat, lng discrepancy can range from 1.0e-8 to 1.0e-10 degrees. 
-                            '''
-
-                            s2_latlng = s2sphere.LatLng.from_degrees(lat, lng)
-                            s2_cellid = s2sphere.CellId.from_lat_lng(s2_latlng)
-
-                            # Take the s2sphere cell ID (a 64-bit integer) and convert it to an 8 byte big-endian Python bytes object
-                            cell_id_as_bytes = s2_cellid.id().to_bytes(8, byteorder=s2sphere_byteorder)
-                            # Get the timestamp for when this tracklet occurred (But which end?)
-                            frame_timestamp = oid['frame_timestamp'] # In milliseconds
-                            # Convert frame_timestamp back to int since when it comes back from CentroidTracker it has a ".0" at the end
-                            frame_timestamp = int(frame_timestamp)
-                            # Convert that timestamp to bytes
-                            frame_timestamp_as_bytes = frame_timestamp.to_bytes(6, byteorder=s2sphere_byteorder)
-                            # Concatenate those bytes together. This is the LevelDB 'key' 
-                            key = bytes(0).join( ( cell_id_as_bytes, frame_timestamp_as_bytes ) )
-
-                            # The LevelDB 'value' is the concatenation of the objectID and its the detection_class_id 
-                            # Convert objectID to bytes
-                            objectID_as_bytes = bytes.fromhex(trackable_object.objectID) # 16 bytes
-                            # Convert detection_class_id to bytes
-                            detection_class_id_as_bytes  = (trackable_object.detection_class_id).to_bytes(2, byteorder=s2sphere_byteorder)
-                            value = bytes(0).join( ( objectID_as_bytes, detection_class_id_as_bytes ) )
-
-                            # Set the key value pair to be written to the database
-                            eon_tracklets_wb.put(key, value)
-
-                            # # print('Original Lat Lng')
-                            # # print('OR lat ', lat)
-                            # # print('OR lng ', lng)
-
-                            # # print('S2 Lat Lng')
-                            # s2_latlng_dup = s2_cellid.to_lat_lng()
-                            # s2_lat = s2_latlng_dup.lat().degrees
-                            # s2_lng = s2_latlng_dup.lng().degrees
-                            # # print('s2 lat ', s2_lat)
-                            # # print('s2 lng ', s2_lng)
-
-                            # # print('DIFFERENCE lat ', lat - s2_latlng_dup.lat().degrees)
-                            # # print('DIFFERENCE lng ', lng - s2_latlng_dup.lng().degrees)
+                if pending_objects and pending_since is None:
+                    pending_since = time.time()
 
+                # Group commit: all the pending objects go into the database in one write batch once there are ...
+                # ... commit_max_objects of them or the oldest has waited commit_interval_ms
+                if pending_objects and (len(pending_objects) >= args['commit_max_objects'] or (time.time() - pending_since) * 1000 >= args['commit_interval_ms']):
+                    frame_timestamp = commit_pending_objects()
 
                     if args['mode'] == 'CALIBRATING': # If we're in calibration mode show user the frame_timestamp
                         print("last frame_timestamp")
@@ -476,15 +618,34 @@ def tracklets_loop():
                         print("current timezone", my_tz)
                         print( datetime.fromtimestamp(frame_timestamp/1000, my_tz).strftime("%B %d, %Y %I:%M %p") )
 
+                tracklets_backlog.value = queue_size(tracklets_queue) + len(pending_objects)
 
-
+                if len(pending_objects) >= args['commit_max_objects']:
+                    next_wait_seconds = 0 # Still behind. Commit the next batch right away (after letting the socket server run)
+                elif pending_objects:
+                    next_wait_seconds = max(0, args['commit_interval_ms'] / 1000 - (time.time() - pending_since))
                 else:
-                    try:
-                        if int((datetime.now() - idle_since).total_seconds()) > 40:
-                            idle_since = datetime.now()
-                            print("no tracklets_queue items for tracklets loop .................")
-                    except:
+                    next_wait_seconds = args['commit_interval_ms'] / 1000
+
+                try:
+                    if int((datetime.now() - idle_since).total_seconds()) > 40:
                         idle_since = datetime.now()
+                        if tracklets_committed_objects.value == last_logged_committed_objects:
+                            print("no tracklets_queue items for tracklets loop .................")
+                        else:
+                            print("tracklets writer: "+str(tracklets_committed_objects.value - last_logged_committed_objects)+" objects committed in the last 40 seconds, backlog "+str(tracklets_backlog.value)+" objects, last commit "+str(round(tracklets_commit_latency_ms.value, 1))+" ms")
+                            last_logged_committed_objects = tracklets_committed_objects.value
+                except:
+                    idle_since = datetime.now()
+                    last_logged_committed_objects = tracklets_committed_objects.value
+
+                # Once a minute, drop the eon partitions that are past the retention period
+                if eon_partitions.retention is not None and time.time() - last_expire_time > 60:
+                    last_expire_time = time.time()
+                    dropped_count = eon_partitions.expire(time.time() * 1000, on_batch=lambda: gevent.wait(timeout=0)) # Let queries run between delete batches
+                    if dropped_count > 0:
+                        print("Dropped "+str(dropped_count)+" expired tracklets database partitions")
+                        query_window_cache.clear()
 
 
 
@@ -524,6 +685,50 @@ def tracklets_loop():
                                          
 
     
+def visible_objects_with_rw_coords(ct):
+    # The objects seen in the latest tracker update as (objectID, frame_timestamp, detection_class_id, centroid, boxoid, bbox_rw_coords) tuples.
+    # The real world coordinates of every object's bounding box bottom left, bottom right and bottom center are looked up (or transformed) in a single call
+    # The S2 cell ID of the bottom center is added as bbox_rw_coords['btm_center']['cell_id'] when the lookup tables are built
+    objectIDs, frameTimestamps, detectionClassIDs, centroids, boxoids = ct.visible()
+
+    # Calculate bottom center pixel coordinates
+    #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
+    bottom_center_x = centroids[:, 0]
+    bottom_y = boxoids[:, 3]
+
+    pixel_points = np.stack([
+        np.stack([boxoids[:, 0], bottom_y], axis=1), # btm_left
+        np.stack([boxoids[:, 2], bottom_y], axis=1), # btm_right
+        np.stack([bottom_center_x, bottom_y], axis=1) # btm_center
+    ], axis=1) # (N, 3, 2)
+
+    if rw.lookup_table_key is None: # The lookup tables aren't built while calibrating
+        rw_points = rw.coords(pixel_points.reshape(-1, 2))
+        btm_center_cell_ids = [None] * len(objectIDs)
+    else:
+        rw_points, cell_ids = rw.lookup(pixel_points.reshape(-1, 2))
+        btm_center_cell_ids = cell_ids.reshape(-1, 3)[:, 2].tolist()
+
+    rw_points = rw_points.reshape(-1, 3, 2).tolist()
+
+    visible_objects = []
+    for (objectID, frame_timestamp, detection_class_id, centroid, boxoid, (btm_left, btm_right, btm_center), btm_center_cell_id) in zip(
+            objectIDs.tolist(), frameTimestamps.tolist(), detectionClassIDs.tolist(), centroids.tolist(), boxoids.tolist(), rw_points, btm_center_cell_ids):
+
+        # Add bottom center pixel coordinates to trackable object
+        bbox_rw_coords = {
+            "btm_left": {"lng": btm_left[0], "lat": btm_left[1]},
+            "btm_right": {"lng": btm_right[0], "lat": btm_right[1]},
+            "btm_center": {"lng": btm_center[0], "lat": btm_center[1]}
+        }
+        if btm_center_cell_id is not None:
+            bbox_rw_coords["btm_center"]["cell_id"] = btm_center_cell_id
+        visible_objects.append((objectID, frame_timestamp, detection_class_id, centroid, boxoid, bbox_rw_coords))
+
+    return visible_objects
+
+
+
 def tracking_loop():
     try:
         
@@ -535,46 +740,57 @@ def tracking_loop():
         #global tracking_loop_fps
         tracking_loop_fps = FPS().start()
         
-        frame_loop_count = 0
         avg = None
         tracker_boxes = []
         track_centroids = True
 
-        ct = CentroidTracker(maxDisappeared=10, maxDistance=tracking_frame_width/20)
+        ct = ArrayCentroidTracker(maxDisappeared=10, maxDistance=tracking_frame_width/20, associationMethod=args['association'], useIoU=args['match_iou'] == 1,
+            motionModel=args['motion_model'] == 1)
         trackableObjects = {}
+
+        # Detected frames come back from the detector later than the frames around them. The reorder buffer releases ...
+        # ... frames in frame number order and skips a missing frame number once it's later than the watermark
+        reorder_buffer = FrameReorderBuffer(max_wait=args['reorder_max_wait'], max_size=p_queue_max)
         
         while run_tracking_loop.value:
-            # Pull first/next frame tuple from p_queue
+            # Pull first/next frame tuple from the reorder buffer
             #queue_get_start_time = time.time()
 
-            if tracking_loop_fps._numFrames % 70 == 0 and not tracking_loop_fps._numFrames == 0:
-                current_tracking_loop_fps = tracking_loop_fps._numFrames / (datetime.now() - tracking_loop_fps._start).total_seconds()
-                print("[INFO] approx. Tracking_Loop Running FPS: {:.2f}".format(current_tracking_loop_fps))
-
-                
             try:
-                if p_queue.full():
-                    print("p_queue FULL .......................................................")
-                    # Then we'll need to drop the next frame from the stack
-                    frame_number, frame_dict = p_queue.get()
+                frame_tuple = reorder_buffer.pop()
 
-                    frame_loop_count = frame_number + 1 # Since we're skipping a frame, we'll need to make sure frame_loop_count catches up to the next frame_number 
-                    continue # Start loop again
-                else:
-                    
-                    p_queue.put(o_queue.get(timeout=20)) # Bring frames from shared output queue into priority queue so they can be used in order
-                    frame_number, frame_dict = p_queue.get(timeout=20)
-                    
-            except:
-                # If there are no more frames being put into p_queue, stop the thread
-                print("No More Frames In p_queue")
+                if frame_tuple is None:
+                    # The next frame isn't here yet. Block on o_queue until a frame arrives or until the missing frame passes the watermark
+                    seconds_until_skip = reorder_buffer.seconds_until_skip()
+                    frame_number, frame_dict = o_queue.get(timeout=20 if seconds_until_skip is None else seconds_until_skip)
+
+                    # Frames whose number was already skipped are dropped
+                    for late_frame_number, late_frame_dict in reorder_buffer.push(frame_number, frame_dict):
+                        tracking_ring.release(late_frame_dict["slot"])
+
+                    continue
+
+                frame_number, frame_dict = frame_tuple
+
+            except Empty:
+                if len(reorder_buffer) > 0:
+                    continue # The missing frame passed the watermark. The next pop() will skip it
+
+                # If there are no more frames being put into o_queue, stop the thread
+                print("No More Frames In o_queue")
                 tracking_loop_fps.stop()
                 print("[INFO] approx. Tracking_Loop FPS: {:.2f}".format(tracking_loop_fps.fps()))
+                print("[INFO] reorder buffer", reorder_buffer.stats())
                 run_tracking_loop.value = 0
                 return
             
             #print("queue_get_start_time Time:", time.time()-queue_get_start_time)
 
+            if tracking_loop_fps._numFrames % 70 == 0 and not tracking_loop_fps._numFrames == 0:
+                current_tracking_loop_fps = tracking_loop_fps._numFrames / (datetime.now() - tracking_loop_fps._start).total_seconds()
+                print("[INFO] approx. Tracking_Loop Running FPS: {:.2f}".format(current_tracking_loop_fps))
+                print("[INFO] reorder buffer", reorder_buffer.stats())
+
             try:
                 if int((datetime.now() - running_notice_since).total_seconds()) > 40:
                     running_notice_since = datetime.now()
@@ -583,329 +799,96 @@ def tracking_loop():
                 running_notice_since = datetime.now()
 
 
-            # if p_queue.qsize() > 70:
-            #     print("p_queue size")
-            #     print(p_queue.qsize())
+            this_frame = tracking_ring.get(frame_dict["slot"]) # A view of the frame in shared memory, not a copy
+            frame_timestamp = frame_dict["frame_timestamp"]
+            if frame_dict.get("detected") == 1:
 
-            if frame_number > frame_loop_count:
-                try:
-                    if int((datetime.now() - frame_number_high_notice_since).total_seconds()) > 10:
-                        frame_number_high_notice_since = datetime.now()
-                        print("frame number too high ...")
-                except:
-                    frame_number_high_notice_since = datetime.now()
+                # (re-)initialize OpenCV's special multi-object tracker
+                # try:
+                #     trackers.clear()
+                # except:
+                #     pass
+                
+                #trackers = cv2.MultiTracker_create() # Or we end up with multiple boxes on same object
 
-                p_queue.task_done() 
-                '''
-                This tracking loop has outpaced our actual frames because of our "detections" bottleneck
-                Since we're adding the same frame back to p_queue again, an act which increases the task 
-                count, calling .task_done() ensures the count of unfinished tasks does not exceed the 
-                number of actual frames or else .join() will never stop blocking because it assumes
-                that there are more tasks/frames to complete than we actually have. 
-                https://docs.python.org/3.4/library/queue.html#queue.Queue.join 
-                '''
-                p_queue.put((frame_number, frame_dict))
-            else:
-                frame_loop_count += 1
-                this_frame = frame_dict["frame"]
-                frame_timestamp = frame_dict["frame_timestamp"]
-                if frame_dict.get("detected") == 1:
-
-                    # (re-)initialize OpenCV's special multi-object tracker
-                    # try:
-                    #     trackers.clear()
-                    # except:
-                    #     pass
-                    
-                    #trackers = cv2.MultiTracker_create() # Or we end up with multiple boxes on same object
+                output_dict = frame_dict.get("output_dict")
+                
+                tracker_boxes = detection_visualization_util.get_bounding_boxes_for_image_array(
+                    this_frame,
+                    output_dict['detection_boxes'],
+                    output_dict['detection_classes'],
+                    output_dict['detection_scores'],
+                    instance_masks=output_dict.get('detection_masks'),
+                    use_normalized_coordinates=True,
+                    line_thickness=1,
+                    skip_scores=True,
+                    skip_labels=True
+                )
 
-                    output_dict = frame_dict.get("output_dict")
-                    
-                    tracker_boxes = detection_visualization_util.get_bounding_boxes_for_image_array(
-                        this_frame,
-                        output_dict['detection_boxes'],
-                        output_dict['detection_classes'],
-                        output_dict['detection_scores'],
-                        instance_masks=output_dict.get('detection_masks'),
-                        use_normalized_coordinates=True,
-                        line_thickness=1,
-                        skip_scores=True,
-                        skip_labels=True
-                    )
-
-
-                    #print(tracker_boxes)
-                    # Remove items from tracker_boxes that aren't
-                    # a person, bicycle, car, motorcycle, bus or truck
-                    # tracker_boxes_to_delete = []
-                    # for idx in range(len(tracker_boxes)):
-                    #     if tracker_boxes[idx][4] not in [1, 2, 3, 4, 6, 8]:
-                    #         tracker_boxes_to_delete.append(idx)
-
-
-                    # for tracker_box_idx in tracker_boxes_to_delete:
-                    #         try:
-                    #             del tracker_boxes[tracker_box_idx]
-                    #         except:
-                    #             print(tracker_boxes)
-                    #             print(idx)
 
-                            
+                #print(tracker_boxes)
+                # Remove items from tracker_boxes that aren't
+                # a person, bicycle, car, motorcycle, bus or truck
+                # tracker_boxes_to_delete = []
+                # for idx in range(len(tracker_boxes)):
+                #     if tracker_boxes[idx][4] not in [1, 2, 3, 4, 6, 8]:
+                #         tracker_boxes_to_delete.append(idx)
 
-                    manual = False
-                    if display:
-                        colors = [] # For display when testing consistent track association
-                        
-                    if manual:
-                        bbox = cv2.selectROI("Frame", this_frame, fromCenter=False, showCrosshair=True)
-
-                        tracker_boxes = []
-                        tracker_boxes.append(bbox)
-                    else:
-                        if track_centroids:
-                            rects = []
-                        
-                        for idx, bbox in enumerate(tracker_boxes):
-                            
-                            xmin, ymin, xmax, ymax, detection_class_id = bbox
 
-                            tracker_boxes[idx] = (xmin, ymin, xmax-xmin, ymax-ymin)
+                # for tracker_box_idx in tracker_boxes_to_delete:
+                #         try:
+                #             del tracker_boxes[tracker_box_idx]
+                #         except:
+                #             print(tracker_boxes)
+                #             print(idx)
 
-                            
-                            if track_centroids:
-                                # print("track_centroids frame_timestamp")
-                                # print(frame_timestamp)
-                                rects.append((xmin, ymin, xmax, ymax, frame_timestamp, detection_class_id))
                         
-                            if display:
-                                colors.append((randint(0, 255), randint(0, 255), randint(0, 255)))
 
+                manual = False
+                if display:
+                    colors = [] # For display when testing consistent track association
+                    
+                if manual:
+                    bbox = cv2.selectROI("Frame", this_frame, fromCenter=False, showCrosshair=True)
 
-                    '''
-                    Use object detection to identify the objects that
-                    we've been tracking though just motion detection,
-                    contours and centroids. 
-                    Record those tracklets that belong to objects we want
-                    '''
+                    tracker_boxes = []
+                    tracker_boxes.append(bbox)
+                else:
                     if track_centroids:
-
-                        # use the centroid tracker to associate the (1) old object
-                        # centroids with (2) the object detections
-                        objects = ct.update(rects, True)
-
-                        # # loop over the tracked objects to add them to objectsPositions and to trackableObjects
-                        # objectsPositions = []
-                        for (objectID, (centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid)) in objects.items():
-
-                            if ct.disappeared[objectID] != 0:
-                                continue
-                                
-
-                                
-                            # # Calculate bottom center pixel coordinates
-                            # #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
-                            # bottom_center_x = centroid[0]
-                            # bottom_center_y = boxoid[3]
-
-
-                            # objectsPositions.append({
-                            #     "tracklet_id": objectID,
-                            #     "node_id": node_id,
-                            #     "bbox_rw_coord": {
-                            #         "btm_left": rw.coord(boxoid[0], boxoid[3]),
-                            #         "btm_right": rw.coord(boxoid[2], boxoid[3]),
-                            #         "btm_center": rw.coord(bottom_center_x, bottom_center_y)
-                            #     },
-                            #     "frame_timestamp": boxoid[4],
-                            #     "detection_class_id": boxoid[5]
-                            # })
-
-                            # Change centroid_detection_class_id from 1 x 1 numpy array to int
-                            centroid_detection_class_id = int(centroid_detection_class_id[0])
-                            
-                            # Calculate bottom center pixel coordinates
-                            #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
-                            bottom_center_x = centroid[0]
-                            bottom_center_y = boxoid[3]
-
-                            # Add bottom center pixel coordinates to trackable object
-                            bbox_rw_coords = {
-                                "btm_left": rw.coord(boxoid[0], boxoid[3]),
-                                "btm_right": rw.coord(boxoid[2], boxoid[3]),
-                                "btm_center": rw.coord(bottom_center_x, bottom_center_y)
-                            }
-
-                                
-                            # check to see if a trackable object exists for the current
-                            # object ID
-                            to = trackableObjects.get(objectID, None)
-
-                            # if there is no existing trackable object, create one
-                            if to is None:
-                                to = TrackableObject(objectID, centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords)
-
-                            # otherwise, there is a trackable object so we can utilize it
-                            # to determine direction
-                            else:
-                                # the difference between the y-coordinate of the *current*
-                                # centroid and the mean of *previous* centroids will tell
-                                # us in which direction the object is moving (negative for
-                                # 'up' and positive for 'down')
-                                # y = [c[1] for c in to.centroids]
-                                # if len(y) > 0: # to avoid 'invalid value encountered in double_scalars' error (https://stackoverflow.com/a/33898520/8941739)
-                                #     direction = centroid[1] - np.mean(y)
-                                #to.append_centroid(centroid)
-                                #to.append_boxoid(boxoid)
-                                to.append_oids(centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords)
-
-
-
-
-                            # store the trackable object in our dictionary
-                            trackableObjects[objectID] = to
-
-                            
-                        ## Put tracklet tip data in queue via a separate process/thread
-                        ## To update their position in database
-                        # tracklets_queue.put({ "tracklets": objectsPositions })                                
-
-                        
-
-                        # For all the objects in trackableObjects
-
-                        # After updating, if object has been marked as "deregistered" ...
-                        # ... it's been completely tracked, add it to deregistered_objects list
-                        deregistered_objects = []
-                        for object_id, trackableObject in trackableObjects.items():
-                            
-                            if not ct.objects.get(object_id, False): 
-                                deregistered_objects.append(object_id)
-
-                        
-                        # For each object in deregistered_objects
-                        for object_id in deregistered_objects:
-                            # ... mark the corresponding trackableObject's (in trackableObjects) 'complete' property as True
-                            trackableObjects[object_id].complete = True
-
-                            # If this trackable object has a detection, add this it to tracklets_queue for seralization/storage
-                            if trackableObjects[object_id].detection_class_id > 0:
-                                tracklets_queue.put(trackableObjects[object_id])                          
-
-                            # Now remove this completed trackable object from the trackableObjects dictionary
-                            del trackableObjects[object_id]
-
-                            
-                        # -> if track_centroids
+                        rects = []
                     
-
-                    #tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
-                    #ok = tracker.init(this_frame, bbox)
+                    for idx, bbox in enumerate(tracker_boxes):
                         
-                    # if ok:
-                    #     print("New tracking box initialized")
-
-                    # for bbox in tracker_boxes:
-                    #     tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
-                    #     trackers.add(tracker, this_frame, bbox)
-                    
-
-                    # -> if frame_dict.get("detected") == 1:
-                    
-                # else:
-
-                #     if frame_number % (framerate - 14) == 0:
-                        # grab the updated bounding box coordinates (if any) for each
-                        # object that is being tracked
-
-                        #ok, bbox = tracker.update(this_frame)
-                        #ok, tracker_boxes = trackers.update(this_frame)
+                        xmin, ymin, xmax, ymax, detection_class_id = bbox
 
+                        tracker_boxes[idx] = (xmin, ymin, xmax-xmin, ymax-ymin)
 
-                        # if not ok:
-                        #     # Tracking failure
-                        #     #print("----- OBJECT TRACKER NOT UPDATING !! -----")
-                        #     if display:
-                        #         cv2.putText(this_frame, "Tracking failure detected", (100,80), cv2.FONT_HERSHEY_SIMPLEX, 0.75,(0,0,255),2)
-                        # else:
-                        #     # Tracking success
-                        #     if manual:
-                        #         tracker_boxes = []
-                        #         tracker_boxes.append(bbox)
-
-                    
-                    # -> if frame_dict.get("detected") == 1: else:
-
-
-                ## MOTION DETECTION. Accumulate the weighted average on every frame even if it's already detected
-                gray = cv2.cvtColor(this_frame, cv2.COLOR_BGR2GRAY)
-                gray = cv2.GaussianBlur(gray, (21, 21), 0)
-                # if the average frame is None, initialize it
-                if avg is None:
-                    print("[INFO] starting background model...")
-                    avg = gray.copy().astype("float")
-                    #rawCapture.truncate(0)
-                    #continue
-                    cnts = []
-                    
-                else:
-                    # accumulate the weighted average between the current frame and
-                    # previous frames, then compute the difference between the current
-                    # frame and running average
-                    cv2.accumulateWeighted(gray, avg, 0.5)
-                    frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-
-                    kernel = np.ones((5,5),np.uint8)
-                    # threshold the delta image, dilate the thresholded image to fill
-                    # in holes, then find contours on thresholded image
-                    thresh = cv2.threshold(frameDelta, delta_thresh, 255,
-                            cv2.THRESH_BINARY)[1]
-                    #thresh = cv2.dilate(thresh, None, iterations=2)
-                    thresh = cv2.dilate(thresh, kernel, iterations=2)
-                    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
-                            cv2.CHAIN_APPROX_SIMPLE)
-                    cnts = cnts[0] if imutils.is_cv2() else cnts[1]
-
-                
-
-                if track_centroids and frame_dict.get("detected") == 0:
-                    rects = []
-
-                # loop over the contours
-                for c in cnts:
-                    # if the contour is too small, ignore it
-                    if cv2.contourArea(c) < min_area:
-                        continue
-
-                    (x, y, w, h) = cv2.boundingRect(c)
+                        
+                        if track_centroids:
+                            # print("track_centroids frame_timestamp")
+                            # print(frame_timestamp)
+                            rects.append((xmin, ymin, xmax, ymax, frame_timestamp, detection_class_id))
                     
-                    if display:
-                        # compute the bounding box for the contour, draw it on the frame,
-                        # and update the text
-                        cv2.rectangle(this_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                        if display:
+                            colors.append((randint(0, 255), randint(0, 255), randint(0, 255)))
 
 
-                    startX = x
-                    startY = y
-                    endX = x + w
-                    endY = y + h
-                    
-                    if track_centroids and frame_dict.get("detected") == 0:
-                        # add the bounding box coordinates to the rectangles list
-                        # put 0 in detection_class_id section since we don't have a detection yet
-                        rects.append((startX, startY, endX, endY, frame_timestamp, 0))
+                '''
+                Use object detection to identify the objects that
+                we've been tracking though just motion detection,
+                contours and centroids. 
+                Record those tracklets that belong to objects we want
+                '''
+                if track_centroids:
 
-                if track_centroids and frame_dict.get("detected") == 0:
                     # use the centroid tracker to associate the (1) old object
-                    # centroids with (2) the newly computed object centroids
-                    objects = ct.update(rects)
-                    
+                    # centroids with (2) the object detections
+                    ct.update(rects, True)
+
                     # # loop over the tracked objects to add them to objectsPositions and to trackableObjects
                     # objectsPositions = []
-
-                    for (objectID, (centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid)) in objects.items():
-
-                        if ct.disappeared[objectID] != 0:
-                            continue
+                    # Only the objects seen in this frame (not marked "disappeared") are returned by ct.visible()
+                    for (objectID, centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords) in visible_objects_with_rw_coords(ct):
 
                         # # Calculate bottom center pixel coordinates
                         # #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
@@ -925,24 +908,7 @@ def tracking_loop():
                         #     "detection_class_id": boxoid[5]
                         # })
 
-                        # Change centroid_detection_class_id from 1 x 1 numpy array to int
-                        centroid_detection_class_id = int(centroid_detection_class_id[0])
-
-
-                        # Calculate bottom center pixel coordinates
-                        #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
-                        bottom_center_x = centroid[0]
-                        bottom_center_y = boxoid[3]
-
-                        # Add bottom center pixel coordinates to trackable object
-                        #to.bbox_rw_coords.append(
-                        bbox_rw_coords = {
-                            "btm_left": rw.coord(boxoid[0], boxoid[3]),
-                            "btm_right": rw.coord(boxoid[2], boxoid[3]),
-                            "btm_center": rw.coord(bottom_center_x, bottom_center_y)
-                        }
-
-                        
+                            
                         # check to see if a trackable object exists for the current
                         # object ID
                         to = trackableObjects.get(objectID, None)
@@ -959,111 +925,299 @@ def tracking_loop():
                             # us in which direction the object is moving (negative for
                             # 'up' and positive for 'down')
                             # y = [c[1] for c in to.centroids]
-
                             # if len(y) > 0: # to avoid 'invalid value encountered in double_scalars' error (https://stackoverflow.com/a/33898520/8941739)
                             #     direction = centroid[1] - np.mean(y)
-                                
                             #to.append_centroid(centroid)
                             #to.append_boxoid(boxoid)
                             to.append_oids(centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords)
 
-                            # # check to see if the object has been counted or not
-                            # if not to.counted:
-                            #     # if the direction is negative (indicating the object
-                            #     # is moving up) AND the centroid is above the center
-                            #     # line, count the object
-                            #     if direction < 0 and centroid[1] < H // 2:
-                            #         totalUp += 1
-                            #         to.counted = True
-
-                            #     # if the direction is positive (indicating the object
-                            #     # is moving down) AND the centroid is below the
-                            #     # center line, count the object
-                            #     elif direction > 0 and centroid[1] > H // 2:
-                            #         totalDown += 1
-                            #         to.counted = True
-
-
-                            
 
 
 
                         # store the trackable object in our dictionary
                         trackableObjects[objectID] = to
 
-                        # print("trackableObjects key")
-                        # trackable_objects_key = next(iter(trackableObjects))
-                        # print(trackable_objects_key)
-                        # print("trackable_object centroids")
-                        # print(trackableObjects[trackable_objects_key].centroids)
+                        
+                    ## Put tracklet tip data in queue via a separate process/thread
+                    ## To update their position in database
+                    # tracklets_queue.put({ "tracklets": objectsPositions })                                
 
-                        # print("trackable_object boxoids")
-                        # print(trackableObjects[trackable_objects_key].boxoids)
+                    
 
-                        # print("trackable_object")
-                        # obj = trackableObjects[trackable_objects_key]
-                        # for attr in dir(obj):
-                        #     print("obj.%s = %r" % (attr, getattr(obj, attr)))
+                    # For all the objects in trackableObjects
 
+                    # After updating, if object has been marked as "deregistered" ...
+                    # ... it's been completely tracked, add it to deregistered_objects list
+                    deregistered_objects = []
+                    for object_id, trackableObject in trackableObjects.items():
                         
-                        if display:
-                            # draw both the ID of the object and the centroid of the
-                            # object on the output frame
-                            text = "ID {}".format(objectID[0:3])
-                            cv2.putText(this_frame, text, (centroid[0] - 10, centroid[1] - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-                            cv2.circle(this_frame, (centroid[0], centroid[1]), 4, (0, 255, 0), -1)
+                        if object_id not in ct: 
+                            deregistered_objects.append(object_id)
 
+                    
+                    # For each object in deregistered_objects
+                    for object_id in deregistered_objects:
+                        # ... mark the corresponding trackableObject's (in trackableObjects) 'complete' property as True
+                        trackableObjects[object_id].complete = True
 
-                    ## Put tracklet tip data in queue via a separate process/thread
-                    ## To update their position in database
-                    #tracklets_queue.put({ "tracklets": objectsPositions })                                
+                        # If this trackable object has a detection, add this it to tracklets_queue for seralization/storage
+                        if trackableObjects[object_id].detection_class_id > 0:
+                            tracklets_queue.put(trackableObjects[object_id])                          
 
-                    
-                    # -> if track_centroids and frame_dict.get("detected") == 0:
+                        # Now remove this completed trackable object from the trackableObjects dictionary
+                        del trackableObjects[object_id]
+
+                        
+                    # -> if track_centroids
+                
 
+                #tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
+                #ok = tracker.init(this_frame, bbox)
                     
+                # if ok:
+                #     print("New tracking box initialized")
+
+                # for bbox in tracker_boxes:
+                #     tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
+                #     trackers.add(tracker, this_frame, bbox)
+                
+
+                # -> if frame_dict.get("detected") == 1:
+                
+            # else:
+
+            #     if frame_number % (framerate - 14) == 0:
+                    # grab the updated bounding box coordinates (if any) for each
+                    # object that is being tracked
+
+                    #ok, bbox = tracker.update(this_frame)
+                    #ok, tracker_boxes = trackers.update(this_frame)
+
+
+                    # if not ok:
+                    #     # Tracking failure
+                    #     #print("----- OBJECT TRACKER NOT UPDATING !! -----")
+                    #     if display:
+                    #         cv2.putText(this_frame, "Tracking failure detected", (100,80), cv2.FONT_HERSHEY_SIMPLEX, 0.75,(0,0,255),2)
+                    # else:
+                    #     # Tracking success
+                    #     if manual:
+                    #         tracker_boxes = []
+                    #         tracker_boxes.append(bbox)
+
+                
+                # -> if frame_dict.get("detected") == 1: else:
+
+
+            ## MOTION DETECTION. Accumulate the weighted average on every frame even if it's already detected
+            gray = cv2.cvtColor(this_frame, cv2.COLOR_BGR2GRAY)
+            gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            # if the average frame is None, initialize it
+            if avg is None:
+                print("[INFO] starting background model...")
+                avg = gray.copy().astype("float")
+                #rawCapture.truncate(0)
+                #continue
+                cnts = []
+                
+            else:
+                # accumulate the weighted average between the current frame and
+                # previous frames, then compute the difference between the current
+                # frame and running average
+                cv2.accumulateWeighted(gray, avg, 0.5)
+                frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
+
+                kernel = np.ones((5,5),np.uint8)
+                # threshold the delta image, dilate the thresholded image to fill
+                # in holes, then find contours on thresholded image
+                thresh = cv2.threshold(frameDelta, delta_thresh, 255,
+                        cv2.THRESH_BINARY)[1]
+                #thresh = cv2.dilate(thresh, None, iterations=2)
+                thresh = cv2.dilate(thresh, kernel, iterations=2)
+                cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
+                        cv2.CHAIN_APPROX_SIMPLE)
+                cnts = cnts[0] if imutils.is_cv2() else cnts[1]
+
+            
+
+            if track_centroids and frame_dict.get("detected") == 0:
+                rects = []
+
+            # loop over the contours
+            for c in cnts:
+                # if the contour is too small, ignore it
+                if cv2.contourArea(c) < min_area:
+                    continue
+
+                (x, y, w, h) = cv2.boundingRect(c)
+                
                 if display:
-                    # Draw tracker boxes on frame
-                    for idx, bbox in enumerate(tracker_boxes):
-                        #(xmin, xmax, ymin, ymax) = [int(v) for v in box]
-                        #cv2.rectangle(this_frame, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2, 1)
+                    # compute the bounding box for the contour, draw it on the frame,
+                    # and update the text
+                    cv2.rectangle(this_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+
+                startX = x
+                startY = y
+                endX = x + w
+                endY = y + h
+                
+                if track_centroids and frame_dict.get("detected") == 0:
+                    # add the bounding box coordinates to the rectangles list
+                    # put 0 in detection_class_id section since we don't have a detection yet
+                    rects.append((startX, startY, endX, endY, frame_timestamp, 0))
+
+            if track_centroids and frame_dict.get("detected") == 0:
+                # use the centroid tracker to associate the (1) old object
+                # centroids with (2) the newly computed object centroids
+                ct.update(rects)
+                
+                # # loop over the tracked objects to add them to objectsPositions and to trackableObjects
+                # objectsPositions = []
+
+                # Only the objects seen in this frame (not marked "disappeared") are returned by ct.visible()
+                for (objectID, centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords) in visible_objects_with_rw_coords(ct):
+
+                    # # Calculate bottom center pixel coordinates
+                    # #bottom_center_x = (boxoid[0] + boxoid[2]) / 2
+                    # bottom_center_x = centroid[0]
+                    # bottom_center_y = boxoid[3]
+
+
+                    # objectsPositions.append({
+                    #     "tracklet_id": objectID,
+                    #     "node_id": node_id,
+                    #     "bbox_rw_coord": {
+                    #         "btm_left": rw.coord(boxoid[0], boxoid[3]),
+                    #         "btm_right": rw.coord(boxoid[2], boxoid[3]),
+                    #         "btm_center": rw.coord(bottom_center_x, bottom_center_y)
+                    #     },
+                    #     "frame_timestamp": boxoid[4],
+                    #     "detection_class_id": boxoid[5]
+                    # })
 
-                        p1 = (int(bbox[0]), int(bbox[1]))
-                        p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                        cv2.rectangle(this_frame, p1, p2, colors[idx], 2)
 
                     
-                    # show the output frame
-                    cv2.imshow("Frame", this_frame)
-                    key = cv2.waitKey(1) & 0xFF
+                    # check to see if a trackable object exists for the current
+                    # object ID
+                    to = trackableObjects.get(objectID, None)
 
+                    # if there is no existing trackable object, create one
+                    if to is None:
+                        to = TrackableObject(objectID, centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords)
 
-                    # if the 's' key is selected, we are going to "select" a bounding
-                    # box to track
-                    if key == ord("s"):
-                        # select the bounding box of the object we want to track (make
-                        # sure you press ENTER or SPACE after selecting the ROI)
-                        box = cv2.selectROI("Frame", this_frame, fromCenter=False, showCrosshair=True)
+                    # otherwise, there is a trackable object so we can utilize it
+                    # to determine direction
+                    else:
+                        # the difference between the y-coordinate of the *current*
+                        # centroid and the mean of *previous* centroids will tell
+                        # us in which direction the object is moving (negative for
+                        # 'up' and positive for 'down')
+                        # y = [c[1] for c in to.centroids]
+
+                        # if len(y) > 0: # to avoid 'invalid value encountered in double_scalars' error (https://stackoverflow.com/a/33898520/8941739)
+                        #     direction = centroid[1] - np.mean(y)
+                            
+                        #to.append_centroid(centroid)
+                        #to.append_boxoid(boxoid)
+                        to.append_oids(centroid_frame_timestamp, centroid_detection_class_id, centroid, boxoid, bbox_rw_coords)
+
+                        # # check to see if the object has been counted or not
+                        # if not to.counted:
+                        #     # if the direction is negative (indicating the object
+                        #     # is moving up) AND the centroid is above the center
+                        #     # line, count the object
+                        #     if direction < 0 and centroid[1] < H // 2:
+                        #         totalUp += 1
+                        #         to.counted = True
+
+                        #     # if the direction is positive (indicating the object
+                        #     # is moving down) AND the centroid is below the
+                        #     # center line, count the object
+                        #     elif direction > 0 and centroid[1] > H // 2:
+                        #         totalDown += 1
+                        #         to.counted = True
 
-                        # create a new object tracker for the bounding box and add it
-                        # to our multi-object tracker
-                        tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
 
-                        trackers.add(tracker, frame, box)
+                        
 
 
-                    # if the `q` key was pressed, break from the loop
-                    elif key == ord("q"):
-                        break
 
+                    # store the trackable object in our dictionary
+                    trackableObjects[objectID] = to
 
-                tracking_loop_fps.update()
+                    # print("trackableObjects key")
+                    # trackable_objects_key = next(iter(trackableObjects))
+                    # print(trackable_objects_key)
+                    # print("trackable_object centroids")
+                    # print(trackableObjects[trackable_objects_key].centroids)
+
+                    # print("trackable_object boxoids")
+                    # print(trackableObjects[trackable_objects_key].boxoids)
+
+                    # print("trackable_object")
+                    # obj = trackableObjects[trackable_objects_key]
+                    # for attr in dir(obj):
+                    #     print("obj.%s = %r" % (attr, getattr(obj, attr)))
 
-                # Let the system know the task is done
-                p_queue.task_done()
                     
-                # -> if frame_number > frame_loop_count: else:
+                    if display:
+                        # draw both the ID of the object and the centroid of the
+                        # object on the output frame
+                        text = "ID {}".format(objectID[0:3])
+                        cv2.putText(this_frame, text, (centroid[0] - 10, centroid[1] - 10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+                        cv2.circle(this_frame, (centroid[0], centroid[1]), 4, (0, 255, 0), -1)
+
+
+                ## Put tracklet tip data in queue via a separate process/thread
+                ## To update their position in database
+                #tracklets_queue.put({ "tracklets": objectsPositions })                                
+
+                
+                # -> if track_centroids and frame_dict.get("detected") == 0:
+
+                
+            if display:
+                # Draw tracker boxes on frame
+                for idx, bbox in enumerate(tracker_boxes):
+                    #(xmin, xmax, ymin, ymax) = [int(v) for v in box]
+                    #cv2.rectangle(this_frame, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2, 1)
+
+                    p1 = (int(bbox[0]), int(bbox[1]))
+                    p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+                    cv2.rectangle(this_frame, p1, p2, colors[idx], 2)
+
+                
+                # show the output frame
+                cv2.imshow("Frame", this_frame)
+                key = cv2.waitKey(1) & 0xFF
+
+
+                # if the 's' key is selected, we are going to "select" a bounding
+                # box to track
+                if key == ord("s"):
+                    # select the bounding box of the object we want to track (make
+                    # sure you press ENTER or SPACE after selecting the ROI)
+                    box = cv2.selectROI("Frame", this_frame, fromCenter=False, showCrosshair=True)
+
+                    # create a new object tracker for the bounding box and add it
+                    # to our multi-object tracker
+                    tracker = OPENCV_OBJECT_TRACKERS[args["tracker"]]()
+
+                    trackers.add(tracker, frame, box)
+
+
+                # if the `q` key was pressed, break from the loop
+                elif key == ord("q"):
+                    break
+
+
+            tracking_loop_fps.update()
+
+            # Done with this frame. Give its slot back to the ring buffer
+            tracking_ring.release(frame_dict["slot"])
+                
 
             
             # -> while run_tracking_loop.value:
@@ -1084,19 +1238,26 @@ def detection_loop():
         else:
             return
             
+        # One long-lived pool for the life of the loop. Up to 'num_workers' detection requests are kept in flight at once ...
+        # ... and each one puts its result in o_queue tagged with its frame number as soon as it comes back
+        max_detections_in_flight = max(1, args['num_workers'])
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_detections_in_flight)
+        detections_in_flight = set()
+
         while run_detection_loop.value:
 
             try:
-                if not i_queue.empty():
+                # Forget the detections that have already finished
+                detections_in_flight = {future for future in detections_in_flight if not future.done()}
 
-                    frame_number, frame, frame_timestamp = i_queue.get(block=False)
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                        #if not o_queue.full(): # If o_queue is full the tracker isn't moving fast enough and to avoid memory problems, we'll just drop frames
-                        #before_executor = time.time()
-                        executor.submit(get_detections, frame_number, frame, frame_timestamp, no_callback=True)
-                        #print("Executor Time:", time.time()-before_executor)
+                if len(detections_in_flight) >= max_detections_in_flight:
+                    # Every worker is busy. Wait for one to finish instead of taking more frames from i_queue
+                    concurrent.futures.wait(detections_in_flight, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+                    continue
 
-                else:
+                try:
+                    frame_number, detection_slot, tracking_slot, frame_timestamp = i_queue.get(timeout=1)
+                except Empty:
                     try:
                         if int((datetime.now() - idle_since).total_seconds()) > 40: # If this loop has been idle
                             idle_since = datetime.now()
@@ -1109,16 +1270,18 @@ def detection_loop():
                     except:
                         idle_since = datetime.now()
 
-                        
+                    continue
+
+                detections_in_flight.add(executor.submit(get_detections, frame_number, detection_slot, tracking_slot, frame_timestamp, no_callback=True))
 
-            except Empty:
-                print("i_queue empty error")                        
             except KeyboardInterrupt:
                 raise                
             except:
                 import traceback
                 traceback.print_exc()
 
+        executor.shutdown(wait=False)
+
     except KeyboardInterrupt:
         import traceback
         traceback.print_exc()
@@ -1218,18 +1381,27 @@ try:
             #if main_fps._numFrames == 0 or main_fps._numFrames % main_fps_divisor == 0:
 
 
-            if main_fps._numFrames == 0 or (datetime.now() - last_i_queue_put).total_seconds() > 3:
+            if main_fps._numFrames == 0 or (datetime.now() - last_i_queue_put).total_seconds() > args['detection_interval']:
                 
              
                 # Put frame in i_queue to wait for asynchronous object detection
                 if not o_queue_exceeds_safe_threshold(): # Since all extant i_queue frames eventually go into o_queue and if o_queue exceeds maxsize, program will stop
                     #print("Putting frame in i_queue")
-                    i_queue.put((main_fps._numFrames, large_frame, frame_timestamp))
+                    tracking_slot = tracking_ring.put(frame)
+                    detection_slot = None if tracking_slot is None else detection_ring.put(large_frame)
+
+                    if detection_slot is not None:
+                        i_queue.put((main_fps._numFrames, detection_slot, tracking_slot, frame_timestamp))
+                    elif tracking_slot is not None: # Every detection slot is in use. Just use this frame for tracking
+                        o_queue.put((main_fps._numFrames, {"detected": 0, "slot": tracking_slot, "frame_timestamp": frame_timestamp}))
                     
-                    if main_fps._numFrames == 0:
-                        first_frame_detected = True
+                    if tracking_slot is not None:
+                        if main_fps._numFrames == 0:
+                            first_frame_detected = True
 
-                    main_fps.update()
+                        main_fps.update()
+                    else:
+                        print("tracking_ring full. Can't add new frame")
                 else:
                     try:
                         if int((datetime.now() - i_queue_notice_since).total_seconds()) > 40:
@@ -1252,16 +1424,20 @@ try:
 
 
             else: # ... then don't perform detection on frame but just use for tracking (tracklet association) 
+                tracking_slot = None
                 if not o_queue_exceeds_safe_threshold(): # Skipping when it's 90% full. The remaining 10% is given to detected frames
-                    # store frame in output queue
-                    o_queue.put((main_fps._numFrames, {"detected": 0, "frame": frame, "frame_timestamp": frame_timestamp}))
+                    # store frame in the tracking ring buffer and its slot in output queue
+                    tracking_slot = tracking_ring.put(frame)
+
+                if tracking_slot is not None:
+                    o_queue.put((main_fps._numFrames, {"detected": 0, "slot": tracking_slot, "frame_timestamp": frame_timestamp}))
                     main_fps.update()
                 else:
 
                     try:
                         if int((datetime.now() - printout_since).total_seconds()) > 30:
                             printout_since = datetime.now()
-                            print("o_queue 90% full...")
+                            print("o_queue 90% full or tracking_ring full...")
                             print("...Can't add new frames to o_queue")
                     except:
                         printout_since = datetime.now()
@@ -1322,6 +1498,8 @@ finally:
 
     print("STOPPING SOCKET SERVER tracklets_socket_server")
     run_tracklets_socket_server.value = 0
+
+    print("Tracklets writer: "+str(tracklets_committed_objects.value)+" objects committed, backlog "+str(tracklets_backlog.value)+" objects, last commit "+str(round(tracklets_commit_latency_ms.value, 1))+" ms")
     
     print("STOPPING SOCKET SERVER calibration_socket_server")
     rw.calibration_socket_server.stop(timeout=3)
@@ -1339,6 +1517,10 @@ finally:
         tsl.terminate()
 
 
+    print("RELEASING SHARED MEMORY FRAME RING BUFFERS")
+    detection_ring.close()
+    tracking_ring.close()
+
     print("CLOSE LEVELDB tracklets DATABASE")
     tracklets_db.close() # can't close prefixed database
     print("CLOSE LEVELDB node DATABASE")
@@ -0,0 +1,255 @@
+# import the necessary packages
+from scipy.spatial import distance as dist
+from pyimagesearch import association
+from pyimagesearch import motionmodel
+import numpy as np
+import uuid
+
+# per-object arrays, one row per tracked object
+COLUMNS = ("objectIDs", "frameTimestamps", "detectionClassIDs", "centroids", "boxoids", "disappeared",
+    "states", "covariances", "stateTimestamps")
+
+class ArrayCentroidTracker:
+    # Same tracking behaviour as CentroidTracker but every tracked object is a
+    # row in preallocated numpy arrays instead of a tuple in an OrderedDict, so
+    # an update is a handful of array operations no matter how many objects and
+    # input rectangles there are
+    def __init__(self, maxDisappeared=50, maxDistance=50, initialCapacity=64, associationMethod="greedy", useIoU=False, minIoU=0.1,
+            motionModel=False, accelerationVariance=400.0, measurementVariance=25.0, velocityVariance=10000.0):
+        # number of rows currently in use. Rows [0, count) are the tracked objects
+        self.count = 0
+
+        # allocate the per-object state. The arrays grow (doubling) when
+        # more objects need to be registered than there's room for
+        self.objectIDs = np.empty(initialCapacity, dtype=object)
+        self.frameTimestamps = np.zeros(initialCapacity, dtype="int64")
+        self.detectionClassIDs = np.zeros(initialCapacity, dtype="int64")
+        self.centroids = np.zeros((initialCapacity, 2), dtype="int64")
+        self.boxoids = np.zeros((initialCapacity, 4), dtype="float")
+        self.disappeared = np.zeros(initialCapacity, dtype="int64")
+
+        # constant velocity Kalman filter state (x, y, vx, vy) of each object,
+        # its covariance and the frame timestamp (milliseconds) it refers to
+        self.states = np.zeros((initialCapacity, 4), dtype="float")
+        self.covariances = np.zeros((initialCapacity, 4, 4), dtype="float")
+        self.stateTimestamps = np.zeros(initialCapacity, dtype="int64")
+
+        # map each object ID to its row
+        self.index = {}
+
+        # store the number of maximum consecutive frames a given
+        # object is allowed to be marked as "disappeared" until we
+        # need to deregister the object from tracking
+        self.maxDisappeared = maxDisappeared
+
+        # store the maximum distance between centroids to associate
+        # an object -- if the distance is larger than this maximum
+        # distance we'll start to mark the object as "disappeared"
+        self.maxDistance = maxDistance
+
+        # "greedy" matches each object to its nearest input the same way
+        # CentroidTracker does. "optimal" only compares objects and inputs
+        # that are within maxDistance of each other (using a spatial grid)
+        # and solves the assignment with the smallest total cost. With
+        # useIoU the cost is how little the stored boxoids overlap instead
+        # of the centroid distance
+        if associationMethod not in ("greedy", "optimal"):
+            raise ValueError("associationMethod must be 'greedy' or 'optimal'")
+        self.associationMethod = associationMethod
+        self.useIoU = useIoU
+        self.minIoU = minIoU
+
+        # with the motion model on, objects are matched against where they
+        # are predicted to be at the new frame's timestamp instead of where
+        # they were last seen, so they keep moving (coast) through the frames
+        # they're missed in. Variances are in pixels and seconds
+        self.motionModel = motionModel
+        self.accelerationVariance = accelerationVariance
+        self.measurementVariance = measurementVariance
+        self.velocityVariance = velocityVariance
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, objectID):
+        return objectID in self.index
+
+    def _grow(self, needed):
+        capacity = self.objectIDs.shape[0]
+        if needed <= capacity:
+            return
+
+        newCapacity = max(needed, capacity * 2)
+        for name in COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros((newCapacity,) + old.shape[1:], dtype=old.dtype) if old.dtype != object else np.empty(newCapacity, dtype=object)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def register(self, frameTimestamp, detectionClassIDs, centroids, boxoids):
+        # register every row of the input arrays as a new object, each
+        # with a new unique object ID
+        n = centroids.shape[0]
+        if n == 0:
+            return
+
+        self._grow(self.count + n)
+        start, end = self.count, self.count + n
+
+        newIDs = [uuid.uuid4().hex for _ in range(n)] # https://stackoverflow.com/a/534847
+        self.objectIDs[start:end] = newIDs
+        self.frameTimestamps[start:end] = frameTimestamp
+        self.detectionClassIDs[start:end] = detectionClassIDs
+        self.centroids[start:end] = centroids
+        self.boxoids[start:end] = boxoids
+        self.disappeared[start:end] = 0
+
+        self.states[start:end], self.covariances[start:end] = motionmodel.initial_states(centroids,
+            self.measurementVariance, self.velocityVariance)
+        self.stateTimestamps[start:end] = frameTimestamp
+
+        self.index.update(zip(newIDs, range(start, end)))
+        self.count = end
+
+    def deregister(self, mask):
+        # remove the objects whose row is True in 'mask' by compacting the
+        # remaining rows to the front of the arrays
+        if not mask.any():
+            return
+
+        keep = np.flatnonzero(~mask)
+        n = keep.shape[0]
+        for name in COLUMNS:
+            arr = getattr(self, name)
+            arr[:n] = arr[keep]
+
+        self.objectIDs[n:self.count] = None
+        self.count = n
+        self.index = dict(zip(self.objectIDs[:n].tolist(), range(n)))
+
+    def associate(self, objectCentroids, objectBoxoids, inputCentroids, inputBoxoids):
+        if self.associationMethod == "optimal":
+            return association.associate(objectCentroids, objectBoxoids, inputCentroids, inputBoxoids,
+                self.maxDistance, useIoU=self.useIoU, minIoU=self.minIoU)
+
+        return self.associate_greedy(objectCentroids, inputCentroids)
+
+    def associate_greedy(self, objectCentroids, inputCentroids):
+        # compute the distance between each pair of object
+        # centroids and input centroids, respectively -- our
+        # goal will be to match an input centroid to an existing
+        # object centroid
+        D = dist.cdist(objectCentroids, inputCentroids)
+
+        # sort the rows by their smallest value so that the row with the
+        # smallest distance is at the *front* and give each row its
+        # nearest column
+        rows = D.min(axis=1).argsort()
+        cols = D.argmin(axis=1)[rows]
+
+        # if the distance between centroids is greater than the maximum
+        # distance, do not associate the two centroids to the same object
+        close = D[rows, cols] <= self.maxDistance
+        rows, cols = rows[close], cols[close]
+
+        # a column only goes to the first (closest) row that wants it. This
+        # is the same result as CentroidTracker's usedRows/usedCols loop
+        _, first = np.unique(cols, return_index=True)
+        return rows[first], cols[first]
+
+    def update(self, rects, detectionsInput=False):
+        # rects is a list of (startX, startY, endX, endY, frame_timestamp, detection_class_id)
+        # tuples or an equivalent (N, 6) array
+        rects = np.asarray(rects, dtype="float").reshape(-1, 6)
+        n = self.count
+
+        # check to see if the list of input bounding box rectangles
+        # is empty
+        if rects.shape[0] == 0:
+            # mark every existing tracked object as disappeared and
+            # deregister the ones that have been missing for too long
+            self.disappeared[:n] += 1
+            self.deregister(self.disappeared[:n] > self.maxDisappeared)
+            return self
+
+        # use the bounding box coordinates to derive the centroids
+        inputCentroids = ((rects[:, 0:2] + rects[:, 2:4]) / 2.0).astype("int64")
+        inputBoxoids = rects[:, 0:4]
+        inputDetectionClassIDs = rects[:, 5].astype("int64")
+        frameTimestamp = int(rects[-1, 4]) # Will be the same for all items in rects
+
+        # if we are currently not tracking any objects take the input
+        # centroids and register each of them
+        if n == 0:
+            self.register(frameTimestamp, inputDetectionClassIDs, inputCentroids, inputBoxoids)
+            return self
+
+        objectCentroids = self.centroids[:n]
+        objectBoxoids = self.boxoids[:n]
+        if self.motionModel:
+            # predict every object forward to this frame and match the
+            # inputs against the predicted positions (boxoids are shifted
+            # along with their centroids)
+            objectCentroids = self.predict(frameTimestamp)
+            objectBoxoids = objectBoxoids + np.tile(objectCentroids - self.centroids[:n], 2)
+
+        rows, cols = self.associate(objectCentroids, objectBoxoids, inputCentroids, inputBoxoids)
+
+        if self.motionModel:
+            self.states[rows], self.covariances[rows] = motionmodel.correct(self.states[rows], self.covariances[rows],
+                inputCentroids[cols], self.measurementVariance)
+
+        # for each matched object set its new centroid and reset its
+        # disappeared counter
+        self.frameTimestamps[rows] = frameTimestamp
+        self.detectionClassIDs[rows] = inputDetectionClassIDs[cols]
+        self.centroids[rows] = inputCentroids[cols]
+        self.boxoids[rows] = inputBoxoids[cols]
+        self.disappeared[rows] = 0
+
+        unusedRows = np.ones(n, dtype=bool)
+        unusedRows[rows] = False
+        unusedCols = np.ones(inputCentroids.shape[0], dtype=bool)
+        unusedCols[cols] = False
+
+        # in the event that the number of object centroids is
+        # equal or greater than the number of input centroids
+        # we need to check and see if some of these objects have
+        # potentially disappeared
+        if n >= inputCentroids.shape[0]:
+            self.disappeared[:n][unusedRows] += 1
+
+            if detectionsInput:
+                # if the input was detection boxes, then mark for database
+                # deletion, those tracklets not acknowledged by detection
+                # boxes (objectless tracklets)
+                self.detectionClassIDs[:n][unusedRows] = -1 # Set detection_class_id to -1 to ignore tracklet
+            else:
+                # deregister the unmatched objects that have been marked
+                # "disappeared" for too many consecutive frames
+                self.deregister(unusedRows & (self.disappeared[:n] > self.maxDisappeared))
+
+        # otherwise, if the number of input centroids is greater
+        # than the number of existing object centroids we need to
+        # register each new input centroid as a trackable object
+        else:
+            self.register(frameTimestamp, inputDetectionClassIDs[unusedCols], inputCentroids[unusedCols], inputBoxoids[unusedCols])
+
+        return self
+
+    def predict(self, frameTimestamp):
+        # advance the motion model of every object to frameTimestamp and
+        # return the predicted centroids
+        n = self.count
+        dt = np.clip(frameTimestamp - self.stateTimestamps[:n], 0, None) / 1000.0
+        self.states[:n], self.covariances[:n] = motionmodel.predict(self.states[:n], self.covariances[:n],
+            dt, self.accelerationVariance)
+        self.stateTimestamps[:n] = np.maximum(self.stateTimestamps[:n], frameTimestamp)
+        return self.states[:n, 0:2]
+
+    def visible(self):
+        # return the objects that were seen in the latest update as
+        # (objectIDs, frameTimestamps, detectionClassIDs, centroids, boxoids)
+        rows = np.flatnonzero(self.disappeared[:self.count] == 0)
+        return (self.objectIDs[rows], self.frameTimestamps[rows], self.detectionClassIDs[rows],
+            self.centroids[rows], self.boxoids[rows])
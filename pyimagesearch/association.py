@@ -0,0 +1,128 @@
+# import the necessary packages
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import numpy as np
+
+# offset added to the grid cell coordinates so predicted positions that
+# are slightly off the frame (negative) still get a valid cell key
+GRID_OFFSET = 1 << 20
+
+def grid_keys(points, cellSize):
+    # the key of the square grid cell each point falls in
+    cells = np.floor(points / cellSize).astype("int64") + GRID_OFFSET
+    return cells[:, 0] * (GRID_OFFSET * 4) + cells[:, 1]
+
+def gated_candidate_pairs(objectCentroids, inputCentroids, maxDistance):
+    # put the input centroids in a grid of maxDistance sized cells. Any
+    # input within maxDistance of an object is in the object's cell or
+    # one of the 8 cells around it, so only those are compared instead of
+    # computing the full object x input distance matrix
+    objectCentroids = np.asarray(objectCentroids, dtype="float").reshape(-1, 2)
+    inputCentroids = np.asarray(inputCentroids, dtype="float").reshape(-1, 2)
+    empty = (np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64"), np.zeros(0, dtype="float"))
+    if objectCentroids.shape[0] == 0 or inputCentroids.shape[0] == 0:
+        return empty
+
+    cellSize = max(float(maxDistance), 1e-9)
+    inputKeys = grid_keys(inputCentroids, cellSize)
+    order = np.argsort(inputKeys, kind="stable")
+    sortedKeys = inputKeys[order]
+
+    objectKeys = grid_keys(objectCentroids, cellSize)
+    objectIndexes = np.arange(objectCentroids.shape[0])
+
+    allRows = []
+    allCols = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbourKeys = objectKeys + dx * (GRID_OFFSET * 4) + dy
+            lo = np.searchsorted(sortedKeys, neighbourKeys, side="left")
+            hi = np.searchsorted(sortedKeys, neighbourKeys, side="right")
+            counts = hi - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+
+            # expand each object's [lo, hi) range of sorted inputs into pairs
+            rows = np.repeat(objectIndexes, counts)
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            allRows.append(rows)
+            allCols.append(order[np.arange(total) + starts])
+
+    if not allRows:
+        return empty
+
+    rows = np.concatenate(allRows)
+    cols = np.concatenate(allCols)
+    distances = np.hypot(*(objectCentroids[rows] - inputCentroids[cols]).T)
+
+    close = distances <= maxDistance
+    return rows[close], cols[close], distances[close]
+
+def pair_iou(boxesA, boxesB):
+    # intersection over union of each (boxesA[i], boxesB[i]) pair of
+    # (startX, startY, endX, endY) boxes
+    boxesA = np.asarray(boxesA, dtype="float").reshape(-1, 4)
+    boxesB = np.asarray(boxesB, dtype="float").reshape(-1, 4)
+    width = np.minimum(boxesA[:, 2], boxesB[:, 2]) - np.maximum(boxesA[:, 0], boxesB[:, 0])
+    height = np.minimum(boxesA[:, 3], boxesB[:, 3]) - np.maximum(boxesA[:, 1], boxesB[:, 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    areaA = (boxesA[:, 2] - boxesA[:, 0]) * (boxesA[:, 3] - boxesA[:, 1])
+    areaB = (boxesB[:, 2] - boxesB[:, 0]) * (boxesB[:, 3] - boxesB[:, 1])
+    union = areaA + areaB - intersection
+    return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0.0)
+
+def optimal_assignment(rows, cols, costs, numRows, numCols):
+    # solve the minimum cost one-to-one assignment over the candidate
+    # (row, col) pairs only. The pairs split into independent blocks
+    # (connected components of the row/col graph) and each block is solved
+    # with the Hungarian algorithm on its own small dense cost matrix
+    if rows.shape[0] == 0:
+        return rows, cols
+
+    graph = coo_matrix((np.ones(rows.shape[0]), (rows, cols + numRows)), shape=(numRows + numCols, numRows + numCols))
+    _, labels = connected_components(graph, directed=False)
+    pairLabels = labels[rows]
+
+    # blocks with a single candidate pair are matched directly
+    pairsPerBlock = np.bincount(pairLabels, minlength=labels.max() + 1)
+    single = pairsPerBlock[pairLabels] == 1
+    matchedRows = [rows[single]]
+    matchedCols = [cols[single]]
+
+    contested = np.flatnonzero(~single)
+    if contested.shape[0] > 0:
+        order = contested[np.argsort(pairLabels[contested], kind="stable")]
+        splits = np.flatnonzero(np.diff(pairLabels[order])) + 1
+        for block in np.split(order, splits):
+            blockRows, rowIndexes = np.unique(rows[block], return_inverse=True)
+            blockCols, colIndexes = np.unique(cols[block], return_inverse=True)
+
+            # a pair that isn't a candidate costs more than all the real pairs
+            # in the block together, so as many pairs as possible get matched
+            notCandidate = costs[block].sum() + 1
+            C = np.full((blockRows.shape[0], blockCols.shape[0]), notCandidate)
+            C[rowIndexes, colIndexes] = costs[block]
+
+            r, c = linear_sum_assignment(C)
+            real = C[r, c] < notCandidate
+            matchedRows.append(blockRows[r[real]])
+            matchedCols.append(blockCols[c[real]])
+
+    return np.concatenate(matchedRows), np.concatenate(matchedCols)
+
+def associate(objectCentroids, objectBoxoids, inputCentroids, inputBoxoids, maxDistance, useIoU=False, minIoU=0.1):
+    # match objects to inputs within maxDistance of each other with the
+    # smallest total centroid distance or, with useIoU, the largest total
+    # box overlap. Returns the matched (rows, cols)
+    rows, cols, distances = gated_candidate_pairs(objectCentroids, inputCentroids, maxDistance)
+
+    if useIoU:
+        iou = pair_iou(np.asarray(objectBoxoids)[rows], np.asarray(inputBoxoids)[cols])
+        overlapping = iou >= minIoU
+        rows, cols, costs = rows[overlapping], cols[overlapping], 1.0 - iou[overlapping]
+    else:
+        costs = distances
+
+    return optimal_assignment(rows, cols, costs, len(objectCentroids), len(inputCentroids))
@@ -0,0 +1,53 @@
+# import the necessary packages
+import numpy as np
+
+# Constant velocity Kalman filter for many objects at once. Each object's
+# state is a row (x, y, vx, vy) in pixels and pixels/second with a 4x4
+# covariance, and every step is a batched numpy operation over all rows
+# (https://en.wikipedia.org/wiki/Kalman_filter)
+
+# measurement matrix: only the position is observed
+H = np.array([[1., 0., 0., 0.],
+              [0., 1., 0., 0.]])
+
+def initial_states(centroids, positionVariance, velocityVariance):
+    # start new objects at their measured centroid, not moving, with
+    # a large uncertainty in the velocity
+    n = centroids.shape[0]
+    states = np.zeros((n, 4), dtype="float")
+    states[:, 0:2] = centroids
+    covariances = np.zeros((n, 4, 4), dtype="float")
+    covariances[:, [0, 1], [0, 1]] = positionVariance
+    covariances[:, [2, 3], [2, 3]] = velocityVariance
+    return states, covariances
+
+def predict(states, covariances, dt, accelerationVariance):
+    # move every state forward by its own dt (seconds). The process noise
+    # is a random (white noise) acceleration with the given variance
+    dt = np.asarray(dt, dtype="float").reshape(-1)
+    n = states.shape[0]
+
+    F = np.tile(np.eye(4), (n, 1, 1))
+    F[:, 0, 2] = dt
+    F[:, 1, 3] = dt
+
+    dt2 = dt * dt
+    Q = np.zeros((n, 4, 4), dtype="float")
+    Q[:, [0, 1], [0, 1]] = (dt2 * dt2 / 4)[:, None]
+    Q[:, [0, 1, 2, 3], [2, 3, 0, 1]] = (dt2 * dt / 2)[:, None]
+    Q[:, [2, 3], [2, 3]] = dt2[:, None]
+    Q *= accelerationVariance
+
+    states = np.einsum("nij,nj->ni", F, states)
+    covariances = F @ covariances @ F.transpose(0, 2, 1) + Q
+    return states, covariances
+
+def correct(states, covariances, measurements, measurementVariance):
+    # fold the measured centroids into the predicted states
+    residuals = measurements - states[:, 0:2]
+    S = covariances[:, 0:2, 0:2] + measurementVariance * np.eye(2)
+    K = covariances[:, :, 0:2] @ np.linalg.inv(S)
+
+    states = states + np.einsum("nij,nj->ni", K, residuals)
+    covariances = covariances - K @ covariances[:, 0:2, :]
+    return states, covariances
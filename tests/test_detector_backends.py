@@ -0,0 +1,52 @@
+import io
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import detector_backends
+
+
+def test_http_backend_detects_through_local_server():
+    posted = []
+
+    def detect_function(jpeg_bytes):
+        posted.append(jpeg_bytes)
+        return {
+            "num_detections": 1,
+            "detection_boxes": [[0.1, 0.2, 0.5, 0.6]],
+            "detection_scores": [0.9],
+            "detection_classes": [3]
+        }
+
+    local_server = detector_backends.LocalDetectionServer(detect_function=detect_function).start()
+    try:
+        backend = detector_backends.HttpDetectorBackend(local_server.url, timeout=5)
+        backend.wakeup()
+
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        frame[10:20, 10:30] = (0, 0, 255)
+        output_dict = backend.detect(7, frame)
+    finally:
+        local_server.stop()
+
+    # The frame is encoded in memory and posted as the request body
+    assert len(posted) == 1
+    assert posted[0] == detector_backends.encode_frame(frame)
+    assert Image.open(io.BytesIO(posted[0])).size == (64, 48)
+
+    assert output_dict['num_detections'] == 1
+    assert isinstance(output_dict['detection_boxes'], np.ndarray)
+    assert output_dict['detection_boxes'].shape == (1, 4)
+    assert output_dict['detection_scores'].tolist() == [0.9]
+    assert output_dict['detection_classes'].tolist() == [3]
+
+
+def test_local_backend_returns_no_detections():
+    backend = detector_backends.create_detector_backend('local')
+    output_dict = backend.detect(1, np.zeros((16, 16, 3), dtype=np.uint8))
+    assert output_dict['num_detections'] == 0
+    assert output_dict['detection_boxes'].shape == (0,)
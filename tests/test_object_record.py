@@ -0,0 +1,67 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import s2cells
+import tracklets_store
+
+
+def round_trip(detection_class_id, cell_ids, frame_timestamps):
+    record = tracklets_store.object_record(detection_class_id, cell_ids, frame_timestamps)
+    return tracklets_store.parse_object_record(record)
+
+
+def test_negative_deltas():
+    # Moving west and south (cell IDs going down) and back, with out of order frame_timestamps
+    cell_ids = s2cells.cell_ids_from_lat_lng([45.40, 45.39, 45.38, 45.39], [-75.74, -75.75, -75.76, -75.70]).tolist()
+    frame_timestamps = [1600000000000, 1600000000033, 1600000000010, 1600000000066]
+    assert round_trip(3, cell_ids, frame_timestamps) == (3, cell_ids, frame_timestamps)
+
+
+def test_large_deltas():
+    # Cell IDs on opposite faces and frame_timestamps years apart, up to the largest 6 byte timestamp
+    cell_ids = s2cells.cell_ids_from_lat_lng([89.9, -89.9, 0.0, 45.39], [0.0, 179.9, -179.9, -75.75]).tolist()
+    frame_timestamps = [0, 1600000000000, 2**47, 2**48 - 1]
+    assert round_trip(1, cell_ids, frame_timestamps) == (1, cell_ids, frame_timestamps)
+
+
+def test_single_tracklet():
+    cell_ids = s2cells.cell_ids_from_lat_lng([45.39], [-75.75]).tolist()
+    assert round_trip(2, cell_ids, [1600000000000]) == (2, cell_ids, [1600000000000])
+
+
+def test_detection_class_id_limits():
+    cell_ids = s2cells.cell_ids_from_lat_lng([45.39, 45.391], [-75.75, -75.751]).tolist()
+    for detection_class_id in (0, 1, 255, 256, 0xffff):
+        assert round_trip(detection_class_id, cell_ids, [1000, 2000]) == (detection_class_id, cell_ids, [1000, 2000])
+
+
+def test_extreme_cell_ids():
+    # The smallest and largest leaf cell IDs, so the deltas between them need the most varint bytes
+    first_leaf = s2cells.cell_ids_from_face_ij([0], [0], [0]).tolist()[0]
+    last_leaf = s2cells.cell_ids_from_face_ij([5], [s2cells.MAX_SIZE - 1], [s2cells.MAX_SIZE - 1]).tolist()[0]
+    cell_ids = [last_leaf, first_leaf, last_leaf]
+    assert round_trip(7, cell_ids, [5, 6, 7]) == (7, cell_ids, [5, 6, 7])
+
+
+def test_random_trajectories():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n = int(rng.integers(1, 300))
+        lats = 45.39 + np.cumsum(rng.normal(0, 2e-4, n))
+        lngs = -75.75 + np.cumsum(rng.normal(0, 2e-4, n))
+        cell_ids = s2cells.cell_ids_from_lat_lng(lats, lngs).tolist()
+        frame_timestamps = (1600000000000 + np.cumsum(rng.integers(0, 100000, n))).tolist()
+        detection_class_id = int(rng.integers(0, 0x10000))
+        assert round_trip(detection_class_id, cell_ids, frame_timestamps) == (detection_class_id, cell_ids, frame_timestamps)
+
+
+def test_zigzag_and_varint():
+    for n in (0, 1, -1, 63, -64, 64, 2**31, -2**31, 2**62, -2**62):
+        assert tracklets_store.unzigzag(tracklets_store.zigzag(n)) == n
+        buffer = bytearray()
+        tracklets_store.append_varint(buffer, tracklets_store.zigzag(n))
+        assert tracklets_store.read_varint(buffer, 0) == (tracklets_store.zigzag(n), len(buffer))
@@ -0,0 +1,77 @@
+import math
+import os
+import sys
+
+import numpy as np
+import s2sphere
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import s2cells
+
+
+def edge_case_points():
+    # Poles, the antimeridian, the prime meridian, the equator and the edges and corners between cube faces, each also ...
+    # ... moved by one ulp either way
+    points = [(90.0, 0.0), (-90.0, 0.0), (90.0, 180.0), (-90.0, -180.0), (0.0, 0.0), (0.0, 180.0), (0.0, -180.0),
+        (45.39, 180.0), (-45.39, -180.0), (0.0, 90.0), (0.0, -90.0), (89.999999, 123.4), (-89.999999, -56.7)]
+    corner_lat = math.degrees(math.atan(1 / math.sqrt(2)))
+    for lng in (-180.0, -135.0, -90.0, -45.0, 0.0, 45.0, 90.0, 135.0, 180.0):
+        for lat in (-corner_lat, -45.0, 0.0, 45.0, corner_lat):
+            points.append((lat, lng))
+
+    moved_points = []
+    for lat, lng in points:
+        for move_lat in (-np.inf, 0, np.inf):
+            for move_lng in (-np.inf, 0, np.inf):
+                moved_lat = float(np.nextafter(lat, move_lat)) if move_lat else lat
+                moved_lng = float(np.nextafter(lng, move_lng)) if move_lng else lng
+                if -90 <= moved_lat <= 90 and -180 <= moved_lng <= 180:
+                    moved_points.append((moved_lat, moved_lng))
+    return moved_points
+
+
+def random_points(count=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    # Uniform over the sphere, plus a dense cluster like a camera's view
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, count)))
+    lngs = rng.uniform(-180, 180, count)
+    lats[:count//4] = 45.39 + rng.normal(0, 1e-3, count//4)
+    lngs[:count//4] = -75.75 + rng.normal(0, 1e-3, count//4)
+    return list(zip(lats.tolist(), lngs.tolist()))
+
+
+def s2sphere_cell_id(lat, lng):
+    return s2sphere.CellId.from_lat_lng(s2sphere.LatLng.from_degrees(lat, lng)).id()
+
+
+def test_cell_ids_from_lat_lng_match_s2sphere():
+    points = edge_case_points() + random_points()
+    lats, lngs = zip(*points)
+    cell_ids = s2cells.cell_ids_from_lat_lng(lats, lngs).tolist()
+    expected = [s2sphere_cell_id(lat, lng) for lat, lng in points]
+    mismatches = [(point, cell_id, expected_id) for point, cell_id, expected_id in zip(points, cell_ids, expected) if cell_id != expected_id]
+    assert mismatches == []
+
+
+def test_lat_lng_from_cell_ids_match_s2sphere():
+    points = edge_case_points() + random_points(seed=1)
+    cell_ids = [s2sphere_cell_id(lat, lng) for lat, lng in points]
+    lats, lngs = s2cells.lat_lng_from_cell_ids(cell_ids)
+    for cell_id, lat, lng in zip(cell_ids, lats.tolist(), lngs.tolist()):
+        center = s2sphere.CellId(cell_id).to_lat_lng()
+        assert (lat, lng) == (center.lat().degrees, center.lng().degrees)
+
+
+def test_parent_cell_ids_match_s2sphere():
+    points = edge_case_points() + random_points(count=2000, seed=2)
+    cell_ids = [s2sphere_cell_id(lat, lng) for lat, lng in points]
+    for level in (0, 1, 12, 16, 18, 29, 30):
+        parents = s2cells.parent_cell_ids(cell_ids, level).tolist()
+        assert parents == [s2sphere.CellId(cell_id).parent(level).id() for cell_id in cell_ids]
+
+
+def test_empty_arrays():
+    assert s2cells.cell_ids_from_lat_lng([], []).shape == (0,)
+    lats, lngs = s2cells.lat_lng_from_cell_ids([])
+    assert lats.shape == lngs.shape == (0,)
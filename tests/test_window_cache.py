@@ -0,0 +1,77 @@
+import os
+import sys
+
+import gevent
+from gevent.event import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from window_cache import WindowCache
+
+
+class SlowDatabase:
+    # Each load reads the database when it starts (like a snapshot) and finishes when its event is set
+    def __init__(self):
+        self.version = 0
+        self.releases = []
+
+    def load_bucket(self, bucket_timestamp, bucket_length):
+        version = self.version
+        release = Event()
+        self.releases.append(release)
+        release.wait()
+        return [{"object_id": "v"+str(version), "detection_class_id": 0, "tracklets": [[0.0, 0.0, bucket_timestamp]]}]
+
+
+def test_overlapping_loads_dont_cache_data_read_before_an_invalidation():
+    database = SlowDatabase()
+    cache = WindowCache(database.load_bucket, bucket_length=60000, max_buckets=10)
+
+    load_a = gevent.spawn(cache.load, 0)
+    load_b = gevent.spawn(cache.load, 0)
+    gevent.sleep(0)
+
+    # A commit into the bucket while both are loading
+    database.version = 1
+    cache.invalidate(1000, 2000)
+
+    database.releases[0].set()
+    load_a.join()
+    load_c = gevent.spawn(cache.load, 0)
+    gevent.sleep(0)
+
+    database.releases[1].set()
+    load_b.join()
+    assert 0 not in cache.buckets
+
+    database.releases[2].set()
+    load_c.join()
+    assert cache.buckets[0][0]['object_id'] == 'v1'
+
+
+def test_load_after_clear_started_before_it_isnt_cached():
+    database = SlowDatabase()
+    cache = WindowCache(database.load_bucket, bucket_length=60000, max_buckets=10)
+
+    load = gevent.spawn(cache.load, 0)
+    gevent.sleep(0)
+    cache.clear()
+    database.releases[0].set()
+    load.join()
+    assert 0 not in cache.buckets
+
+
+def test_invalidation_bookkeeping_is_dropped_when_loads_finish():
+    database = SlowDatabase()
+    cache = WindowCache(database.load_bucket, bucket_length=60000, max_buckets=10)
+
+    load = gevent.spawn(cache.load, 0)
+    gevent.sleep(0)
+    for minute in range(1000):
+        cache.invalidate(minute * 60000, minute * 60000 + 1)
+    assert list(cache.invalidated_at) == [0]
+
+    database.releases[0].set()
+    load.join()
+    assert cache.loads_in_flight == {}
+    assert cache.invalidated_at == {}
@@ -0,0 +1,113 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+from collections import deque
+import uuid
+import numpy as np
+import wire_protocol
+
+
+class TrackletsFeed:
+    '''
+    Live tail of the tracklets database. Every trackable object the tracklets loop commits is published here and pushed to each
+    subscriber (in the query result format) so a live view gets only the new objects instead of re-querying time windows.
+
+    Each published object gets the next sequence number. A subscriber is sent a resume token, '<feed ID>:<sequence number>',
+    with every message and can resubscribe with the last one it got after a reconnect. The objects it missed are replayed from a
+    ring of the most recent 'ring_size' objects. The feed ID changes whenever the tracklets loop starts. If the token is from an
+    earlier feed or older than the ring the subscriber is told to 'resync' (query the time window it missed) instead.
+
+    Messages pushed to subscribers:
+        {"token": "<feed ID>:<sequence number>", "objects": [trackable objects]}
+        {"token": "<feed ID>:<sequence number>", "objects": [], "resync": true}
+    '''
+    def __init__(self, ring_size=10000, max_pending=1000):
+        self.feed_id = uuid.uuid4().hex[:12]
+        self.sequence = 0
+        self.ring = deque(maxlen=ring_size) # (sequence number, trackable object)
+        self.max_pending = max_pending
+        self.subscribers = set()
+
+
+    def token(self):
+        return self.feed_id+':'+str(self.sequence)
+
+
+    def parse_token(self, resume_token):
+        # The sequence number of a token from this feed, or None
+        feed_id, _, sequence = str(resume_token).partition(':')
+        if feed_id != self.feed_id or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+
+    def publish(self, trackable_objects):
+        # Called with the objects of each commit, after it's been written
+        if not trackable_objects:
+            return
+
+        for trackable_object in trackable_objects:
+            self.sequence += 1
+            self.ring.append((self.sequence, trackable_object))
+
+        token = self.token()
+        for subscription in list(self.subscribers):
+            objects = subscription.filter(trackable_objects)
+            if objects:
+                subscription.push({"token": token, "objects": objects})
+
+
+    def subscribe(self, resume_token=None, region=None, object_filter=None):
+        # Returns a subscription (a wire_protocol.PushStream) whose first message is the objects missed since 'resume_token' ...
+        # ... (none without a token), a resync or nothing new yet
+        subscription = Subscription(region, object_filter, self.max_pending)
+        subscription.on_close = lambda: self.subscribers.discard(subscription)
+
+        sequence = self.parse_token(resume_token) if resume_token else self.sequence
+        oldest_sequence = self.ring[0][0] if self.ring else self.sequence + 1
+        if sequence is None or sequence > self.sequence or sequence < oldest_sequence - 1:
+            subscription.push({"token": self.token(), "objects": [], "resync": True})
+        else:
+            missed_objects = [trackable_object for object_sequence, trackable_object in self.ring if object_sequence > sequence]
+            subscription.push({"token": self.token(), "objects": subscription.filter(missed_objects)})
+
+        self.subscribers.add(subscription)
+        return subscription
+
+
+
+class Subscription(wire_protocol.PushStream):
+    def __init__(self, region=None, object_filter=None, max_pending=1000):
+        super().__init__(max_pending)
+        self.region = region
+        self.object_filter = object_filter # a tracklets_store.ObjectFilter
+
+
+    def filter(self, trackable_objects):
+        # The objects the subscription's object_filter accepts with tracklets in its region, with only those tracklets
+        if self.object_filter is not None:
+            trackable_objects = self.object_filter.filter(trackable_objects)
+        if self.region is None or not trackable_objects:
+            return trackable_objects
+
+        points = np.array([tracklet[0:2] for trackable_object in trackable_objects for tracklet in trackable_object['tracklets']], dtype=float).reshape(-1, 2)
+        inside = self.region.contains(points[:, 0], points[:, 1]).tolist()
+
+        filtered_objects = []
+        position = 0
+        for trackable_object in trackable_objects:
+            count = len(trackable_object['tracklets'])
+            tracklets = [tracklet for tracklet, is_inside in zip(trackable_object['tracklets'], inside[position:position+count]) if is_inside]
+            position += count
+            if tracklets:
+                filtered_objects.append(dict(trackable_object, tracklets=tracklets))
+        return filtered_objects
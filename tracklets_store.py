@@ -0,0 +1,952 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+import time
+import numpy as np
+import s2sphere
+import s2cells
+
+
+#### !!! WARNING !!! --> Store s2sphere in bigendian format to order bytes lexicographically in LevelDB
+s2sphere_byteorder = 'big'
+
+'''
+Key layout inside an eon partition
+
+The primary tracklet keys are the 8 byte s2sphere cell ID followed by the 6 byte frame_timestamp so points are ordered spatially.
+An s2sphere cell ID never starts with a byte above 0xBF (the face number in its top 3 bits is at most 5) so every secondary
+keyspace below uses a first byte of 0xC0 or higher. They can share the eon partition with the cell-primary keys and will never
+show up inside a cell range scan.
+'''
+TIME_INDEX_KEYSPACE = b'\xf0' # frame_timestamp (6 bytes) + cell ID (8 bytes) -> objectID (16 bytes) + detection_class_id (2 bytes)
+
+'''
+Object-primary layout
+
+Instead of one entry per tracklet point, each completed object is a single record:
+    start frame_timestamp (6 bytes) + detection_class_id (2 bytes) + number of points (varint) + the points
+Each point is a (cell ID, frame_timestamp) pair stored as the zigzag encoded difference from the previous point's values,
+packed as varints (https://developers.google.com/protocol-buffers/docs/encoding#varints). Consecutive points of an object
+are close in space and time so most differences fit in a few bytes. The first point's differences are from 0 and start time.
+
+The time index has an entry for every minute an object spans and the space index one for every minute and coarse cell it has
+points in, minute first so a region query reads only the minutes of its time window. Both are keys only and point to the
+object record.
+'''
+OBJECT_KEYSPACE = b'\xf1' # objectID (16 bytes) -> object record
+OBJECT_TIME_INDEX_KEYSPACE = b'\xf2' # minute since the epoch (4 bytes) + objectID (16 bytes) -> b''
+OBJECT_SPACE_INDEX_KEYSPACE = b'\xf3' # minute since the epoch (4 bytes) + coarse cell ID (8 bytes) + objectID (16 bytes) -> b''
+
+OBJECT_TIME_INDEX_BUCKET = 60000 # milliseconds
+OBJECT_SPACE_INDEX_LEVEL = 18 # S2 cell level of the space index. Level 18 cells are about 35 metres across
+
+STORAGE_LAYOUTS = ['tracklets', 'objects', 'both']
+
+'''
+Rollups
+
+Counts kept up to date as each completed object is written, whatever the storage layout, so "how many cars passed here in the
+last hour" is answered from a few rollup records instead of every tracklet. For each minute, coarse cell and detection_class_id
+there's a record of how many objects were in that cell during that minute and how many tracklet points they had there.
+'''
+ROLLUP_KEYSPACE = b'\xf4' # minute since the epoch (4 bytes) + coarse cell ID (8 bytes) + detection_class_id (2 bytes) -> object count (varint) + tracklet count (varint)
+
+'''
+Object spans
+
+A small entry per object, whatever the storage layout, with the time span it has tracklets in and its detection_class_id. A query
+for particular objects reads the time index over just their spans instead of the whole window.
+'''
+OBJECT_SPAN_KEYSPACE = b'\xf5' # objectID (16 bytes) -> first frame_timestamp (6 bytes) + last frame_timestamp (6 bytes) + detection_class_id (2 bytes)
+
+ROLLUP_BUCKET = 60000 # milliseconds
+ROLLUP_LEVEL = 16 # S2 cell level of the rollups. Level 16 cells are about 150 metres across
+
+CELL_ID_BYTES = 8
+CELL_ID_LEVEL = 30 # Tracklets are stored under their leaf cell
+TIMESTAMP_BYTES = 6
+OBJECT_ID_BYTES = 16
+MINUTE_BYTES = 4
+
+YIELD_EVERY = 1000 # Rows or objects a query loop handles between yield points
+
+
+
+def yielding(iterable, every=YIELD_EVERY):
+    # Yields the items of 'iterable', letting other threads run every 'every' items. Queries run in a query thread so the ...
+    # ... greenlets in the main thread (the writer, other requests) get the GIL between steps of a long loop, not only when ...
+    # ... the interpreter's switch interval makes the query thread give it up
+    for count, item in enumerate(iterable, start=1):
+        if count % every == 0:
+            time.sleep(0)
+        yield item
+
+
+def timestamp_to_bytes(frame_timestamp):
+    return int(frame_timestamp).to_bytes(TIMESTAMP_BYTES, byteorder=s2sphere_byteorder)
+
+
+def cell_primary_key(cell_id, frame_timestamp):
+    # Take the s2sphere cell ID (a 64-bit integer) and convert it to an 8 byte big-endian Python bytes object and ...
+    # ... concatenate it with the timestamp. This is the LevelDB 'key'
+    return bytes(0).join( ( cell_id.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder), timestamp_to_bytes(frame_timestamp) ) )
+
+
+def time_index_key(frame_timestamp, cell_id):
+    # Same bytes as the cell-primary key but time first so a time window is one contiguous key range
+    return bytes(0).join( ( TIME_INDEX_KEYSPACE, timestamp_to_bytes(frame_timestamp), cell_id.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder) ) )
+
+
+def tracklet_value(object_id, detection_class_id):
+    # The LevelDB 'value' is the concatenation of the objectID (16 bytes) and its detection_class_id (2 bytes)
+    return bytes(0).join( ( bytes.fromhex(object_id), int(detection_class_id).to_bytes(2, byteorder=s2sphere_byteorder) ) )
+
+
+def put_tracklet(write_batch, cell_id, frame_timestamp, value):
+    # Write the cell-primary key and its time-primary index entry in the same batch so they're committed atomically
+    write_batch.put(cell_primary_key(cell_id, frame_timestamp), value)
+    write_batch.put(time_index_key(frame_timestamp, cell_id), value)
+
+
+def build_time_index(eon_db):
+    # Tracklets written before the time index existed only have a cell-primary key. This does a one time scan to index them
+    # Returns the number of index entries written
+    count = 0
+    if next(eon_db.iterator(prefix=TIME_INDEX_KEYSPACE, include_value=False), None) is not None:
+        return count # already indexed
+
+    with eon_db.write_batch() as wb:
+        for key, value in eon_db.iterator(stop=b'\xc0'): # cell-primary keys only
+            cell_id = int.from_bytes(key[0:CELL_ID_BYTES], byteorder=s2sphere_byteorder)
+            frame_timestamp = int.from_bytes(key[CELL_ID_BYTES:], byteorder=s2sphere_byteorder)
+            wb.put(time_index_key(frame_timestamp, cell_id), value)
+            count += 1
+
+    return count
+
+
+def iterate_time_window(eon_db, query_timestamp, query_range):
+    # Yields (cell_id, frame_timestamp, value) for each tracklet with query_timestamp <= frame_timestamp < query_timestamp+query_range
+    # The iterator is bounded by the window so its cost depends on the number of results, not the size of the database
+    start = TIME_INDEX_KEYSPACE + timestamp_to_bytes(max(query_timestamp, 0))
+    stop = TIME_INDEX_KEYSPACE + timestamp_to_bytes(max(query_timestamp + query_range, 0))
+
+    for key, value in eon_db.iterator(start=start, stop=stop):
+        key = key[len(TIME_INDEX_KEYSPACE):]
+        frame_timestamp = int.from_bytes(key[0:TIMESTAMP_BYTES], byteorder=s2sphere_byteorder)
+        cell_id = int.from_bytes(key[TIMESTAMP_BYTES:], byteorder=s2sphere_byteorder)
+        yield cell_id, frame_timestamp, value
+
+
+def query_time_window(eon_db, query_timestamp, query_range, storage_layout='tracklets', region=None, object_filter=None):
+    # Trackable objects with the tracklets in the time window (and in the region if one is given, and that 'object_filter' ...
+    # ... accepts). With the object layouts objects that only have per tracklet entries (written before, or with the ...
+    # ... 'tracklets' layout) are included too
+    if storage_layout == 'tracklets':
+        return query_tracklets_time_window(eon_db, query_timestamp, query_range, region, object_filter)
+
+    trackable_object_list = query_objects_time_window(eon_db, query_timestamp, query_range, region, object_filter)
+    if storage_layout == 'objects':
+        object_ids = set(trackable_object['object_id'] for trackable_object in trackable_object_list)
+        if object_filter is not None:
+            # Don't look for the objects that were found again
+            object_filter = object_filter.excluding(object_ids)
+            if object_filter.object_ids is not None and not object_filter.object_ids:
+                return trackable_object_list
+        trackable_object_list += [trackable_object for trackable_object in query_tracklets_time_window(eon_db, query_timestamp, query_range, region, object_filter)
+            if trackable_object['object_id'] not in object_ids]
+
+    return trackable_object_list
+
+
+def query_tracklets_time_window(eon_db, query_timestamp, query_range, region=None, object_filter=None):
+    if region is not None:
+        rows = iterate_region(eon_db, region, query_timestamp, query_range)
+    elif object_filter is not None and object_filter.object_ids is not None:
+        rows = iterate_objects_time_window(eon_db, object_filter.object_ids, query_timestamp, query_range)
+    else:
+        rows = iterate_time_window(eon_db, query_timestamp, query_range)
+
+    # The objectID and detection_class_id are compared as they're stored, so other objects' points are never decoded
+    if object_filter is not None:
+        rows = [row for row in yielding(rows) if object_filter.accepts_value(row[2])]
+    else:
+        rows = list(yielding(rows))
+
+    # Decode the centre lat/lng of every cell in one call
+    lats, lngs = s2cells.lat_lng_from_cell_ids([cell_id for cell_id, _, _ in rows])
+
+    if region is not None:
+        # The covering is bigger than the region. Only keep the tracklets that are actually in it
+        inside = region.contains(lngs, lats)
+        rows = [row for row, is_inside in zip(rows, inside.tolist()) if is_inside]
+        lats, lngs = lats[inside], lngs[inside]
+
+    # Group the tracklets in the time window by the objectID stored in their value
+    trackableObjects = {}
+    for (cell_id, frame_timestamp, value), lat, lng in yielding(zip(rows, lats.tolist(), lngs.tolist())):
+
+        object_id = value[0:16].hex()
+        if object_id in trackableObjects:
+            trackableObjects[object_id]['tracklets'].append([lng, lat, frame_timestamp])
+        else:
+            trackableObjects[object_id] = {
+                "object_id": object_id,
+                "detection_class_id": int.from_bytes(value[16:], byteorder=s2sphere_byteorder),
+                "tracklets": [
+                    [
+                        lng,
+                        lat,
+                        frame_timestamp
+                    ]
+                ]
+            }
+
+    if region is not None:
+        # A region's rows come in cell order, not time order
+        for trackableObject in trackableObjects.values():
+            trackableObject['tracklets'].sort(key=lambda tracklet: tracklet[2])
+
+    return list(trackableObjects.values())
+
+
+
+def zigzag(n):
+    # Map signed integers to unsigned so small negative differences stay small: 0, -1, 1, -2 ... -> 0, 1, 2, 3 ...
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def unzigzag(n):
+    return n >> 1 if n & 1 == 0 else -(n >> 1) - 1
+
+
+def append_varint(buffer, n):
+    # 7 bits per byte, least significant first. The high bit is set on every byte but the last
+    while n > 0x7f:
+        buffer.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buffer.append(n)
+
+
+def read_varint(buffer, position):
+    # Returns the varint at 'position' and the position after it
+    n = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, position
+        shift += 7
+
+
+def object_record(detection_class_id, cell_ids, frame_timestamps):
+    # Pack an object's (cell ID, frame_timestamp) points into one record
+    start_timestamp = frame_timestamps[0]
+    record = bytearray(timestamp_to_bytes(start_timestamp))
+    record += int(detection_class_id).to_bytes(2, byteorder=s2sphere_byteorder)
+    append_varint(record, len(cell_ids))
+
+    last_cell_id, last_timestamp = 0, start_timestamp
+    for cell_id, frame_timestamp in zip(cell_ids, frame_timestamps):
+        append_varint(record, zigzag(cell_id - last_cell_id))
+        append_varint(record, zigzag(frame_timestamp - last_timestamp))
+        last_cell_id, last_timestamp = cell_id, frame_timestamp
+
+    return bytes(record)
+
+
+def parse_object_record(record):
+    # Returns (detection_class_id, cell_ids, frame_timestamps)
+    start_timestamp = int.from_bytes(record[0:TIMESTAMP_BYTES], byteorder=s2sphere_byteorder)
+    detection_class_id = int.from_bytes(record[TIMESTAMP_BYTES:TIMESTAMP_BYTES+2], byteorder=s2sphere_byteorder)
+    count, position = read_varint(record, TIMESTAMP_BYTES+2)
+
+    cell_ids = []
+    frame_timestamps = []
+    cell_id, frame_timestamp = 0, start_timestamp
+    for _ in range(count):
+        delta, position = read_varint(record, position)
+        cell_id += unzigzag(delta)
+        delta, position = read_varint(record, position)
+        frame_timestamp += unzigzag(delta)
+        cell_ids.append(cell_id)
+        frame_timestamps.append(frame_timestamp)
+
+    return detection_class_id, cell_ids, frame_timestamps
+
+
+def object_time_index_key(minute, object_id_bytes):
+    return bytes(0).join( ( OBJECT_TIME_INDEX_KEYSPACE, minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder), object_id_bytes ) )
+
+
+def object_space_index_key(minute, coarse_cell_id, object_id_bytes):
+    return bytes(0).join( ( OBJECT_SPACE_INDEX_KEYSPACE, minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder),
+        coarse_cell_id.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder), object_id_bytes ) )
+
+
+def put_object_space_index(write_batch, object_id_bytes, cell_ids, frame_timestamps):
+    # One entry for each minute and coarse cell the object has points in
+    minutes = (np.asarray(frame_timestamps, dtype=np.int64) // OBJECT_TIME_INDEX_BUCKET).tolist()
+    for minute, coarse_cell_id in set(zip(minutes, s2cells.parent_cell_ids(cell_ids, OBJECT_SPACE_INDEX_LEVEL).tolist())):
+        write_batch.put(object_space_index_key(minute, coarse_cell_id, object_id_bytes), b'')
+
+
+def put_object(write_batch, object_id, detection_class_id, cell_ids, frame_timestamps):
+    # Write an object's record and its time and space index entries in the same batch
+    object_id_bytes = bytes.fromhex(object_id)
+    write_batch.put(OBJECT_KEYSPACE + object_id_bytes, object_record(detection_class_id, cell_ids, frame_timestamps))
+
+    # Every minute from the first point to the last, so a time window in a gap between points still finds the object
+    for minute in range(min(frame_timestamps) // OBJECT_TIME_INDEX_BUCKET, max(frame_timestamps) // OBJECT_TIME_INDEX_BUCKET + 1):
+        write_batch.put(object_time_index_key(minute, object_id_bytes), b'')
+
+    put_object_space_index(write_batch, object_id_bytes, cell_ids, frame_timestamps)
+
+
+def iterate_object_ids_in_time_window(eon_db, query_timestamp, query_range):
+    # Yields the objectID bytes of each object with a time index entry in the minutes the window touches. Each only once
+    first_minute = max(query_timestamp, 0) // OBJECT_TIME_INDEX_BUCKET
+    last_minute = max(query_timestamp + query_range - 1, 0) // OBJECT_TIME_INDEX_BUCKET
+    start = OBJECT_TIME_INDEX_KEYSPACE + first_minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder)
+    stop = OBJECT_TIME_INDEX_KEYSPACE + (last_minute + 1).to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder)
+
+    seen = set()
+    for key in eon_db.iterator(start=start, stop=stop, include_value=False):
+        object_id_bytes = key[len(OBJECT_TIME_INDEX_KEYSPACE)+MINUTE_BYTES:]
+        if object_id_bytes not in seen:
+            seen.add(object_id_bytes)
+            yield object_id_bytes
+
+
+def trackable_objects_from_records(object_records, query_timestamp=None, query_range=None, region=None):
+    # Turn (objectID bytes, record) pairs into the query result format. If a time window (or region) is given only the ...
+    # ... tracklets in it are kept and objects without any are dropped. The cells of every record are decoded in one call
+    parsed_records = [(object_id_bytes, parse_object_record(record)) for object_id_bytes, record in yielding(object_records, 100)]
+
+    lats, lngs = s2cells.lat_lng_from_cell_ids([cell_id for _, (_, cell_ids, _) in parsed_records for cell_id in cell_ids])
+    inside = (region.contains(lngs, lats) if region is not None else np.ones(lats.shape[0], dtype=bool)).tolist()
+    lats, lngs = lats.tolist(), lngs.tolist()
+
+    trackable_object_list = []
+    position = 0
+    for object_id_bytes, (detection_class_id, cell_ids, frame_timestamps) in yielding(parsed_records, 100):
+        tracklets = [
+            [lng, lat, frame_timestamp]
+            for lng, lat, frame_timestamp, is_inside in zip(lngs[position:position+len(cell_ids)], lats[position:position+len(cell_ids)], frame_timestamps, inside[position:position+len(cell_ids)])
+            if is_inside and (query_timestamp is None or query_timestamp <= frame_timestamp < query_timestamp + query_range)
+        ]
+        position += len(cell_ids)
+
+        if tracklets:
+            trackable_object_list.append({
+                "object_id": object_id_bytes.hex(),
+                "detection_class_id": detection_class_id,
+                "tracklets": tracklets
+            })
+
+    return trackable_object_list
+
+
+def query_objects_time_window(eon_db, query_timestamp, query_range, region=None, object_filter=None):
+    # Whole object records found through the time index, trimmed to the time window. No regrouping of tracklets by objectID
+    # With a region, only the objects the space index has in the region's covering during the window are read. With an ...
+    # ... object_filter that has objectIDs, only their records are read
+    if object_filter is not None and object_filter.object_ids is not None:
+        object_ids = object_filter.object_ids
+        if region is not None:
+            region_object_ids = set(iterate_object_ids_in_region(eon_db, region, query_timestamp, query_range))
+            object_ids = [object_id_bytes for object_id_bytes in object_ids if object_id_bytes in region_object_ids]
+    elif region is not None:
+        object_ids = iterate_object_ids_in_region(eon_db, region, query_timestamp, query_range)
+    else:
+        object_ids = iterate_object_ids_in_time_window(eon_db, query_timestamp, query_range)
+
+    object_records = []
+    for object_id_bytes in yielding(object_ids):
+        record = eon_db.get(OBJECT_KEYSPACE + object_id_bytes)
+        if record is not None and (object_filter is None or object_filter.accepts_record(record)):
+            object_records.append((object_id_bytes, record))
+
+    return trackable_objects_from_records(object_records, query_timestamp, query_range, region)
+
+
+
+def object_span_value(detection_class_id, frame_timestamps):
+    return bytes(0).join( ( timestamp_to_bytes(min(frame_timestamps)), timestamp_to_bytes(max(frame_timestamps)), int(detection_class_id).to_bytes(2, byteorder=s2sphere_byteorder) ) )
+
+
+def parse_object_span(value):
+    # Returns (first frame_timestamp, last frame_timestamp, detection_class_id)
+    return (
+        int.from_bytes(value[0:TIMESTAMP_BYTES], byteorder=s2sphere_byteorder),
+        int.from_bytes(value[TIMESTAMP_BYTES:2*TIMESTAMP_BYTES], byteorder=s2sphere_byteorder),
+        int.from_bytes(value[2*TIMESTAMP_BYTES:], byteorder=s2sphere_byteorder)
+    )
+
+
+def put_object_span(write_batch, object_id, detection_class_id, frame_timestamps):
+    write_batch.put(OBJECT_SPAN_KEYSPACE + bytes.fromhex(object_id), object_span_value(detection_class_id, frame_timestamps))
+
+
+def iterate_objects_time_window(eon_db, object_ids, query_timestamp, query_range):
+    # Yields (cell_id, frame_timestamp, value) like iterate_time_window() but only for the objects with these objectIDs (bytes)
+    # The time index is only read over the part of each object's span that's in the window. Objects written before spans were ...
+    # ... kept are looked for in one read of the whole window
+    query_end = query_timestamp + query_range
+    unspanned_object_ids = set()
+    for object_id_bytes in object_ids:
+        span = eon_db.get(OBJECT_SPAN_KEYSPACE + object_id_bytes)
+        if span is None:
+            unspanned_object_ids.add(object_id_bytes)
+            continue
+
+        first_timestamp, last_timestamp, _ = parse_object_span(span)
+        start, stop = max(query_timestamp, first_timestamp), min(query_end, last_timestamp + 1)
+        if start < stop:
+            for row in iterate_time_window(eon_db, start, stop - start):
+                if row[2][0:OBJECT_ID_BYTES] == object_id_bytes:
+                    yield row
+
+    if unspanned_object_ids:
+        for row in iterate_time_window(eon_db, query_timestamp, query_range):
+            if row[2][0:OBJECT_ID_BYTES] in unspanned_object_ids:
+                yield row
+
+
+
+class ObjectFilter:
+    '''
+    The objects a query wants, from its 'detection_class_ids' (an allowlist, like [6] for only buses) and 'object_ids' (hex
+    objectIDs to look up). Either can be left out.
+
+    Tracklet values and object records are checked as they're stored, before anything in them is decoded. With objectIDs the
+    queries read only those objects' entries instead of the whole time window
+    '''
+    def __init__(self, detection_class_ids=None, object_ids=None):
+        self.detection_class_ids = None
+        self.class_id_bytes = None
+        if detection_class_ids is not None:
+            self.detection_class_ids = set(int(detection_class_id) for detection_class_id in detection_class_ids)
+            if any(not 0 <= detection_class_id < 0x10000 for detection_class_id in self.detection_class_ids):
+                raise ValueError("detection_class_ids are out of range")
+            self.class_id_bytes = set(detection_class_id.to_bytes(2, byteorder=s2sphere_byteorder) for detection_class_id in self.detection_class_ids)
+
+        self.object_ids = None # objectID bytes, in the order given
+        self.object_id_set = None
+        self.object_id_hexes = None
+        if object_ids is not None:
+            self.object_ids = list(dict.fromkeys(bytes.fromhex(object_id) for object_id in object_ids))
+            if any(len(object_id_bytes) != OBJECT_ID_BYTES for object_id_bytes in self.object_ids):
+                raise ValueError("object_ids must be "+str(OBJECT_ID_BYTES)+" bytes of hex")
+            self.object_id_set = set(self.object_ids)
+            self.object_id_hexes = set(object_id_bytes.hex() for object_id_bytes in self.object_ids)
+
+    @classmethod
+    def from_query(cls, query_dict):
+        # None if the query doesn't filter objects
+        if query_dict.get('detection_class_ids') is None and query_dict.get('object_ids') is None:
+            return None
+        return cls(detection_class_ids=query_dict.get('detection_class_ids'), object_ids=query_dict.get('object_ids'))
+
+    def accepts_value(self, value):
+        # A tracklet value: objectID (16 bytes) + detection_class_id (2 bytes)
+        return (self.object_id_set is None or value[0:OBJECT_ID_BYTES] in self.object_id_set) and \
+            (self.class_id_bytes is None or value[OBJECT_ID_BYTES:] in self.class_id_bytes)
+
+    def accepts_record(self, record):
+        # An object record, whose detection_class_id comes after its start frame_timestamp
+        return self.class_id_bytes is None or record[TIMESTAMP_BYTES:TIMESTAMP_BYTES+2] in self.class_id_bytes
+
+    def accepts(self, trackable_object):
+        # A trackable object in the query result format
+        return (self.object_id_hexes is None or trackable_object['object_id'] in self.object_id_hexes) and \
+            (self.detection_class_ids is None or trackable_object['detection_class_id'] in self.detection_class_ids)
+
+    def filter(self, trackable_objects):
+        return [trackable_object for trackable_object in trackable_objects if self.accepts(trackable_object)]
+
+    def excluding(self, object_ids):
+        # The same filter without these (hex) objectIDs
+        if self.object_ids is None:
+            return self
+        excluded_filter = ObjectFilter()
+        excluded_filter.detection_class_ids, excluded_filter.class_id_bytes = self.detection_class_ids, self.class_id_bytes
+        excluded_filter.object_ids = [object_id_bytes for object_id_bytes in self.object_ids if object_id_bytes.hex() not in object_ids]
+        excluded_filter.object_id_set = set(excluded_filter.object_ids)
+        excluded_filter.object_id_hexes = set(object_id_bytes.hex() for object_id_bytes in excluded_filter.object_ids)
+        return excluded_filter
+
+
+
+class Region:
+    '''
+    A lat/lng bounding box or polygon to query. Built from the 'region' of a query:
+        {"bbox": [west, south, east, north]} or {"polygon": [[lng, lat], [lng, lat], ...]}
+
+    The database is read through an S2 covering of the region's bounding box (https://s2geometry.io/devguide/s2cell_hierarchy
+    #s2cellid-numbering). Every cell of the covering is one contiguous range of cell IDs, so one bounded iterator per range
+    reads only the tracklets in or close to the region. contains() then drops the ones just outside it
+    '''
+    def __init__(self, bbox=None, polygon=None, max_cells=16):
+        if polygon is not None:
+            self.polygon = np.asarray(polygon, dtype=float).reshape(-1, 2)
+            if self.polygon.shape[0] < 3:
+                raise ValueError("A region polygon needs at least 3 [lng, lat] points")
+            west, south = self.polygon.min(axis=0)
+            east, north = self.polygon.max(axis=0)
+        elif bbox is not None:
+            self.polygon = None
+            west, south, east, north = [float(value) for value in bbox]
+        else:
+            raise ValueError("A region needs a 'bbox' or a 'polygon'")
+
+        self.bbox = (min(west, east), min(south, north), max(west, east), max(south, north))
+
+        region_coverer = s2sphere.RegionCoverer()
+        region_coverer.max_cells = max_cells
+        rect = s2sphere.LatLngRect.from_point_pair(s2sphere.LatLng.from_degrees(self.bbox[1], self.bbox[0]), s2sphere.LatLng.from_degrees(self.bbox[3], self.bbox[2]))
+        self.covering = region_coverer.get_covering(rect)
+
+    @classmethod
+    def from_query(cls, region_dict):
+        return cls(bbox=region_dict.get('bbox'), polygon=region_dict.get('polygon'))
+
+    def cell_ranges(self, level=CELL_ID_LEVEL):
+        # Sorted, merged [first, last] cell ID ranges of the covering for keys made from cell IDs of 'level'. For the leaf ...
+        # ... cell-primary keys that's each covering cell's leaf range. Cells finer than 'level' become their parent at 'level'
+        ranges = []
+        for cell in self.covering:
+            if cell.level() > level:
+                cell = cell.parent(level)
+            ranges.append((cell.range_min().id(), cell.range_max().id()))
+
+        merged_ranges = []
+        for first, last in sorted(ranges):
+            if merged_ranges and first <= merged_ranges[-1][1] + 2: # Consecutive leaf cell IDs are 2 apart
+                merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], last))
+            else:
+                merged_ranges.append((first, last))
+        return merged_ranges
+
+    def contains(self, lngs, lats):
+        # Boolean array of which [lng, lat] points are in the region
+        lngs = np.asarray(lngs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        west, south, east, north = self.bbox
+        inside = (lngs >= west) & (lngs <= east) & (lats >= south) & (lats <= north)
+        if self.polygon is None or not inside.any():
+            return inside
+
+        # Even-odd ray casting against every polygon edge at once for the points inside the bounding box
+        x, y = lngs[inside][:, None], lats[inside][:, None]
+        x1, y1 = self.polygon[:, 0], self.polygon[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_at_y = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside[inside] = (np.count_nonzero(crosses & (x < x_at_y), axis=1) % 2) == 1
+        return inside
+
+
+def iterate_region(eon_db, region, query_timestamp, query_range):
+    # Yields (cell_id, frame_timestamp, value) for each tracklet in the time window whose cell is in the region's covering
+    # One bounded iterator over the cell-primary keys per covering range
+    for first, last in region.cell_ranges():
+        start = first.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder)
+        stop = (last + 1).to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder)
+        for key, value in eon_db.iterator(start=start, stop=stop):
+            frame_timestamp = int.from_bytes(key[CELL_ID_BYTES:], byteorder=s2sphere_byteorder)
+            if query_timestamp <= frame_timestamp < query_timestamp + query_range:
+                yield int.from_bytes(key[0:CELL_ID_BYTES], byteorder=s2sphere_byteorder), frame_timestamp, value
+
+
+def iterate_object_ids_in_region(eon_db, region, query_timestamp, query_range):
+    # Yields the objectID bytes of each object the space index has in the region's covering during the minutes the window ...
+    # ... touches. Each only once. One bounded iterator per minute and covering range, so the work follows the window's length
+    first_minute = max(query_timestamp, 0) // OBJECT_TIME_INDEX_BUCKET
+    last_minute = max(query_timestamp + query_range - 1, 0) // OBJECT_TIME_INDEX_BUCKET
+    cell_ranges = region.cell_ranges(OBJECT_SPACE_INDEX_LEVEL)
+
+    seen = set()
+    for minute in range(first_minute, last_minute + 1):
+        minute_prefix = OBJECT_SPACE_INDEX_KEYSPACE + minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder)
+        for first, last in cell_ranges:
+            start = minute_prefix + first.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder)
+            stop = minute_prefix + (last + 1).to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder)
+            for key in eon_db.iterator(start=start, stop=stop, include_value=False):
+                object_id_bytes = key[len(minute_prefix)+CELL_ID_BYTES:]
+                if object_id_bytes not in seen:
+                    seen.add(object_id_bytes)
+                    yield object_id_bytes
+
+
+
+def rollup_key(minute, coarse_cell_id, detection_class_id):
+    return bytes(0).join( ( ROLLUP_KEYSPACE, minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder), coarse_cell_id.to_bytes(CELL_ID_BYTES, byteorder=s2sphere_byteorder),
+        int(detection_class_id).to_bytes(2, byteorder=s2sphere_byteorder) ) )
+
+
+def rollup_value(object_count, tracklet_count):
+    value = bytearray()
+    append_varint(value, object_count)
+    append_varint(value, tracklet_count)
+    return bytes(value)
+
+
+def parse_rollup_value(value):
+    # Returns (object_count, tracklet_count)
+    object_count, position = read_varint(value, 0)
+    tracklet_count, _ = read_varint(value, position)
+    return object_count, tracklet_count
+
+
+def object_rollup_counts(detection_class_id, cell_ids, frame_timestamps):
+    # {(minute, coarse cell ID, detection_class_id): [object count, tracklet count]} of one object. It counts once in every ...
+    # ... minute and coarse cell it has points in
+    counts = {}
+    coarse_cell_ids = s2cells.parent_cell_ids(cell_ids, ROLLUP_LEVEL).tolist()
+    for coarse_cell_id, frame_timestamp in zip(coarse_cell_ids, frame_timestamps):
+        key = (int(frame_timestamp) // ROLLUP_BUCKET, coarse_cell_id, int(detection_class_id))
+        if key in counts:
+            counts[key][1] += 1
+        else:
+            counts[key] = [1, 1]
+    return counts
+
+
+def add_rollups(eon_db, write_batch, counts):
+    # Add 'counts' to the rollup records of one partition. The records are read here and rewritten in 'write_batch' so this is ...
+    # ... only safe with a single writer, and all the counts for a batch have to be added together in one call
+    for (minute, coarse_cell_id, detection_class_id), (object_count, tracklet_count) in counts.items():
+        key = rollup_key(minute, coarse_cell_id, detection_class_id)
+        value = eon_db.get(key)
+        if value is not None:
+            stored_object_count, stored_tracklet_count = parse_rollup_value(value)
+            object_count += stored_object_count
+            tracklet_count += stored_tracklet_count
+        write_batch.put(key, rollup_value(object_count, tracklet_count))
+
+
+def iterate_rollups(eon_db, query_timestamp, query_range):
+    # Yields (minute, coarse cell ID, detection_class_id, object count, tracklet count) for the minutes the window touches
+    first_minute = max(query_timestamp, 0) // ROLLUP_BUCKET
+    last_minute = max(query_timestamp + query_range - 1, 0) // ROLLUP_BUCKET
+    start = ROLLUP_KEYSPACE + first_minute.to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder)
+    stop = ROLLUP_KEYSPACE + (last_minute + 1).to_bytes(MINUTE_BYTES, byteorder=s2sphere_byteorder)
+
+    position = len(ROLLUP_KEYSPACE)
+    for key, value in eon_db.iterator(start=start, stop=stop):
+        minute = int.from_bytes(key[position:position+MINUTE_BYTES], byteorder=s2sphere_byteorder)
+        coarse_cell_id = int.from_bytes(key[position+MINUTE_BYTES:position+MINUTE_BYTES+CELL_ID_BYTES], byteorder=s2sphere_byteorder)
+        detection_class_id = int.from_bytes(key[position+MINUTE_BYTES+CELL_ID_BYTES:], byteorder=s2sphere_byteorder)
+        yield (minute, coarse_cell_id, detection_class_id) + parse_rollup_value(value)
+
+
+def sum_rollups(rows, bucket=None, level=ROLLUP_LEVEL, region=None):
+    # Sum rollup rows into {(bucket start timestamp, cell ID, detection_class_id): [object count, tracklet count]}
+    # 'bucket' (milliseconds, a multiple of a minute) merges minutes together, None merges them all into one. 'level' merges ...
+    # ... cells into their parent at a coarser level. With a region only the cells whose centre is in it are counted
+    # Objects are counted per minute, so an object that stays in a cell for 3 minutes counts 3 times in a longer bucket
+    rows = list(rows)
+    if not rows:
+        return {}
+
+    coarse_cell_ids = [coarse_cell_id for _, coarse_cell_id, _, _, _ in rows]
+    if region is not None:
+        lats, lngs = s2cells.lat_lng_from_cell_ids(coarse_cell_ids)
+        inside = region.contains(lngs, lats).tolist()
+        rows = [row for row, is_inside in zip(rows, inside) if is_inside]
+        coarse_cell_ids = [coarse_cell_id for coarse_cell_id, is_inside in zip(coarse_cell_ids, inside) if is_inside]
+        if not rows:
+            return {}
+
+    if level < ROLLUP_LEVEL:
+        coarse_cell_ids = s2cells.parent_cell_ids(coarse_cell_ids, level).tolist()
+
+    sums = {}
+    for (minute, _, detection_class_id, object_count, tracklet_count), cell_id in zip(rows, coarse_cell_ids):
+        bucket_timestamp = 0 if bucket is None else (minute * ROLLUP_BUCKET) // bucket * bucket
+        key = (bucket_timestamp, cell_id, detection_class_id)
+        if key in sums:
+            sums[key][0] += object_count
+            sums[key][1] += tracklet_count
+        else:
+            sums[key] = [object_count, tracklet_count]
+    return sums
+
+
+def rollups_from_sums(sums, bucket=None):
+    # Turn sum_rollups() results into the query result format, with the centre of each cell for drawing a heatmap
+    keys = sorted(sums)
+    lats, lngs = s2cells.lat_lng_from_cell_ids([cell_id for _, cell_id, _ in keys])
+    rollup_list = []
+    for (bucket_timestamp, cell_id, detection_class_id), lat, lng in zip(keys, lats.tolist(), lngs.tolist()):
+        rollup = {
+            "cell_id": str(cell_id),
+            "lng": lng,
+            "lat": lat,
+            "detection_class_id": detection_class_id,
+            "objects": sums[(bucket_timestamp, cell_id, detection_class_id)][0],
+            "tracklets": sums[(bucket_timestamp, cell_id, detection_class_id)][1]
+        }
+        if bucket is not None:
+            rollup["timestamp"] = bucket_timestamp
+        rollup_list.append(rollup)
+    return rollup_list
+
+
+def query_rollups(eon_db, query_timestamp, query_range, bucket=None, level=ROLLUP_LEVEL, region=None):
+    # Rollup counts of one partition for the minutes the window touches
+    return rollups_from_sums(sum_rollups(iterate_rollups(eon_db, query_timestamp, query_range), bucket, level, region), bucket)
+
+
+
+'''
+Eon partitions
+
+Tracklets are partitioned by time into eons of a fixed length. Each eon is its own key range of the database,
+b'\x01' + eon number (4 bytes), with the layouts above inside it. A time window query only reads the partitions it overlaps
+and a whole expired eon is dropped by deleting its key range and compacting it.
+
+Everything written before partitioning is in the legacy b'\x00' partition. It stays readable and is dropped as a whole once
+its newest tracklet has expired.
+'''
+LEGACY_PARTITION_PREFIX = b'\x00'
+EON_PARTITION_PREFIX = b'\x01'
+METADATA_PREFIX = b'\x02'
+EON_LENGTH_KEY = METADATA_PREFIX + b'eon_length' # The eon length (milliseconds) the partitions were created with
+EON_BYTES = 4
+
+DELETE_BATCH_SIZE = 10000
+
+
+class PrefixedPuts:
+    # Adds one partition's prefix to the keys put into a write batch on the whole database
+    def __init__(self, write_batch, prefix):
+        self.write_batch = write_batch
+        self.prefix = prefix
+
+    def put(self, key, value):
+        self.write_batch.put(self.prefix + key, value)
+
+
+class PartitionedWriteBatch:
+    # One write batch on the whole database so puts to several eon partitions are still committed atomically
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.write_batch = partitions.db.write_batch()
+        self.eons = set()
+        self.rollup_counts = {} # eon -> rollup counts added to that partition by this batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            for eon, counts in self.rollup_counts.items():
+                add_rollups(self.partitions.eon_db(eon), self.for_eon(eon), counts)
+            self.write_batch.write()
+            self.partitions.known_eons.update(self.eons)
+
+    def add_object_rollups(self, detection_class_id, cell_ids, frame_timestamps):
+        # Count a completed object in the rollups of the partition of each minute it's in. The counts of every object ...
+        # ... in the batch are added up first and the rollup records are only read and rewritten once, when it's written
+        for (minute, coarse_cell_id, class_id), (object_count, tracklet_count) in object_rollup_counts(detection_class_id, cell_ids, frame_timestamps).items():
+            counts = self.rollup_counts.setdefault(self.partitions.eon(minute * ROLLUP_BUCKET), {})
+            key = (minute, coarse_cell_id, class_id)
+            if key in counts:
+                counts[key][0] += object_count
+                counts[key][1] += tracklet_count
+            else:
+                counts[key] = [object_count, tracklet_count]
+
+    def for_eon(self, eon):
+        self.eons.add(eon)
+        return PrefixedPuts(self.write_batch, self.partitions.eon_prefix(eon))
+
+    def for_timestamp(self, frame_timestamp):
+        # The partition a tracklet with this frame_timestamp goes into
+        return self.for_eon(self.partitions.eon(frame_timestamp))
+
+    def for_timestamps(self, frame_timestamps):
+        # Every partition from the first to the last of these frame_timestamps
+        return [self.for_eon(eon) for eon in range(self.partitions.eon(min(frame_timestamps)), self.partitions.eon(max(frame_timestamps)) + 1)]
+
+
+class EonPartitions:
+    def __init__(self, db, eon_length=3600000, retention=None):
+        # eon_length and retention are in milliseconds. With no retention nothing is ever deleted
+        self.db = db
+        self.retention = retention
+
+        # The eon length is a property of the database. If the partitions were made with a different one keep using it
+        stored_eon_length = db.get(EON_LENGTH_KEY)
+        if stored_eon_length is not None and int(stored_eon_length) != eon_length:
+            print("Tracklets database eons are "+str(int(stored_eon_length))+" ms long, not "+str(eon_length)+" ms. Keeping "+str(int(stored_eon_length))+" ms")
+            eon_length = int(stored_eon_length)
+        elif stored_eon_length is None:
+            db.put(EON_LENGTH_KEY, bytes(str(eon_length), 'ascii'))
+        self.eon_length = eon_length
+
+        self.legacy_db = db.prefixed_db(LEGACY_PARTITION_PREFIX)
+        self.known_eons = set(self.list_eons())
+        self.eon_dbs = {}
+
+    def eon(self, frame_timestamp):
+        return int(frame_timestamp) // self.eon_length
+
+    def eon_prefix(self, eon):
+        return EON_PARTITION_PREFIX + eon.to_bytes(EON_BYTES, byteorder=s2sphere_byteorder)
+
+    def eon_db(self, eon):
+        if eon not in self.eon_dbs:
+            self.eon_dbs[eon] = self.db.prefixed_db(self.eon_prefix(eon))
+        return self.eon_dbs[eon]
+
+    def write_batch(self):
+        return PartitionedWriteBatch(self)
+
+    def list_eons(self):
+        # The eon numbers that have a partition. Seeks from one partition to the next instead of reading all their keys
+        eons = []
+        iterator = self.db.iterator(prefix=EON_PARTITION_PREFIX, include_value=False)
+        while True:
+            key = next(iterator, None)
+            if key is None:
+                break
+            eon = int.from_bytes(key[len(EON_PARTITION_PREFIX):len(EON_PARTITION_PREFIX)+EON_BYTES], byteorder=s2sphere_byteorder)
+            eons.append(eon)
+            iterator.seek(self.eon_prefix(eon + 1))
+        iterator.close()
+        return eons
+
+    def legacy_has_data(self):
+        return next(self.legacy_db.iterator(include_value=False), None) is not None
+
+    def partitions_overlapping(self, query_timestamp, query_range):
+        # The legacy partition (if it has anything in it) and the eon partitions that overlap the window
+        partition_dbs = [self.legacy_db] if self.legacy_has_data() else []
+        first_eon = self.eon(max(query_timestamp, 0))
+        last_eon = self.eon(max(query_timestamp + query_range - 1, 0))
+        partition_dbs += [self.eon_db(eon) for eon in sorted(self.known_eons) if first_eon <= eon <= last_eon]
+        return partition_dbs
+
+    def snapshot(self, query_timestamp, query_range):
+        # Snapshots of the partitions that overlap the window, taken together so they're all of the same writes. A query ...
+        # ... given them as 'partition_dbs' can run in another thread while the writer carries on and sees none of its writes
+        return [partition_db.snapshot() for partition_db in self.partitions_overlapping(query_timestamp, query_range)]
+
+    def query_time_window(self, query_timestamp, query_range, storage_layout='tracklets', region=None, object_filter=None, partition_dbs=None):
+        # query_time_window() of every overlapping partition (or of 'partition_dbs'). An object can be in more than one partition ...
+        # ... when it crosses an eon boundary. Its tracklets from each of them are merged
+        if partition_dbs is None:
+            partition_dbs = self.partitions_overlapping(query_timestamp, query_range)
+
+        trackable_objects = {}
+        for partition_db in partition_dbs:
+            for trackable_object in yielding(query_time_window(partition_db, query_timestamp, query_range, storage_layout=storage_layout, region=region, object_filter=object_filter), 100):
+                merged_object = trackable_objects.get(trackable_object['object_id'])
+                if merged_object is None:
+                    trackable_objects[trackable_object['object_id']] = trackable_object
+                else:
+                    frame_timestamps = set(tracklet[2] for tracklet in merged_object['tracklets'])
+                    merged_object['tracklets'] += [tracklet for tracklet in trackable_object['tracklets'] if tracklet[2] not in frame_timestamps]
+                    merged_object['tracklets'].sort(key=lambda tracklet: tracklet[2])
+
+        return list(trackable_objects.values())
+
+    def query_rollups(self, query_timestamp, query_range, bucket=None, level=ROLLUP_LEVEL, region=None, partition_dbs=None):
+        # Rollup counts summed over every overlapping partition (or over 'partition_dbs')
+        if partition_dbs is None:
+            partition_dbs = self.partitions_overlapping(query_timestamp, query_range)
+
+        sums = {}
+        for partition_db in partition_dbs:
+            for key, (object_count, tracklet_count) in sum_rollups(iterate_rollups(partition_db, query_timestamp, query_range), bucket, level, region).items():
+                if key in sums:
+                    sums[key][0] += object_count
+                    sums[key][1] += tracklet_count
+                else:
+                    sums[key] = [object_count, tracklet_count]
+
+        return rollups_from_sums(sums, bucket)
+
+    def expire(self, now, on_batch=None):
+        # Drop every partition that's entirely older than now - retention (milliseconds). 'on_batch' is called between delete ...
+        # ... batches so a caller that's also serving queries can let them run. Returns the number of partitions dropped
+        if self.retention is None:
+            return 0
+
+        cutoff = now - self.retention
+        dropped = 0
+
+        for eon in sorted(self.known_eons):
+            if (eon + 1) * self.eon_length > cutoff:
+                break
+            self.delete_range(self.eon_prefix(eon), self.eon_prefix(eon + 1), on_batch)
+            self.known_eons.discard(eon)
+            self.eon_dbs.pop(eon, None)
+            dropped += 1
+
+        newest_legacy_timestamp = newest_timestamp(self.legacy_db)
+        if newest_legacy_timestamp is not None and newest_legacy_timestamp < cutoff:
+            self.delete_range(LEGACY_PARTITION_PREFIX, EON_PARTITION_PREFIX, on_batch)
+            dropped += 1
+
+        return dropped
+
+    def delete_range(self, start, stop, on_batch=None):
+        # LevelDB has no range delete. Delete the keys in batches, then compact the range so its space is given back right away
+        next_key = start
+        while True:
+            keys = []
+            for key in self.db.iterator(start=next_key, stop=stop, include_value=False):
+                keys.append(key)
+                if len(keys) == DELETE_BATCH_SIZE:
+                    break
+
+            if not keys:
+                break
+
+            with self.db.write_batch() as wb:
+                for key in keys:
+                    wb.delete(key)
+
+            # Carry on after the last deleted key instead of skipping over the deleted ones again
+            next_key = keys[-1] + b'\x00'
+
+            if on_batch is not None:
+                on_batch()
+
+        self.db.compact_range(start=start, stop=stop)
+
+
+def newest_timestamp(eon_db):
+    # frame_timestamp of the newest tracklet in a partition (to the minute for object records), or None if it's empty
+    newest = None
+
+    key = next(eon_db.iterator(prefix=TIME_INDEX_KEYSPACE, include_value=False, reverse=True), None)
+    if key is not None:
+        newest = int.from_bytes(key[len(TIME_INDEX_KEYSPACE):len(TIME_INDEX_KEYSPACE)+TIMESTAMP_BYTES], byteorder=s2sphere_byteorder)
+
+    key = next(eon_db.iterator(prefix=OBJECT_TIME_INDEX_KEYSPACE, include_value=False, reverse=True), None)
+    if key is not None:
+        minute = int.from_bytes(key[len(OBJECT_TIME_INDEX_KEYSPACE):len(OBJECT_TIME_INDEX_KEYSPACE)+MINUTE_BYTES], byteorder=s2sphere_byteorder)
+        newest = max(newest or 0, (minute + 1) * OBJECT_TIME_INDEX_BUCKET - 1)
+
+    if newest is None and next(eon_db.iterator(stop=b'\xc0', include_value=False), None) is not None:
+        # Cell-primary keys that were never time indexed. Their time is after the cell ID so find the newest the slow way
+        newest = max(int.from_bytes(key[CELL_ID_BYTES:], byteorder=s2sphere_byteorder) for key in eon_db.iterator(stop=b'\xc0', include_value=False))
+
+    return newest
@@ -0,0 +1,155 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+import heapq
+import math
+import time
+import numpy as np
+
+
+'''
+Level of detail for query results
+
+The map only needs enough points of each trajectory to animate it, so a query can ask for its trackable objects to be thinned out
+before they're sent, with the 'lod' of the query:
+    {"max_points": 200, "tolerance_m": 0.5, "min_spacing_m": 1.0, "min_spacing_ms": 500}
+Any of them can be left out.
+
+    min_spacing_m / min_spacing_ms: drop points that are closer than min_spacing_m metres AND sooner than min_spacing_ms after the
+        last point kept. A parked car keeps a point every min_spacing_ms, a fast one every min_spacing_m
+    tolerance_m: drop the points that the trajectory through the remaining ones passes within tolerance_m metres of
+    max_points: keep at most this many points per object, the ones that matter most to its shape
+
+tolerance_m and max_points use the Douglas-Peucker algorithm (https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm)
+with the synchronized euclidean distance: a point's error is how far it is from where the simplified trajectory has the object
+at that point's frame_timestamp, not just how far it is from the simplified path. So stops and changes of speed are kept as well
+as turns, which matters since the map interpolates positions by time. The first and last points are always kept.
+'''
+LOD_KEYS = ['max_points', 'tolerance_m', 'min_spacing_m', 'min_spacing_ms']
+
+METRES_PER_DEGREE = 111319.49 # Along a meridian (and along the equator)
+
+
+
+def lod_from_query(lod_dict):
+    # Validated level of detail settings from a query's 'lod'. Raises ValueError or TypeError for invalid ones
+    if not isinstance(lod_dict, dict):
+        raise TypeError("'lod' must be an object")
+
+    lod = {}
+    for key, value in lod_dict.items():
+        if key not in LOD_KEYS:
+            raise ValueError("Unknown level of detail setting "+str(key))
+        if value is None:
+            continue
+        value = int(value) if key == 'max_points' else float(value)
+        if value < 0 or (key == 'max_points' and value < 2):
+            raise ValueError("Level of detail setting "+key+" is out of range")
+        lod[key] = value
+    return lod
+
+
+def simplify_trackable_objects(trackable_objects, max_points=None, tolerance_m=None, min_spacing_m=None, min_spacing_ms=None):
+    # Thin out the tracklets of each trackable object (query result format) in place. Returns the list
+    if max_points is None and tolerance_m is None and min_spacing_m is None and min_spacing_ms is None:
+        return trackable_objects
+
+    for count, trackable_object in enumerate(trackable_objects, start=1):
+        if count % 100 == 0:
+            time.sleep(0) # It runs in a query thread. Let the main thread's greenlets have the GIL
+        tracklets = trackable_object['tracklets']
+        if len(tracklets) <= 2:
+            continue
+
+        keep = simplify(np.asarray(tracklets, dtype=float).reshape(-1, 3), max_points, tolerance_m, min_spacing_m, min_spacing_ms)
+        trackable_object['tracklets'] = [tracklets[index] for index in keep.tolist()]
+
+    return trackable_objects
+
+
+def simplify(tracklets, max_points=None, tolerance_m=None, min_spacing_m=None, min_spacing_ms=None):
+    # Sorted indexes of the [lng, lat, frame_timestamp] rows to keep. The rows must be in frame_timestamp order
+    n = tracklets.shape[0]
+    if n <= 2:
+        return np.arange(n)
+
+    # Metres east and north of the first point (equirectangular, fine over the few km a camera sees)
+    xy = np.empty((n, 2), dtype=float)
+    xy[:, 0] = (tracklets[:, 0] - tracklets[0, 0]) * METRES_PER_DEGREE * math.cos(math.radians(tracklets[0, 1]))
+    xy[:, 1] = (tracklets[:, 1] - tracklets[0, 1]) * METRES_PER_DEGREE
+    t = tracklets[:, 2]
+
+    candidates = np.arange(n)
+    if min_spacing_m is not None or min_spacing_ms is not None:
+        candidates = spaced_indexes(xy, t, math.inf if min_spacing_m is None else min_spacing_m, math.inf if min_spacing_ms is None else min_spacing_ms)
+
+    if max_points is None and tolerance_m is None:
+        return candidates
+
+    return candidates[douglas_peucker(xy[candidates], t[candidates], max_points, tolerance_m)]
+
+
+def spaced_indexes(xy, t, min_spacing_m, min_spacing_ms):
+    # Indexes of the points at least min_spacing_m metres from, or min_spacing_ms later than, the last one kept. Plus the last point
+    # Either spacing can be math.inf, which turns that test off
+    keep = [0]
+    last_x, last_y, last_t = xy[0, 0], xy[0, 1], t[0]
+    min_spacing_m_squared = min_spacing_m * min_spacing_m
+    for index, (x, y, frame_timestamp) in enumerate(zip(xy[1:, 0].tolist(), xy[1:, 1].tolist(), t[1:].tolist()), start=1):
+        if frame_timestamp - last_t >= min_spacing_ms or (x - last_x)**2 + (y - last_y)**2 >= min_spacing_m_squared:
+            keep.append(index)
+            last_x, last_y, last_t = x, y, frame_timestamp
+
+    if keep[-1] != xy.shape[0] - 1:
+        keep.append(xy.shape[0] - 1)
+    return np.array(keep)
+
+
+def synchronized_distances(xy, t, first, last):
+    # Distance of each point between 'first' and 'last' from where the straight segment between them has the object at its time
+    inner = slice(first + 1, last)
+    duration = t[last] - t[first]
+    fraction = (t[inner] - t[first]) / duration if duration > 0 else np.zeros(last - first - 1)
+    expected = xy[first] + fraction[:, None] * (xy[last] - xy[first])
+    return np.hypot(*(xy[inner] - expected).T)
+
+
+def douglas_peucker(xy, t, max_points=None, tolerance_m=None):
+    # Top-down Douglas-Peucker that always splits the segment with the largest error next, so it can stop at max_points as well ...
+    # ... as at the tolerance. Returns the sorted indexes kept
+    n = xy.shape[0]
+    if n <= 2 or (max_points is None and tolerance_m is None):
+        return np.arange(n)
+
+    keep = [0, n - 1]
+    segments = []
+
+    def add_segment(first, last):
+        if last - first > 1:
+            errors = synchronized_distances(xy, t, first, last)
+            worst = int(errors.argmax())
+            heapq.heappush(segments, (-float(errors[worst]), first, last, first + 1 + worst))
+
+    add_segment(0, n - 1)
+    while segments:
+        if max_points is not None and len(keep) >= max_points:
+            break
+
+        negative_error, first, last, index = heapq.heappop(segments)
+        if tolerance_m is not None and -negative_error <= tolerance_m:
+            break
+
+        keep.append(index)
+        add_segment(first, index)
+        add_segment(index, last)
+
+    return np.array(sorted(keep))
@@ -0,0 +1,143 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+from collections import OrderedDict
+import gevent
+
+
+class WindowCache:
+    '''
+    LRU cache of decoded query results for the tracklets socket server, by time bucket.
+
+    A time window query is answered from the fixed length buckets it overlaps. Each bucket is the decoded result of
+    load_bucket(bucket start, bucket length) (the trackable objects with tracklets in it, in the query result format). They're
+    merged by objectID and trimmed to the window. The map's windows move forward with the clock (or jump back when the clock is
+    dragged) so after serving a query the next bucket in that direction is prefetched in a greenlet.
+
+    invalidate() has to be called with the time span of everything written to the database (each commit) so no bucket with
+    stale contents is used again. A load only caches its bucket if the bucket wasn't invalidated (and the cache wasn't cleared) since
+    the load started, however many loads of it overlap.
+    '''
+    def __init__(self, load_bucket, bucket_length=60000, max_buckets=60):
+        self.load_bucket = load_bucket
+        self.bucket_length = bucket_length
+        self.max_buckets = max_buckets
+
+        self.buckets = OrderedDict() # bucket number -> trackable objects, least recently used first
+        self.invalidation_count = 0 # Goes up with every invalidate() and clear()
+        self.cleared_at = 0 # invalidation_count of the last clear()
+        self.loads_in_flight = {} # bucket number -> how many loads of it haven't finished
+        self.invalidated_at = {} # bucket number -> invalidation_count when it was last invalidated. Only while it's being loaded
+        self.prefetching = set()
+        self.last_first_bucket = None
+
+
+    def bucket(self, frame_timestamp):
+        return int(frame_timestamp) // self.bucket_length
+
+
+    def get(self, bucket):
+        trackable_objects = self.buckets.get(bucket)
+        if trackable_objects is not None:
+            self.buckets.move_to_end(bucket)
+            return trackable_objects
+        return self.load(bucket)
+
+
+    def load(self, bucket):
+        started_at = self.invalidation_count
+        self.loads_in_flight[bucket] = self.loads_in_flight.get(bucket, 0) + 1
+        try:
+            trackable_objects = self.load_bucket(bucket * self.bucket_length, self.bucket_length)
+            # Not invalidated or cleared while it was being loaded
+            if self.invalidated_at.get(bucket, 0) <= started_at and self.cleared_at <= started_at:
+                self.buckets[bucket] = trackable_objects
+                self.buckets.move_to_end(bucket)
+                while len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+        finally:
+            self.loads_in_flight[bucket] -= 1
+            if self.loads_in_flight[bucket] == 0:
+                del self.loads_in_flight[bucket]
+                self.invalidated_at.pop(bucket, None)
+        return trackable_objects
+
+
+    def query_time_window(self, query_timestamp, query_range):
+        # Same result as querying the database for the window. Every trackable object returned is a new dict so callers can change it
+        first_bucket = self.bucket(max(query_timestamp, 0))
+        last_bucket = self.bucket(max(query_timestamp + query_range - 1, 0))
+        query_end = query_timestamp + query_range
+
+        trackable_objects = {}
+        for bucket in range(first_bucket, last_bucket + 1):
+            # Only the first and last bucket can stick out of the window
+            trim = bucket == first_bucket or bucket == last_bucket
+            for trackable_object in self.get(bucket):
+                tracklets = trackable_object['tracklets']
+                if trim:
+                    tracklets = [tracklet for tracklet in tracklets if query_timestamp <= tracklet[2] < query_end]
+                    if not tracklets:
+                        continue
+
+                merged_object = trackable_objects.get(trackable_object['object_id'])
+                if merged_object is None:
+                    trackable_objects[trackable_object['object_id']] = dict(trackable_object, tracklets=list(tracklets))
+                else:
+                    merged_object['tracklets'] += tracklets # Buckets are in time order so this keeps the tracklets in order
+
+        # Read ahead in the direction the windows are moving
+        if self.last_first_bucket is not None and first_bucket < self.last_first_bucket:
+            self.prefetch(first_bucket - 1)
+        else:
+            self.prefetch(last_bucket + 1)
+        self.last_first_bucket = first_bucket
+
+        return list(trackable_objects.values())
+
+
+    def prefetch(self, bucket):
+        if self.max_buckets <= 0 or bucket < 0 or bucket in self.buckets or bucket in self.prefetching:
+            return
+
+        def prefetch_bucket():
+            try:
+                if bucket not in self.buckets:
+                    self.load(bucket)
+            finally:
+                self.prefetching.discard(bucket)
+
+        self.prefetching.add(bucket)
+        gevent.spawn(prefetch_bucket)
+
+
+    def invalidate(self, first_timestamp, last_timestamp):
+        # Drop the buckets from first_timestamp to last_timestamp (milliseconds)
+        first_bucket = self.bucket(max(first_timestamp, 0))
+        last_bucket = self.bucket(max(last_timestamp, 0))
+        if last_bucket - first_bucket < len(self.buckets):
+            for bucket in range(first_bucket, last_bucket + 1):
+                self.buckets.pop(bucket, None)
+        else:
+            for bucket in [bucket for bucket in self.buckets if first_bucket <= bucket <= last_bucket]:
+                del self.buckets[bucket]
+
+        self.invalidation_count += 1
+        for bucket in self.loads_in_flight:
+            if first_bucket <= bucket <= last_bucket:
+                self.invalidated_at[bucket] = self.invalidation_count
+
+
+    def clear(self):
+        self.buckets.clear()
+        self.invalidation_count += 1
+        self.cleared_at = self.invalidation_count
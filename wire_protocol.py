@@ -0,0 +1,369 @@
+# Copyright (C) 2018-2020 David Thompson
+#
+# This file is part of Grassland
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of Grassland, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+
+import json
+import numpy as np
+import gevent
+from gevent.lock import Semaphore
+from gevent.queue import Queue
+
+
+'''
+Framing for the tracklets (8766) and calibration (8765) sockets
+
+Every message is a frame:
+    payload length (4 bytes, big-endian) + message type (1 byte) + request ID (4 bytes, big-endian) + payload
+so a reader always knows how many bytes to wait for, however TCP splits them up.
+
+A request is one MESSAGE_JSON frame. A list response (tracklets, rollups) is streamed as MESSAGE_JSON_CHUNK frames, each a JSON
+array holding the next few items, or MESSAGE_BINARY_CHUNK frames of packed trackable objects, followed by a MESSAGE_END frame.
+Concatenating the chunks gives the whole list. Nothing ever has to build the whole response as one string.
+
+Every frame of a response has the request ID of its request, so one long-lived connection can carry many requests at once
+(serve_requests()) with their responses matched back by ID. The client picks the IDs. A MESSAGE_CANCEL frame with a request's ID
+stops its response. No more frames are sent for it after that, so a client that's moved on (like the map scrubbing the timeline)
+doesn't wait for or read answers it no longer wants.
+
+Instead of a list, a request can be answered with a PushStream (a subscription). Its messages are sent as MESSAGE_PUSH frames as
+they happen, for as long as the client keeps the request open. It ends when the client cancels it or closes the connection, or
+with a MESSAGE_ERROR if the client falls too far behind.
+
+Packed trackable objects (all little-endian):
+    number of objects (uint32), then for each object
+    objectID (16 bytes) + detection_class_id (int16) + number of tracklets n (uint32) + n lngs (float32) + n lats (float32) + n frame_timestamps (int64)
+float32 keeps about 7 significant digits so lng/lat are rounded to within a metre or so. Use JSON for full precision.
+
+Unframed requests (one write of raw JSON, starting with '{') from older clients are still accepted. A frame can't start with '{'
+since that would be a payload of more than 2 GB.
+'''
+MESSAGE_JSON = 1 # A whole JSON message
+MESSAGE_JSON_CHUNK = 2 # A JSON array, part of a streamed list
+MESSAGE_BINARY_CHUNK = 3 # Packed trackable objects, part of a streamed list
+MESSAGE_END = 4 # End of a streamed list. No payload
+MESSAGE_ERROR = 5 # JSON {"error": "..."} instead of the response
+MESSAGE_CANCEL = 6 # Stop answering the request with this ID. No payload
+MESSAGE_PUSH = 7 # A JSON message of a PushStream
+
+ENCODINGS = ['json', 'binary']
+
+HEADER_BYTES = 9
+MAX_PAYLOAD_BYTES = 16 * 1024 * 1024
+CHUNK_ITEMS = 500 # Items per chunk of a streamed list
+
+UNFRAMED_REQUEST_BYTES = 65536
+
+
+# What an 'answer' function given to serve_requests() raises for a request that's missing something or has invalid values
+REQUEST_ERRORS = (KeyError, ValueError, TypeError)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+
+def frame(message_type, payload=b'', request_id=0):
+    return len(payload).to_bytes(4, byteorder='big') + bytes((message_type,)) + request_id.to_bytes(4, byteorder='big') + payload
+
+
+def recv_exactly(socket, n):
+    # Returns exactly n bytes, or None if the connection closed before any of them arrived
+    buffer = bytearray()
+    while len(buffer) < n:
+        data = socket.recv(n - len(buffer))
+        if not data:
+            if buffer:
+                raise ProtocolError("Connection closed in the middle of a message")
+            return None
+        buffer += data
+    return bytes(buffer)
+
+
+def read_frame(socket, header=None):
+    # Returns (message type, request ID, payload) or None if the connection closed between messages
+    header = header or recv_exactly(socket, HEADER_BYTES)
+    if header is None:
+        return None
+
+    length = int.from_bytes(header[0:4], byteorder='big')
+    if length > MAX_PAYLOAD_BYTES:
+        raise ProtocolError("Message of "+str(length)+" bytes is too big")
+
+    payload = recv_exactly(socket, length) if length > 0 else b''
+    if payload is None:
+        raise ProtocolError("Connection closed in the middle of a message")
+    return header[4], int.from_bytes(header[5:9], byteorder='big'), payload
+
+
+def read_first_header(socket):
+    # Returns the header of the first frame on a connection, b'{' for an old style unframed JSON request or None if the ...
+    # ... connection closed without sending anything
+    first_byte = recv_exactly(socket, 1)
+    if first_byte is None or first_byte == b'{':
+        return first_byte
+
+    rest = recv_exactly(socket, HEADER_BYTES - 1)
+    if rest is None:
+        raise ProtocolError("Connection closed in the middle of a message")
+    return first_byte + rest
+
+
+def read_unframed_request(socket):
+    # The rest of an old style request after its '{'. It had to arrive in one write
+    return json.loads((b'{' + socket.recv(UNFRAMED_REQUEST_BYTES)).decode('utf-8'))
+
+
+def read_request(socket):
+    # Returns (request dict, framed) or (None, False) if the connection closed without a request
+    # 'framed' is False for an old style unframed JSON request, which should get an unframed JSON answer
+    header = read_first_header(socket)
+    if header is None:
+        return None, False
+
+    if header == b'{':
+        return read_unframed_request(socket), False
+
+    message_type, _, payload = read_frame(socket, header)
+    if message_type != MESSAGE_JSON:
+        raise ProtocolError("Expected a JSON request, not message type "+str(message_type))
+    return json.loads(payload.decode('utf-8')), True
+
+
+def send_json(socket, message, message_type=MESSAGE_JSON, request_id=0):
+    socket.sendall(frame(message_type, bytes(json.dumps(message), 'utf-8'), request_id))
+
+
+def list_frames(items, encoding='json', request_id=0, chunk_items=CHUNK_ITEMS):
+    # Yields the frames that stream a list: chunks of 'chunk_items' items then an end message. 'binary' is only for trackable objects
+    for start in range(0, len(items), chunk_items):
+        chunk = items[start:start+chunk_items]
+        if encoding == 'binary':
+            yield frame(MESSAGE_BINARY_CHUNK, pack_trackable_objects(chunk), request_id)
+        else:
+            yield frame(MESSAGE_JSON_CHUNK, bytes(json.dumps(chunk), 'utf-8'), request_id)
+
+    yield frame(MESSAGE_END, b'', request_id)
+
+
+def read_list(socket, request_id=0):
+    # Read a streamed list back into one list, skipping frames of other requests. For Python clients of the sockets
+    items = []
+    while True:
+        message = read_frame(socket)
+        if message is None:
+            raise ProtocolError("Connection closed in the middle of a list")
+
+        message_type, message_request_id, payload = message
+        if message_request_id != request_id:
+            continue
+        elif message_type == MESSAGE_END:
+            return items
+        elif message_type == MESSAGE_JSON_CHUNK:
+            items += json.loads(payload.decode('utf-8'))
+        elif message_type == MESSAGE_BINARY_CHUNK:
+            items += unpack_trackable_objects(payload)
+        elif message_type == MESSAGE_ERROR:
+            raise ProtocolError(json.loads(payload.decode('utf-8'))['error'])
+        else:
+            raise ProtocolError("Unexpected message type "+str(message_type)+" in a list")
+
+
+
+class PushStream:
+    # Messages to push to one subscriber. push() never blocks the publisher. If more than 'max_pending' messages are waiting ...
+    # ... to be sent the subscriber is too slow, and the stream is closed with 'overflowed' set
+    def __init__(self, max_pending=1000):
+        self.queue = Queue()
+        self.max_pending = max_pending
+        self.closed = False
+        self.overflowed = False
+        self.on_close = None
+
+    def push(self, message):
+        if self.closed:
+            return False
+        if self.queue.qsize() >= self.max_pending:
+            self.overflowed = True
+            self.close()
+            return False
+        self.queue.put(message)
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(StopIteration)
+            if self.on_close is not None:
+                self.on_close()
+
+    def __iter__(self):
+        while True:
+            message = self.queue.get()
+            if message is StopIteration:
+                return
+            yield message
+
+
+
+def serve_requests(socket, answer):
+    # Answer requests on a connection until the client closes it. answer(request dict) returns (list, encoding), a PushStream ...
+    # ... or raises one of REQUEST_ERRORS. Each framed request is answered in its own greenlet, so a slow one doesn't hold up the others
+    header = read_first_header(socket)
+    if header is None:
+        return
+
+    if header == b'{':
+        # Old style client. One unframed request, answered with unframed JSON
+        request = read_unframed_request(socket)
+        try:
+            result = answer(request)
+            if isinstance(result, PushStream):
+                result.close()
+                raise ValueError("Subscriptions need a framed connection")
+            items, _ = result
+        except REQUEST_ERRORS as e:
+            print("Invalid request", request, repr(e))
+            items = []
+        socket.sendall(bytes(json.dumps(items), 'utf-8'))
+        return
+
+    RequestConnection(socket, answer).run(header)
+
+
+class RequestConnection:
+    '''
+    The framed requests of one connection. Any number can be in progress at once. Frames of different responses can be
+    interleaved but each frame is sent whole (the send lock) so they never get mixed up inside a frame.
+    '''
+    def __init__(self, socket, answer):
+        self.socket = socket
+        self.answer = answer
+        self.send_lock = Semaphore()
+        self.requests = {} # request ID -> {'cancelled': bool, 'stream': PushStream or None} for each request still being answered
+
+    def send(self, frame_bytes):
+        with self.send_lock:
+            self.socket.sendall(frame_bytes)
+
+    def run(self, header=None):
+        try:
+            while True:
+                message = read_frame(self.socket, header)
+                header = None
+                if message is None:
+                    break
+
+                message_type, request_id, payload = message
+                if message_type == MESSAGE_JSON:
+                    if request_id in self.requests:
+                        self.send(frame(MESSAGE_ERROR, bytes(json.dumps({"error": "Request ID "+str(request_id)+" is already in use"}), 'utf-8'), request_id))
+                        continue
+                    self.requests[request_id] = {'cancelled': False, 'stream': None}
+                    gevent.spawn(self.respond, request_id, payload)
+                elif message_type == MESSAGE_CANCEL:
+                    if request_id in self.requests:
+                        self.cancel(self.requests[request_id])
+                else:
+                    raise ProtocolError("Unexpected message type "+str(message_type)+" from the client")
+        finally:
+            # The client's gone. Stop every response still being sent
+            for request in list(self.requests.values()):
+                self.cancel(request)
+
+    def cancel(self, request):
+        request['cancelled'] = True
+        if request['stream'] is not None:
+            request['stream'].close() # Wakes up the greenlet waiting for its next message
+
+    def respond(self, request_id, payload):
+        request = self.requests[request_id]
+        try:
+            # Cancelled before it even started (superseded by a newer request that arrived with it)
+            if request['cancelled']:
+                return
+
+            try:
+                request_dict = json.loads(payload.decode('utf-8'))
+                result = self.answer(request_dict)
+            except REQUEST_ERRORS as e:
+                print("Invalid request", payload[:200], repr(e))
+                self.send(frame(MESSAGE_ERROR, bytes(json.dumps({"error": repr(e)}), 'utf-8'), request_id))
+                return
+
+            if isinstance(result, PushStream):
+                self.push(request_id, request, result)
+                return
+
+            items, encoding = result
+            for frame_bytes in list_frames(items, encoding, request_id):
+                if request['cancelled']:
+                    return
+                self.send(frame_bytes)
+                gevent.sleep(0) # Let the connection read cancellations and other requests start between chunks
+        except OSError:
+            self.cancel(request) # Connection closed
+        finally:
+            self.requests.pop(request_id, None)
+
+    def push(self, request_id, request, stream):
+        # Send the stream's messages until the request is cancelled or the stream is closed
+        request['stream'] = stream
+        if request['cancelled']:
+            stream.close()
+
+        try:
+            for message in stream:
+                if request['cancelled']:
+                    break
+                self.send(frame(MESSAGE_PUSH, bytes(json.dumps(message), 'utf-8'), request_id))
+        finally:
+            stream.close()
+
+        if stream.overflowed and not request['cancelled']:
+            self.send(frame(MESSAGE_ERROR, bytes(json.dumps({"error": "Subscriber fell behind"}), 'utf-8'), request_id))
+
+
+
+def pack_trackable_objects(trackable_objects):
+    parts = [len(trackable_objects).to_bytes(4, byteorder='little')]
+    for trackable_object in trackable_objects:
+        tracklets = np.array(trackable_object['tracklets'], dtype=float).reshape(-1, 3)
+        parts.append(bytes.fromhex(trackable_object['object_id']))
+        parts.append(int(trackable_object['detection_class_id']).to_bytes(2, byteorder='little', signed=True))
+        parts.append(tracklets.shape[0].to_bytes(4, byteorder='little'))
+        parts.append(tracklets[:, 0].astype('<f4').tobytes())
+        parts.append(tracklets[:, 1].astype('<f4').tobytes())
+        parts.append(tracklets[:, 2].astype('<i8').tobytes())
+    return b''.join(parts)
+
+
+def unpack_trackable_objects(payload):
+    trackable_objects = []
+    count = int.from_bytes(payload[0:4], byteorder='little')
+    position = 4
+    for _ in range(count):
+        object_id = payload[position:position+16].hex()
+        detection_class_id = int.from_bytes(payload[position+16:position+18], byteorder='little', signed=True)
+        n = int.from_bytes(payload[position+18:position+22], byteorder='little')
+        position += 22
+
+        lngs = np.frombuffer(payload, dtype='<f4', count=n, offset=position).astype(float)
+        lats = np.frombuffer(payload, dtype='<f4', count=n, offset=position + 4*n).astype(float)
+        frame_timestamps = np.frombuffer(payload, dtype='<i8', count=n, offset=position + 8*n)
+        position += 16*n
+
+        trackable_objects.append({
+            "object_id": object_id,
+            "detection_class_id": detection_class_id,
+            "tracklets": [list(tracklet) for tracklet in zip(lngs.tolist(), lats.tolist(), frame_timestamps.tolist())]
+        })
+    return trackable_objects